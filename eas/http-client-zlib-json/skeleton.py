@@ -1,11 +1,35 @@
+from collections import deque
+import asyncio
 from io import StringIO
 import json
+import os
 import socket
 import sys
+import time
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 import zlib
 
+# bytes asked of every recv_into, the buffer is allocated once per connection
+RECV_SIZE = 256 * 1024
+
+# a response header longer than this is not waited for
+MAX_HEADER_SIZE = 64 * 1024
+
+# window bits of the codings the server may answer with; a response without
+# Content-Encoding is the server's legacy zlib body when the request had no
+# Accept-Encoding, and identity when it had one
+WBITS = {'zlib': zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS, 'gzip': 16 + zlib.MAX_WBITS}
+LEGACY_ENCODING = 'zlib'
+
+# what ConnectionPool asks for
+ACCEPT_ENCODING = 'gzip, deflate'
+
+# requests ConnectionPool keeps in flight at once, the connections it keeps open
+POOL_LIMIT = 16
+# methods ConnectionPool sends again when a reused connection turns out to be closed
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE'))
+
 def get_first_length(data):
     """Get the length of the first part of the response, including the header and the content if Content-Length is present."""
     header = data.split('\r\n\r\n')[0]
@@ -24,6 +48,267 @@ def create_socket():
     client_socket.connect(server_address)
     return client_socket
 
+def parse_head(head):
+    """Return the status code and the headers, with lowercase names, of a response head"""
+    status_line, *lines = bytes(head).decode('latin-1').split('\r\n')
+    headers = {}
+    for line in lines:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return int(status_line.split(' ')[1]), headers
+
+def get_decompressor(headers, negotiated=False):
+    """Return a decompressobj for the body of a response, None for an identity body
+
+    negotiated tells whether the request sent Accept-Encoding.
+    """
+    default = 'identity' if negotiated else LEGACY_ENCODING
+    encoding = headers.get('content-encoding', default).lower()
+    if encoding == 'identity':
+        return None
+    return zlib.decompressobj(WBITS[encoding])
+
+class ResponseReader:
+    """Read HTTP/1.1 responses off one socket as bytes, one after the other.
+
+    Every recv_into goes to the same preallocated buffer. The header terminator
+    is searched once in the received bytes. The body is read up to its
+    Content-Length, its last chunk or the close of the connection, and it is
+    decompressed as it arrives. Bytes received past a response stay for the next one.
+    """
+
+    def __init__(self, sock, size=RECV_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        # received and not consumed yet: a header, a chunk size line or a pipelined response
+        self.pending = bytearray()
+
+    def receive(self, eof_ok=False):
+        """Receive into the buffer, return a view of what arrived, valid until the next call"""
+        count = self.sock.recv_into(self.view)
+        if not count and not eof_ok:
+            raise ConnectionError('connection closed in the middle of a response')
+        return self.view[:count]
+
+    def read_head(self):
+        """Return the status code and the headers, with lowercase names, of the next response"""
+        searched = 0
+        end = self.pending.find(b'\r\n\r\n')
+        while end < 0:
+            if len(self.pending) > MAX_HEADER_SIZE:
+                raise ValueError(f'response header exceeds {MAX_HEADER_SIZE} bytes')
+            # the terminator may straddle what was searched and what arrives
+            searched = max(0, len(self.pending) - 3)
+            self.pending += self.receive()
+            end = self.pending.find(b'\r\n\r\n', searched)
+        head = self.pending[:end]
+        del self.pending[:end + 4]
+        return parse_head(head)
+
+    def read_line(self):
+        end = self.pending.find(b'\r\n')
+        while end < 0:
+            if len(self.pending) > MAX_HEADER_SIZE:
+                raise ValueError('chunk size line too long')
+            self.pending += self.receive()
+            end = self.pending.find(b'\r\n')
+        line = bytes(self.pending[:end])
+        del self.pending[:end + 2]
+        return line
+
+    def read_exactly(self, count):
+        # the pending bytes first, then straight from the receive buffer
+        if self.pending and count:
+            piece = bytes(self.pending[:count])
+            del self.pending[:count]
+            count -= len(piece)
+            yield piece
+        while count:
+            data = self.receive()
+            if len(data) > count:
+                self.pending += data[count:]
+                data = data[:count]
+            count -= len(data)
+            yield data
+
+    def read_body(self, headers):
+        """Yield the raw body in the pieces it arrived in, each one valid until the next"""
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            while True:
+                size = int(self.read_line().split(b';')[0], 16)
+                if not size:
+                    # skip the trailer up to its empty line
+                    while self.read_line():
+                        pass
+                    return
+                yield from self.read_exactly(size)
+                self.read_line()
+        elif 'content-length' in headers:
+            yield from self.read_exactly(int(headers['content-length']))
+        else:
+            # the end of the body is the end of the connection
+            if self.pending:
+                yield bytes(self.pending)
+                self.pending.clear()
+            while True:
+                data = self.receive(eof_ok=True)
+                if not data:
+                    return
+                yield data
+
+    def read_content(self, headers):
+        """Yield the decompressed body as it arrives"""
+        decompressor = get_decompressor(headers)
+        if decompressor is None:
+            for piece in self.read_body(headers):
+                yield bytes(piece)
+            return
+        for piece in self.read_body(headers):
+            data = decompressor.decompress(piece)
+            if data:
+                yield data
+        data = decompressor.flush()
+        if data:
+            yield data
+
+    def read_response(self):
+        """Return the status code, the headers and the decompressed body of the next response"""
+        status, headers = self.read_head()
+        return status, headers, b''.join(self.read_content(headers))
+
+async def read_body_async(reader, headers):
+    """Yield the raw body of a response from an asyncio StreamReader, the async read_body"""
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if not size:
+                while (await reader.readline()).strip():
+                    pass
+                return
+            yield await reader.readexactly(size)
+            await reader.readexactly(2)
+    elif 'content-length' in headers:
+        remaining = int(headers['content-length'])
+        while remaining:
+            data = await reader.read(min(remaining, RECV_SIZE))
+            if not data:
+                raise ConnectionError('connection closed in the middle of a response')
+            remaining -= len(data)
+            yield data
+    else:
+        while True:
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                return
+            yield data
+
+async def read_head_async(reader):
+    """Return the status code and the headers of the next response"""
+    return parse_head((await reader.readuntil(b'\r\n\r\n'))[:-4])
+
+async def read_content_async(reader, headers, negotiated=False):
+    """Return the decompressed body of the response whose headers were read"""
+    decompressor = get_decompressor(headers, negotiated)
+    pieces = []
+    async for piece in read_body_async(reader, headers):
+        pieces.append(piece if decompressor is None else decompressor.decompress(piece))
+    if decompressor is not None:
+        pieces.append(decompressor.flush())
+    return b''.join(pieces)
+
+async def read_response_async(reader, negotiated=False):
+    """Return the status code, the headers and the decompressed body of the next response"""
+    status, headers = await read_head_async(reader)
+    return status, headers, await read_content_async(reader, headers, negotiated)
+
+class ConnectionPool:
+    """Keep-alive connections to one server shared by concurrent requests.
+
+    At most limit requests are in flight, each on a connection of its own; a
+    connection goes back to the pool after its response and is reused by the
+    next request, so at most limit connections are ever open.
+    """
+
+    def __init__(self, address=('localhost', 8080), limit=POOL_LIMIT):
+        self.address = address
+        self.limit = asyncio.Semaphore(limit)
+        # (reader, writer) of the open connections no request is using
+        self.idle = []
+        self.opened = 0
+
+    async def connect(self):
+        self.opened += 1
+        return await asyncio.open_connection(*self.address)
+
+    async def send(self, connection, request):
+        # write request, return the status code and the headers of its response
+        reader, writer = connection
+        writer.write(request)
+        return await read_head_async(reader)
+
+    async def exchange(self, connection, request, negotiated=True):
+        # negotiated: request carries Accept-Encoding, as the ones request() builds do
+        status, headers = await self.send(connection, request)
+        return status, headers, await read_content_async(connection[0], headers, negotiated)
+
+    async def request(self, target, method='GET'):
+        """Return the status code, the headers and the decompressed body of one request"""
+        request = (f'{method} {target} HTTP/1.1\r\nHost: {self.address[0]}\r\n'
+                   f'Accept-Encoding: {ACCEPT_ENCODING}\r\n\r\n').encode('latin-1')
+        async with self.limit:
+            connection = self.idle.pop() if self.idle else None
+            try:
+                if connection is None:
+                    connection = await self.connect()
+                    status, headers = await self.send(connection, request)
+                else:
+                    try:
+                        status, headers = await self.send(connection, request)
+                    except (asyncio.IncompleteReadError, ConnectionError) as error:
+                        # the server closed the idle connection; the request is sent again
+                        # only when none of its response had arrived and repeating it is safe
+                        if (isinstance(error, asyncio.IncompleteReadError) and error.partial
+                                or method not in IDEMPOTENT_METHODS):
+                            raise
+                        connection[1].close()
+                        connection = await self.connect()
+                        status, headers = await self.send(connection, request)
+                # a failure in the body is never retried
+                content = await read_content_async(connection[0], headers, negotiated=True)
+            except BaseException:
+                if connection is not None:
+                    connection[1].close()
+                raise
+
+            if headers.get('connection', '').lower() == 'close':
+                connection[1].close()
+            else:
+                self.idle.append(connection)
+            return status, headers, content
+
+    async def get_json(self, target):
+        """GET target and return its decompressed JSON body"""
+        status, headers, content = await self.request(target)
+        return json.loads(content)
+
+    async def close(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            writer.close()
+            await writer.wait_closed()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+async def fetch_all(targets, address=('localhost', 8080), limit=POOL_LIMIT):
+    """GET every target with at most limit in flight, return their JSON in order"""
+    async with ConnectionPool(address, limit) as pool:
+        return await asyncio.gather(*(pool.get_json(target) for target in targets))
+
 def client():
     """Send a GET request to the server and print the response."""
     # Create socket and Send the request
@@ -32,42 +317,124 @@ def client():
     request_header = b'GET index.html HTTP/1.1\r\nHost: localhost\r\n\r\n'
     client_socket.send(request_header)
 
-    # Receive the response
-    response = ''
-    while True:
-        # Receive data
-        received = client_socket.recv(1024)
-        decoded_received = received.decode('utf-8')
-        print(decoded_received)
-        first_length = get_first_length(decoded_received)
-        response += decoded_received
-
-        # Break if no more data
-        if not received or first_length < 1024:
-            break
-
-    # Decode and Print the response
-    print(response)
-
-    # Get the status code
-    status_code = response.split(' ')[1]
+    # Receive the response, the body is decompressed as it arrives
+    status_code, headers, content = ResponseReader(client_socket).read_response()
 
     # Print the status code
-    if status_code == 200:
-        print(status_code)
     print(status_code)
 
-
     # Close the socket 
     client_socket.close()
 
-    # Decompress and parse JSON content
-    body = response.split('\r\n\r\n')[1]
-    content = zlib.decompress(body)
+    # Parse JSON content
     json_content = json.loads(content)
     
     print(json_content)
 
+def serve_response(listener, response, runs):
+    # benchmark child: send the same response on each of runs connections
+    for _ in range(runs):
+        sock, _ = listener.accept()
+        sock.sendall(response)
+        sock.close()
+
+def read_whole(sock):
+    # what client() did, made safe for compressed bytes: 1024-byte recvs, decompressed at the end
+    pieces = []
+    while True:
+        received = sock.recv(1024)
+        if not received:
+            break
+        pieces.append(received)
+    header, _, body = b''.join(pieces).partition(b'\r\n\r\n')
+    return len(zlib.decompress(body))
+
+def read_incremental(sock):
+    reader = ResponseReader(sock)
+    status, headers = reader.read_head()
+    return sum(len(piece) for piece in reader.read_content(headers))
+
+def benchmark_large_response(size=100 * 1024 * 1024, runs=3):
+    import multiprocessing
+
+    # hex of random bytes deflates to about its entropy, 4 bits a character
+    content = json.dumps({'data': os.urandom(size).hex()}).encode()
+    body = zlib.compress(content, 1)
+    print(f'{len(body) / 1e6:.0f} MB zlib body, {len(content) / 1e6:.0f} MB decompressed, best of {runs}')
+    framed = b''.join(b'%x\r\n%s\r\n' % (len(body[offset:offset + 65536]), body[offset:offset + 65536])
+                      for offset in range(0, len(body), 65536))
+    responses = {
+        'Content-Length': b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body),
+        'chunked': b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n%s0\r\n\r\n' % framed,
+    }
+    del framed
+    print(f'{"":>32} {"MB/s":>8}')
+    for framing, read in (('Content-Length', read_whole), ('Content-Length', read_incremental),
+                          ('chunked', read_incremental)):
+        listener = socket.create_server(('localhost', 0))
+        server = multiprocessing.Process(target=serve_response, args=(listener, responses[framing], runs))
+        server.start()
+        best = float('inf')
+        for _ in range(runs):
+            started = time.perf_counter()
+            with socket.create_connection(listener.getsockname()) as sock:
+                assert read(sock) == len(content)
+            best = min(best, time.perf_counter() - started)
+        server.join()
+        listener.close()
+        print(f'{f"{read.__name__}, {framing}":>32} {len(body) / best / 1e6:>8.0f}')
+
+def connect_when_ready(timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return create_socket()
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+def benchmark_pool(requests=5000, concurrencies=(1, 16, 128)):
+    import signal
+    import subprocess
+
+    # the server of the sibling directory, in its run mode
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'http-server-zlib-json', 'skeleton.py')
+    server = subprocess.Popen([sys.executable, server_path, 'run'], stdout=subprocess.DEVNULL)
+    try:
+        connect_when_ready().close()
+        print(f'GET index.html x {requests}')
+        print(f'{"":>28} {"req/s":>8}')
+
+        # what client() does for every request
+        request = b'GET index.html HTTP/1.1\r\nHost: localhost\r\n\r\n'
+        started = time.perf_counter()
+        for _ in range(requests):
+            client_socket = create_socket()
+            client_socket.send(request)
+            json.loads(ResponseReader(client_socket).read_response()[2])
+            client_socket.close()
+        print(f'{"socket per request":>28} {requests / (time.perf_counter() - started):>8.0f}')
+
+        async def fan_out(limit):
+            async with ConnectionPool(limit=limit) as pool:
+                # open the connections one by one before timing, a burst of connects
+                # overflows the backlog of 5 the server listens with
+                for _ in range(limit):
+                    connection = await pool.connect()
+                    await pool.exchange(connection, request, negotiated=False)
+                    pool.idle.append(connection)
+                started = time.perf_counter()
+                await asyncio.gather(*(pool.get_json('index.html') for _ in range(requests)))
+                return time.perf_counter() - started, pool.opened
+
+        for limit in concurrencies:
+            elapsed, opened = asyncio.run(fan_out(limit))
+            print(f'{f"pool, concurrency {limit}":>28} {requests / elapsed:>8.0f}  ({opened} connections)')
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait()
+
 # A 'null' stream that discards anything written to it
 class NullWriter(StringIO):
     def write(self, txt):
@@ -79,6 +446,17 @@ def assert_equal(parameter1, parameter2):
     else:
         print(f'test attribute failed: {parameter1} is not equal to {parameter2}')
 
+def recv_into_from(pieces):
+    # side effect of a mock recv_into that receives pieces one by one, then the close
+    pieces = deque(pieces)
+    def recv_into(buffer):
+        if not pieces:
+            return 0
+        piece = pieces.popleft()
+        buffer[:len(piece)] = piece
+        return len(piece)
+    return recv_into
+
 class TestHttpClient(unittest.TestCase):
     def test_get_first_length_no_content_length(self):
         print('Testing get_first_length_no_content_length ...')
@@ -90,6 +468,163 @@ class TestHttpClient(unittest.TestCase):
         data = "HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n12345"
         assert_equal(get_first_length(data), len(data.split('\r\n\r\n')[0]) + 5)
 
+    def test_response_reader_split_and_pipelined(self):
+        print('Testing ResponseReader ...')
+        first = zlib.compress(b'{"message": "Hello world!"}')
+        gzip_compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+        second = gzip_compressor.compress(b'[1, 2, 3]') + gzip_compressor.flush()
+        data = b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s' % (len(first), first) + \
+               b'HTTP/1.1 404 Not found\r\nContent-Encoding: gzip\r\nTransfer-Encoding: chunked\r\n\r\n' + \
+               b'%x\r\n%s\r\n%x\r\n%s\r\n0\r\n\r\n' % (5, second[:5], len(second) - 5, second[5:])
+        # a few bytes at a time, so header terminators and chunk lines are split
+        sock = MagicMock()
+        sock.recv_into.side_effect = recv_into_from([data[offset:offset + 7] for offset in range(0, len(data), 7)])
+
+        reader = ResponseReader(sock)
+        status, headers, content = reader.read_response()
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(content), {'message': 'Hello world!'})
+        status, headers, content = reader.read_response()
+        self.assertEqual(status, 404)
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertEqual(json.loads(content), [1, 2, 3])
+        self.assertEqual(len(reader.pending), 0)
+        print()
+
+    @patch(f'{__name__}.create_socket')
+    def test_client(self, mock_create_socket):
+        print('Testing client ...')
+        body = zlib.compress(b'{"message": "Hello world!"}')
+        sock = mock_create_socket.return_value
+        sock.recv_into.side_effect = recv_into_from([b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body)])
+        output = StringIO()
+        with patch('sys.stdout', new=output):
+            client()
+        sock.send.assert_called_once_with(b'GET index.html HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        self.assertEqual(output.getvalue(), "200\n{'message': 'Hello world!'}\n")
+        sock.close.assert_called_once()
+        print()
+
+    def test_connection_pool_reuse_and_retry(self):
+        print('Testing ConnectionPool ...')
+        body = zlib.compress(b'{"message": "Hello world!"}')
+        # the pool asks for gzip or deflate, a body without Content-Encoding would be identity
+        response = b'HTTP/1.1 200 OK\r\nContent-Encoding: deflate\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body)
+        accepted = []
+
+        async def handle(reader, writer):
+            # answer two requests, then drop the connection like an idle timeout
+            accepted.append(writer)
+            try:
+                for _ in range(2):
+                    await reader.readuntil(b'\r\n\r\n')
+                    writer.write(response)
+                    await writer.drain()
+            except asyncio.IncompleteReadError:
+                # the pool closed it first
+                pass
+            writer.close()
+
+        async def fetch():
+            server = await asyncio.start_server(handle, 'localhost', 0)
+            async with server:
+                pool = ConnectionPool(server.sockets[0].getsockname()[:2], limit=3)
+                async with pool:
+                    first = await asyncio.gather(*(pool.get_json('index.html') for _ in range(6)))
+                    await asyncio.sleep(0.05)
+                    # the pooled connections are closed by now, the requests go on new ones
+                    second = await asyncio.gather(*(pool.get_json('index.html') for _ in range(3)))
+                return first + second, pool.opened
+
+        results, opened = asyncio.run(fetch())
+        self.assertEqual(results, [{'message': 'Hello world!'}] * 9)
+        self.assertEqual(opened, 6)
+        self.assertEqual(len(accepted), 6)
+        print()
+
+    def test_connection_pool_no_unsafe_retry(self):
+        print('Testing ConnectionPool retries ...')
+        body = zlib.compress(b'{"message": "Hello world!"}')
+        head = b'HTTP/1.1 200 OK\r\nContent-Encoding: deflate\r\nContent-Length: %d\r\n\r\n' % len(body)
+
+        accepted = []
+
+        async def handle(reader, writer):
+            # a whole response, then on the first connection the head and half the body
+            # of the next one, on the others a close like an idle timeout
+            accepted.append(writer)
+            await reader.readuntil(b'\r\n\r\n')
+            writer.write(head + body)
+            if len(accepted) > 1:
+                await writer.drain()
+                writer.close()
+                return
+            try:
+                await reader.readuntil(b'\r\n\r\n')
+            except asyncio.IncompleteReadError:
+                pass
+            else:
+                writer.write(head + body[:5])
+                await writer.drain()
+            writer.close()
+
+        async def fetch():
+            server = await asyncio.start_server(handle, 'localhost', 0)
+            async with server:
+                async with ConnectionPool(server.sockets[0].getsockname()[:2], limit=1) as pool:
+                    await pool.get_json('index.html')
+                    # the response had started, the request is not sent again
+                    with self.assertRaises(ConnectionError):
+                        await pool.get_json('index.html')
+                    self.assertEqual(pool.opened, 1)
+
+                    # a closed idle connection is only retried for an idempotent method
+                    await pool.get_json('index.html')
+                    await asyncio.sleep(0.05)
+                    with self.assertRaises((asyncio.IncompleteReadError, ConnectionError)):
+                        await pool.request('/submit', 'POST')
+                    self.assertEqual(pool.opened, 2)
+
+        asyncio.run(fetch())
+        print()
+
+    def test_fetch_all_from_server(self):
+        print('Testing fetch_all against the server ...')
+        import signal
+        import subprocess
+
+        server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'http-server-zlib-json',
+                                   'skeleton.py')
+        if not os.path.exists(server_path):
+            self.skipTest('the server skeleton is not next to the client')
+        try:
+            create_socket().close()
+        except OSError:
+            pass
+        else:
+            self.skipTest('port 8080 is taken')
+        server = subprocess.Popen([sys.executable, server_path, 'run'], stdout=subprocess.DEVNULL)
+        try:
+            connect_when_ready().close()
+            # the streamed items come gzip coded, index.html is too short and comes as is
+            items, index = asyncio.run(fetch_all(['/items?count=3', 'index.html']))
+            self.assertEqual([item['id'] for item in items], [0, 1, 2])
+            self.assertEqual(index, {'status': 200, 'message': 'Hello world!'})
+
+            # without Accept-Encoding both are the legacy zlib body
+            with connect_when_ready() as sock:
+                sock.sendall(b'GET /items?count=3 HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                             b'GET index.html HTTP/1.1\r\nHost: localhost\r\n\r\n')
+                reader = ResponseReader(sock)
+                status, headers, content = reader.read_response()
+                self.assertEqual((status, len(json.loads(content))), (200, 3))
+                status, headers, content = reader.read_response()
+                self.assertEqual(json.loads(content), {'status': 200, 'message': 'Hello world!'})
+        finally:
+            server.send_signal(signal.SIGINT)
+            server.wait()
+        print()
+
     @patch('socket.socket')
     def test_create_socket(self, mock_socket):
         print('Testing create_socket ...')
@@ -103,6 +638,11 @@ if __name__ == '__main__':
     if len(sys.argv) == 2 and sys.argv[1] == 'run':
         client()
 
+    elif len(sys.argv) == 2 and sys.argv[1] == 'bench':
+        benchmark_large_response()
+        benchmark_pool()
+        sys.exit()
+
     # run unit test to test locally
     # or for domjudge
     runner = unittest.TextTestRunner(stream=NullWriter())
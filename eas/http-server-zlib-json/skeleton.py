@@ -1,13 +1,88 @@
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 from io import StringIO
+from urllib.parse import parse_qs, unquote
+import gzip
+import mimetypes
+import os
 import socket
 import select
+import stat
 import sys
+import threading
+import time
 import unittest
 import zlib
 import json
 from unittest.mock import MagicMock, patch
 
-def get_content(status):
+# optional encoders, negotiated only when installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# reason phrases of the statuses the server answers with
+REASONS = {200: 'OK', 206: 'Partial Content', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not found',
+           405: 'Method Not Allowed', 416: 'Range Not Satisfiable', 500: 'Internal Server Error'}
+
+# limits of one request, a client sending more is answered with 400 and closed
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+
+# keep-alive connections without a request for this long are closed
+IDLE_TIMEOUT = 15.0
+
+# a client that pipelines faster than it reads is not read until this much output drained
+OUTBOUND_LIMIT = 1024 * 1024
+
+# requests under this prefix are files of the static_root directory given to serve()
+STATIC_PREFIX = '/static/'
+
+# bodies smaller than this fit in one packet anyway, compressing them only costs CPU
+COMPRESS_MIN_SIZE = 860
+
+# coding of clients that send no Accept-Encoding: a zlib body without a Content-Encoding
+# header, what this server always sent and what its client decompresses
+LEGACY_ENCODING = 'zlib'
+
+# generated bodies are compressed and sent in chunks of about this much JSON
+CHUNK_SIZE = 64 * 1024
+
+# GET /items?count=N streams N generated records, at most MAX_ITEMS
+ITEMS_PATH = '/items'
+MAX_ITEMS = 10 * 1000 * 1000
+
+# handlers that would stall the select loop run in one of these pools
+PROCESS_POOL = 'process'
+THREAD_POOL = 'thread'
+
+# what a route handler returns: a complete response, JSON fragments to stream,
+# a complete response computed in a pool, or nothing for the static files
+RESPONSE = 'response'
+STREAM = 'stream'
+OFFLOAD = 'offload'
+STATIC = 'static'
+
+# what serve() times, in seconds: accepting a connection, parsing one read, running one
+# request's handler, compressing one body or chunk and one send of queued output
+PHASES = ('accept', 'parse', 'handler', 'compress', 'send')
+
+# upper bounds of the latency histogram buckets, in seconds, +Inf is implied
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                   0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# access log lines waiting for the writer thread, beyond this they are dropped, not waited for
+ACCESS_LOG_BACKLOG = 10000
+METRICS_PATH = '/metrics'
+
+def get_json(status):
     msg = "Hello world!"
     if status == 404:
         msg =  "404 Not found"
@@ -15,13 +90,217 @@ def get_content(status):
         msg =  "403 Forbidden"
     elif status == 500:
         msg = "500 Internal Server Error"
+    elif status == 400:
+        msg = "400 Bad Request"
+    elif status == 405:
+        msg = "405 Method Not Allowed"
 
     index_html = {
         "status": status,
         "message": msg
     }
     json_data = json.dumps(index_html)
-    return zlib.compress(json_data.encode("utf-8"))
+    return json_data.encode("utf-8")
+
+def get_content(status):
+    return zlib.compress(get_json(status))
+
+def build_response(status, body, content_type='text/html; charset=UTF-8', headers=()):
+    """Build the complete response, header and body, ready for sendall"""
+    header = f'HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: {content_type}\r\n' \
+             f'Content-Length: {len(body)}\r\n'
+    for line in headers:
+        header += line + '\r\n'
+    return (header + '\r\n').encode('utf-8') + body
+
+class ZlibStream:
+    """Incremental zlib/gzip encoder, every piece of output can be decoded on arrival"""
+
+    def __init__(self, level, wbits):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        # a sync flush ends the piece on a byte boundary without resetting the dictionary
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+class IdentityStream:
+    def compress(self, data):
+        return data
+
+    def finish(self):
+        return b''
+
+class Encoder:
+    def __init__(self, name, compress, fast_level, best_level, stream=None):
+        self.name = name
+
+        # compress(data, level) returns the encoded bytes, stream(level) an object
+        # with compress(data) and finish() for bodies that are generated piece by piece
+        self.compress = compress
+        self.stream = stream
+
+        # level policy: responses that are cached are compressed once, so they get
+        # best_level, bodies built for every request get the cheaper fast_level
+        self.fast_level = fast_level
+        self.best_level = best_level
+
+    def encode(self, data, cached=False):
+        return self.compress(data, self.best_level if cached else self.fast_level)
+
+# key: content-coding, value: Encoder, in order of preference when the client's
+# q-values tie
+ENCODERS = OrderedDict()
+
+def register_encoder(name, compress, fast_level=None, best_level=None, stream=None):
+    """Add a content-coding the server can negotiate, or replace one"""
+    ENCODERS[name] = Encoder(name, compress, fast_level, best_level, stream)
+    # negotiation results depend on the registry
+    negotiate.cache_clear()
+
+@lru_cache(maxsize=256)
+def negotiate(accept_encoding):
+    """Return the content-coding to use for an Accept-Encoding value, 'identity' for none"""
+    accepted = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+
+    best, best_quality = 'identity', 0.0
+    for coding in ENCODERS:
+        quality = accepted.get(coding, accepted.get('*', 0.0))
+        # 'x-gzip' is an old alias of gzip
+        if coding == 'gzip':
+            quality = max(quality, accepted.get('x-gzip', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+class BrotliStream:
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+class ZstdStream:
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+register_encoder('gzip', lambda data, level: gzip.compress(data, compresslevel=level, mtime=0), 6, 9,
+                 lambda level: ZlibStream(level, 31))
+register_encoder('deflate', lambda data, level: zlib.compress(data, level), 6, 9,
+                 lambda level: ZlibStream(level, 15))
+if zstandard is not None:
+    register_encoder('zstd', lambda data, level: zstandard.ZstdCompressor(level=level).compress(data), 3, 19,
+                     ZstdStream)
+    ENCODERS.move_to_end('zstd', last=False)
+if brotli is not None:
+    register_encoder('br', lambda data, level: brotli.compress(data, quality=level), 4, 11, BrotliStream)
+    ENCODERS.move_to_end('br', last=False)
+
+def encode_body(data, encoding, cached=False):
+    """Return the body and the extra headers for a negotiated content-coding"""
+    started = time.perf_counter()
+    if encoding == LEGACY_ENCODING:
+        body, headers = zlib.compress(data), ()
+    elif encoding == 'identity' or len(data) < COMPRESS_MIN_SIZE:
+        return data, ('Vary: Accept-Encoding',)
+    else:
+        body, headers = ENCODERS[encoding].encode(data, cached), (f'Content-Encoding: {encoding}', 'Vary: Accept-Encoding')
+    METRICS.observe('compress', time.perf_counter() - started)
+    return body, headers
+
+class ResponseCache:
+    """Fully built responses keyed by (path, status, encoding)"""
+
+    def __init__(self, max_dynamic=1024):
+        # static entries never change unless invalidated, dynamic entries
+        # are bounded and the least recently used one is evicted first
+        self.static = {}
+        self.dynamic = OrderedDict()
+        self.max_dynamic = max_dynamic
+
+        # key: path, value: cache keys of that path, so invalidate does not scan
+        self.paths = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.static) + len(self.dynamic)
+
+    def get(self, key):
+        response = self.static.get(key)
+        if response is None:
+            response = self.dynamic.get(key)
+            if response is not None:
+                self.dynamic.move_to_end(key)
+        if response is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return response
+
+    def put(self, key, response, dynamic=False):
+        if dynamic:
+            self.dynamic[key] = response
+            self.dynamic.move_to_end(key)
+            if len(self.dynamic) > self.max_dynamic:
+                evicted, _ = self.dynamic.popitem(last=False)
+                self.forget(evicted)
+        else:
+            self.static[key] = response
+        self.paths.setdefault(key[0], set()).add(key)
+
+    def get_or_build(self, key, build, dynamic=False):
+        response = self.get(key)
+        if response is None:
+            response = build()
+            self.put(key, response, dynamic)
+        return response
+
+    def forget(self, key):
+        keys = self.paths.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.paths[key[0]]
+
+    def invalidate(self, path=None):
+        """Call when the content behind path changed, without a path everything is dropped"""
+        if path is None:
+            self.static.clear()
+            self.dynamic.clear()
+            self.paths.clear()
+            return
+        for key in self.paths.pop(path, ()):
+            self.static.pop(key, None)
+            self.dynamic.pop(key, None)
+
+# responses of serve(), shared by all connections
+RESPONSES = ResponseCache()
 
 def create_server():
     """Create a server socket and listen for incoming connections"""
@@ -37,56 +316,1546 @@ def get_header(data):
     print('request header:', data.split('\r\n'))
     return data.split('\r\n')[0].split(' ')[1]
 
-def serve():
+class Request:
+    def __init__(self, method, target, version, headers, body=b''):
+        self.method = method
+        self.target = target
+        self.version = version
+
+        # key: lower-case header name, value: header value
+        self.headers = headers
+        self.body = body
+
+    def keep_alive(self):
+        """HTTP/1.1 connections persist unless closed, HTTP/1.0 ones only when asked to"""
+        tokens = [token.strip().lower() for token in self.headers.get('connection', '').split(',')]
+        if self.version == 'HTTP/1.1':
+            return 'close' not in tokens
+        return 'keep-alive' in tokens
+
+def parse_request_head(head):
+    """Parse the request line and header fields, raise ValueError when malformed"""
+    lines = head.split('\r\n')
+    parts = lines[0].split(' ')
+    if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+        raise ValueError(f'bad request line: {lines[0]!r}')
+    headers = {}
+    for line in lines[1:]:
+        name, colon, value = line.partition(':')
+        if not colon or not name or name != name.strip():
+            raise ValueError(f'bad header line: {line!r}')
+        name = name.lower()
+        value = value.strip()
+        # repeated fields are combined, as if sent as one comma separated list
+        headers[name] = f'{headers[name]}, {value}' if name in headers else value
+    return Request(parts[0], parts[1], parts[2], headers)
+
+class RequestParser:
+    """Reassemble the requests of one connection from whatever recv returns"""
+
+    def __init__(self, max_header_size=MAX_HEADER_SIZE, max_body_size=MAX_BODY_SIZE):
+        # bytes of an incomplete request wait here until the rest arrives
+        self.buffer = bytearray()
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.error = None
+
+    def feed(self, data):
+        """Return the requests completed by data, in the order they were sent
+
+        A malformed request sets error, the requests before it are still returned
+        and nothing after it is parsed.
+        """
+        if self.error is not None:
+            return []
+        buffer = self.buffer
+        buffer += data
+
+        requests = []
+        offset = 0
+        try:
+            while True:
+                end = buffer.find(b'\r\n\r\n', offset)
+                if end < 0:
+                    if len(buffer) - offset > self.max_header_size:
+                        raise ValueError(f'request header exceeds {self.max_header_size} bytes')
+                    break
+                if end - offset > self.max_header_size:
+                    raise ValueError(f'request header exceeds {self.max_header_size} bytes')
+                request = parse_request_head(buffer[offset:end].decode('latin-1'))
+
+                if 'transfer-encoding' in request.headers:
+                    raise ValueError('chunked request bodies are not supported')
+                # digits only: int() also takes '1_0', '+5' and spaces, which a proxy
+                # in front may read differently
+                length = request.headers.get('content-length', '0')
+                if not (length.isascii() and length.isdigit()):
+                    raise ValueError('bad Content-Length')
+                length = int(length)
+                if not 0 <= length <= self.max_body_size:
+                    raise ValueError(f'request body of {length} bytes is not accepted')
+
+                start = end + 4
+                if len(buffer) - start < length:
+                    # the head is parsed again once the body is complete
+                    break
+                request.body = bytes(buffer[start:start + length])
+                requests.append(request)
+                offset = start + length
+        except ValueError as error:
+            self.error = error
+            buffer.clear()
+            return requests
+
+        # drop the consumed requests once per read
+        if offset:
+            del buffer[:offset]
+        return requests
+
+def file_identity(st):
+    # a replaced or modified file differs in at least one of these
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+class FileEntry:
+    def __init__(self, path, fd, st, now):
+        self.path = path
+        self.fd = fd
+        self.size = st.st_size
+        self.identity = file_identity(st)
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+        # time of the last stat, the file is trusted to be unchanged for revalidate seconds
+        self.checked = now
+
+        # responses still sending from fd, it is closed once evicted and unused
+        self.users = 0
+        self.evicted = False
+
+class FileCache:
+    """Open descriptors and stat results of the files below root"""
+
+    def __init__(self, root, max_open=256, revalidate=1.0):
+        self.root = os.path.realpath(root)
+        self.max_open = max_open
+        self.revalidate = revalidate
+
+        # key: request path, value: FileEntry, least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, name):
+        """Return the file system path of name, None when it is outside root or invalid"""
+        try:
+            path = os.path.realpath(os.path.join(self.root, name))
+        except (ValueError, OSError):
+            # e.g. an embedded null byte from a percent-encoded %00
+            return None
+        if not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def acquire(self, name, now):
+        """Return the open FileEntry of name, or None when there is no such regular file"""
+        entry = self.entries.get(name)
+        if entry is not None:
+            if now - entry.checked < self.revalidate:
+                self.entries.move_to_end(name)
+                entry.users += 1
+                self.hits += 1
+                return entry
+            # same file and unchanged, one stat instead of open + fstat
+            try:
+                identity = file_identity(os.stat(entry.path))
+            except OSError:
+                identity = None
+            if entry.identity == identity:
+                entry.checked = now
+                self.entries.move_to_end(name)
+                entry.users += 1
+                self.hits += 1
+                return entry
+            self.invalidate(name)
+
+        self.misses += 1
+        path = self.resolve(name)
+        if path is None:
+            return None
+        try:
+            fd = os.open(path, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+        except OSError:
+            return None
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode):
+            # directories and devices are not served
+            os.close(fd)
+            return None
+
+        entry = FileEntry(path, fd, st, now)
+        self.entries[name] = entry
+        if len(self.entries) > self.max_open:
+            _, evicted = self.entries.popitem(last=False)
+            self.evict(evicted)
+        entry.users += 1
+        return entry
+
+    def release(self, entry):
+        entry.users -= 1
+        if entry.evicted and not entry.users:
+            os.close(entry.fd)
+
+    def evict(self, entry):
+        entry.evicted = True
+        if not entry.users:
+            os.close(entry.fd)
+
+    def invalidate(self, name=None):
+        """Call when files changed, without a name every descriptor is dropped"""
+        names = list(self.entries) if name is None else [name]
+        for name in names:
+            entry = self.entries.pop(name, None)
+            if entry is not None:
+                self.evict(entry)
+
+    def close(self):
+        self.invalidate()
+
+class FileSegment:
+    """Part of a cached file, sent with sendfile without copying it through Python"""
+
+    def __init__(self, files, entry, offset, count):
+        self.files = files
+        self.entry = entry
+        self.offset = offset
+        self.remaining = count
+
+    def release(self):
+        if self.entry is not None:
+            self.files.release(self.entry)
+            self.entry = None
+
+class ChunkedBody:
+    """A generated body, encoded and framed only as fast as the socket drains it"""
+
+    def __init__(self, fragments, stream, chunked=True, chunk_size=CHUNK_SIZE):
+        self.fragments = iter(fragments)
+        self.stream = stream
+
+        # HTTP/1.0 clients get the bare body and the end of the connection marks its end
+        self.chunked = chunked
+        self.chunk_size = chunk_size
+
+        # framed bytes not sent yet
+        self.buffer = bytearray()
+        self.finished = False
+
+    def fill(self):
+        """Append the next chunk to buffer, return False when the body is complete"""
+        if self.finished:
+            return False
+        pieces = []
+        size = 0
+        for fragment in self.fragments:
+            pieces.append(fragment)
+            size += len(fragment)
+            if size >= self.chunk_size:
+                break
+        else:
+            self.finished = True
+
+        started = time.perf_counter()
+        data = self.stream.compress(b''.join(pieces)) if pieces else b''
+        if self.finished:
+            data += self.stream.finish()
+        METRICS.observe('compress', time.perf_counter() - started)
+        if data:
+            self.frame(data)
+        if self.finished and self.chunked:
+            self.buffer += b'0\r\n\r\n'
+        return True
+
+    def frame(self, data):
+        if self.chunked:
+            self.buffer += b'%x\r\n' % len(data)
+            self.buffer += data
+            self.buffer += b'\r\n'
+        else:
+            self.buffer += data
+
+    def close(self):
+        close = getattr(self.fragments, 'close', None)
+        if close is not None:
+            close()
+
+class PendingResponse:
+    """Place of a response still computed by a worker, later responses wait behind it"""
+
+    def __init__(self, keep_alive_header=None, head=False):
+        self.keep_alive_header = keep_alive_header
+        self.head = head
+        self.data = None
+
+    def complete(self, response):
+        if self.keep_alive_header is not None:
+            response = add_header(response, self.keep_alive_header)
+        if self.head:
+            response = without_body(response)
+        self.data = bytearray(response)
+
+class WorkerPools:
+    """Thread and process pools whose results are handed back to the select loop
+
+    A worker cannot touch the sockets, it appends its result to completed and
+    writes a byte to a pipe the loop selects on, so the loop wakes up and
+    sends the response itself.
+    """
+
+    def __init__(self, threads=8, processes=None):
+        self.threads = threads
+        self.processes = processes
+        self.executors = {}
+
+        # (token, future) of finished jobs; deque appends are thread safe
+        self.completed = deque()
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        os.set_blocking(self.write_fd, False)
+
+    def fileno(self):
+        return self.read_fd
+
+    def executor(self, kind):
+        # started on first use, a server without heavy routes has no workers
+        executor = self.executors.get(kind)
+        if executor is None:
+            if kind == PROCESS_POOL:
+                executor = ProcessPoolExecutor(self.processes)
+            else:
+                executor = ThreadPoolExecutor(self.threads)
+            self.executors[kind] = executor
+        return executor
+
+    def submit(self, kind, handler, args, token):
+        future = self.executor(kind).submit(handler, *args)
+        future.add_done_callback(lambda future: self.done(token, future))
+
+    def done(self, token, future):
+        # runs in a worker thread or the process pool's management thread
+        self.completed.append((token, future))
+        try:
+            os.write(self.write_fd, b'\0')
+        except BlockingIOError:
+            # the pipe is full, the loop is woken up anyway
+            pass
+
+    def collect(self):
+        """Return the (token, future) of every job finished since the last call"""
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        finished = []
+        while self.completed:
+            finished.append(self.completed.popleft())
+        return finished
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+def report(request, params):
+    """CPU heavy: GET /report?rows=N builds and compresses a large JSON report"""
+    rows = parse_qs(request.target.partition('?')[2]).get('rows', ['20000'])[0]
+    if not (rows.isascii() and rows.isdigit()):
+        return build_response(400, get_content(400))
+    rows = min(int(rows), 1000000)
+    data = json.dumps([{"id": i, "user": f"user{i % 97}", "total": i * 31 % 10007} for i in range(rows)])
+    accept_encoding = request.headers.get('accept-encoding')
+    encoding = LEGACY_ENCODING if accept_encoding is None else negotiate(accept_encoding)
+    body, headers = encode_body(data.encode('utf-8'), encoding, cached=True)
+    if encoding == LEGACY_ENCODING:
+        return build_response(200, body)
+    return build_response(200, body, 'application/json', headers)
+
+def slow(request, params):
+    """Blocking I/O: GET /slow?ms=N waits N milliseconds, like a call to another service"""
+    try:
+        ms = float(parse_qs(request.target.partition('?')[2]).get('ms', ['100'])[0])
+    except ValueError:
+        return build_response(400, get_content(400))
+    # not (ms >= 0) also refuses nan
+    if not ms >= 0:
+        return build_response(400, get_content(400))
+    time.sleep(min(ms, 10000) / 1000)
+    return build_response(200, get_content(200))
+
+def run_handler(handler, request, params):
+    """Call an offloaded handler in the loop, a failure becomes a 500"""
+    try:
+        return handler(request, params)
+    except Exception:
+        return build_response(500, get_content(500))
+
+class Histogram:
+    """Counts of observations per bucket, rendered cumulative as Prometheus expects"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last count is for observations above every bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+class Metrics:
+    """In-process phase histograms and response counters, served on /metrics"""
+
+    def __init__(self, phases=PHASES):
+        self.phases = {phase: Histogram() for phase in phases}
+        self.responses = {}
+        self.dropped = 0
+
+    def observe(self, phase, seconds):
+        self.phases[phase].observe(seconds)
+
+    def count(self, status):
+        self.responses[status] = self.responses.get(status, 0) + 1
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        lines = ['# HELP http_phase_seconds Time spent in each phase of serving requests.',
+                 '# TYPE http_phase_seconds histogram']
+        for phase, histogram in self.phases.items():
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'http_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+            lines.append(f'http_phase_seconds_bucket{{phase="{phase}",le="+Inf"}} {histogram.count}')
+            lines.append(f'http_phase_seconds_sum{{phase="{phase}"}} {histogram.sum:.9f}')
+            lines.append(f'http_phase_seconds_count{{phase="{phase}"}} {histogram.count}')
+        lines += ['# HELP http_responses_total Responses answered, by status code.',
+                  '# TYPE http_responses_total counter']
+        for status in sorted(self.responses):
+            lines.append(f'http_responses_total{{code="{status}"}} {self.responses[status]}')
+        lines += ['# HELP http_access_log_dropped_total Access log lines dropped on a full backlog.',
+                  '# TYPE http_access_log_dropped_total counter',
+                  f'http_access_log_dropped_total {self.dropped}']
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+# serve() times into this one, so GET /metrics can render it
+METRICS = Metrics()
+
+class AccessLog:
+    """Common Log Format access log, formatted and written in batches by a thread
+
+    The select loop only appends a tuple to a deque, it never takes a lock or waits
+    for the stream: when the writer falls behind by backlog lines, new lines are dropped.
+    """
+
+    def __init__(self, stream, backlog=ACCESS_LOG_BACKLOG, interval=0.1, metrics=None):
+        self.stream = stream
+        self.entries = deque()
+        self.backlog = backlog
+        self.interval = interval
+        self.metrics = metrics
+        self.dropped = 0
+        # strftime of the second the last line was logged in
+        self.second = None
+        self.stamp = ''
+        self.closing = threading.Event()
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.writer.start()
+
+    def log(self, address, request, status, size, seconds):
+        if len(self.entries) >= self.backlog:
+            self.dropped += 1
+            if self.metrics is not None:
+                self.metrics.dropped += 1
+            return
+        self.entries.append((time.time(), address, request, status, size, seconds))
+
+    def format(self, logged, address, request, status, size, seconds):
+        second = int(logged)
+        if second != self.second:
+            self.second = second
+            self.stamp = time.strftime('%d/%b/%Y:%H:%M:%S %z', time.localtime(second))
+        host = address[0] if address else '-'
+        return f'{host} - - [{self.stamp}] "{request.method} {request.target} {request.version}" ' \
+               f'{status} {"-" if size is None else size} {seconds * 1000000:.0f}us\n'
+
+    def write(self):
+        # writer thread: wake up every interval and write what was queued in one go
+        while True:
+            closing = self.closing.wait(self.interval)
+            lines = []
+            while self.entries:
+                lines.append(self.format(*self.entries.popleft()))
+            if lines:
+                self.stream.write(''.join(lines))
+                self.stream.flush()
+            if closing:
+                return
+
+    def close(self):
+        """Write out the queued lines and stop the writer thread"""
+        self.closing.set()
+        self.writer.join()
+
+class HttpConnection:
+    def __init__(self, now, address=None):
+        self.parser = RequestParser()
+        self.address = address
+
+        # responses in request order waiting for the socket to accept them,
+        # bytearrays of header and body bytes and FileSegments
+        self.outbound = deque()
+        self.pending = 0
+        self.last_activity = now
+
+        # set once a response said Connection: close, the socket closes when drained
+        self.closing = False
+
+    def queue(self, data):
+        # consecutive responses share one buffer, so they leave in one send
+        if self.outbound and isinstance(self.outbound[-1], bytearray):
+            self.outbound[-1] += data
+        else:
+            self.outbound.append(bytearray(data))
+        self.pending += len(data)
+
+    def queue_body(self, body):
+        self.outbound.append(body)
+
+    def queue_pending(self, pending):
+        self.outbound.append(pending)
+
+    def completed(self, pending):
+        self.pending += len(pending.data)
+
+    def queue_file(self, segment):
+        if segment.remaining:
+            self.outbound.append(segment)
+            self.pending += segment.remaining
+        else:
+            segment.release()
+
+    def send(self, sock):
+        """Send what the socket takes now, return True once everything is sent"""
+        outbound = self.outbound
+        while outbound:
+            item = outbound[0]
+            if isinstance(item, PendingResponse):
+                if item.data is None:
+                    # in order: nothing behind it leaves before it is ready
+                    return True
+                item = outbound[0] = item.data
+            try:
+                if isinstance(item, FileSegment):
+                    sent = os.sendfile(sock.fileno(), item.entry.fd, item.offset, item.remaining)
+                    if not sent:
+                        raise ConnectionError(f'{item.entry.path} shrank while it was sent')
+                    item.offset += sent
+                    item.remaining -= sent
+                    done = not item.remaining
+                elif isinstance(item, ChunkedBody):
+                    if not item.buffer:
+                        try:
+                            more = item.fill()
+                        except Exception as error:
+                            # the status line is gone, cutting the body short is all that is left
+                            raise ConnectionError(f'generating the body failed: {error!r}') from error
+                        if not more:
+                            outbound.popleft()
+                            continue
+                    sent = sock.send(item.buffer)
+                    del item.buffer[:sent]
+                    if not item.buffer:
+                        # produce the next chunk while the socket takes it
+                        continue
+                    return False
+                else:
+                    sent = sock.send(item)
+                    del item[:sent]
+                    done = not item
+            except BlockingIOError:
+                return False
+            self.pending -= sent
+            if not done:
+                # the socket buffer is full
+                return False
+            outbound.popleft()
+            if isinstance(item, FileSegment):
+                item.release()
+        return True
+
+    def discard(self):
+        for item in self.outbound:
+            if isinstance(item, FileSegment):
+                item.release()
+            elif isinstance(item, ChunkedBody):
+                item.close()
+        self.outbound.clear()
+        self.pending = 0
+
+def add_header(response, header):
+    """Insert one header line into a complete response"""
+    head, _, body = response.partition(b'\r\n\r\n')
+    return head + b'\r\n' + header + b'\r\n\r\n' + body
+
+def body_length(response):
+    """Bytes of a complete response after its header, the size the access log records"""
+    return len(response) - response.index(b'\r\n\r\n') - 4
+
+def without_body(response):
+    """The response to a HEAD request: the header of the GET response only"""
+    return response[:response.index(b'\r\n\r\n') + 4]
+
+def handle_request(data, cache=RESPONSES):
+    """Return the complete response for the raw request data"""
+    request = parse_request_head(data.decode('latin-1').partition('\r\n\r\n')[0])
+    return respond(request.target, cache, request.headers.get('accept-encoding'))
+
+def respond(request_file, cache=RESPONSES, accept_encoding=None):
+    """Return the complete response for the requested path"""
+    if request_file == 'index.html' or request_file == '/index.html':
+        path, status = '/index.html', 200
+    else:
+        # every unknown path gets the same 404 body
+        path, status = None, 404
+
+    encoding = LEGACY_ENCODING if accept_encoding is None else negotiate(accept_encoding)
+    key = (path, status, encoding)
+    if cache is None:
+        return build_json_response(status, encoding)
+    return cache.get_or_build(key, lambda: build_json_response(status, encoding, cached=True))
+
+def build_json_response(status, encoding, cached=False):
+    body, headers = encode_body(get_json(status), encoding, cached)
+    if encoding == LEGACY_ENCODING:
+        return build_response(status, body)
+    return build_response(status, body, 'application/json', headers)
+
+def connection_header(request, keep_alive):
+    """Return the Connection header the response needs, None for the HTTP/1.1 default"""
+    if not keep_alive:
+        return b'Connection: close'
+    if request.version != 'HTTP/1.1':
+        return b'Connection: keep-alive'
+    return None
+
+def generate_items(count, batch=1000):
+    """Yield a JSON array of count generated records, batch records per fragment"""
+    yield b'['
+    for start in range(0, count, batch):
+        records = [{"id": i, "name": f"item {i}", "tags": ["generated", "stream"], "score": i * 7 % 1000}
+                   for i in range(start, min(count, start + batch))]
+        fragment = json.dumps(records)[1:-1].encode('utf-8')
+        yield b',' + fragment if start else fragment
+    yield b']'
+
+def respond_stream(request, fragments):
+    """Return the response header, the ChunkedBody and whether the connection stays open
+
+    The body is compressed with the negotiated coding as it is generated, a
+    client without Accept-Encoding gets the legacy zlib body without a
+    Content-Encoding header, as from every other route.
+    """
+    accept_encoding = request.headers.get('accept-encoding')
+    encoder = ENCODERS.get(negotiate(accept_encoding)) if accept_encoding is not None else None
+    if encoder is not None and encoder.stream is not None:
+        stream = encoder.stream(encoder.fast_level)
+    elif accept_encoding is None:
+        encoder, stream = None, ZlibStream(zlib.Z_DEFAULT_COMPRESSION, zlib.MAX_WBITS)
+    else:
+        encoder, stream = None, IdentityStream()
+
+    # chunked transfer coding needs HTTP/1.1, otherwise closing the connection ends the body
+    chunked = request.version == 'HTTP/1.1'
+    keep_alive = chunked and request.keep_alive()
+    lines = [f'HTTP/1.1 200 {REASONS[200]}', 'Content-Type: application/json', 'Vary: Accept-Encoding']
+    if encoder is not None:
+        lines.append(f'Content-Encoding: {encoder.name}')
+    if chunked:
+        lines.append('Transfer-Encoding: chunked')
+    if not keep_alive:
+        lines.append('Connection: close')
+    header = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+    return header, ChunkedBody(fragments, stream, chunked), keep_alive
+
+def items_count(target):
+    """Return the count of GET /items?count=N, None when the value is not usable"""
+    values = parse_qs(target.partition('?')[2]).get('count', ['1000'])
+    try:
+        count = int(values[0])
+    except ValueError:
+        return None
+    return count if 0 <= count <= MAX_ITEMS else None
+
+def parse_range(value, size):
+    """Return the (start, stop) of a single byte range, None to send the whole file
+
+    Raises ValueError when the range cannot be satisfied. Several ranges and
+    malformed values are ignored, the whole file is a valid answer to both.
+    """
+    unit, _, ranges = value.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, dash, last = ranges.strip().partition('-')
+    # isdigit() alone takes digits like '\xb2' that int() refuses
+    if not dash or not (first or last) or not (first + last).isascii():
+        return None
+    if (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+    if not first:
+        # the last bytes of the file
+        if int(last) == 0 or size == 0:
+            raise ValueError('empty suffix range')
+        return max(0, size - int(last)), size
+    start = int(first)
+    stop = size if not last else min(int(last) + 1, size)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError(f'range starts at {start} of {size} bytes')
+    return start, stop
+
+def respond_static(request, files, now, name=None):
+    """Return the response header and the FileSegment of a static file request
+
+    Returns None when there is no such file, the caller answers 404. The
+    segment is None when there is no body to send.
+    """
+    if name is None:
+        name = request.target[len(STATIC_PREFIX):].partition('?')[0]
+    entry = files.acquire(unquote(name), now)
+    if entry is None:
+        return None
+
+    lines = []
+    try:
+        byte_range = parse_range(request.headers['range'], entry.size) if 'range' in request.headers else None
+    except ValueError:
+        lines.append(f'HTTP/1.1 416 {REASONS[416]}')
+        lines.append(f'Content-Range: bytes */{entry.size}')
+        lines.append('Content-Length: 0')
+        files.release(entry)
+        return static_header(request, lines), None
+
+    if byte_range is None:
+        start, stop = 0, entry.size
+        lines.append(f'HTTP/1.1 200 {REASONS[200]}')
+    else:
+        start, stop = byte_range
+        lines.append(f'HTTP/1.1 206 {REASONS[206]}')
+        lines.append(f'Content-Range: bytes {start}-{stop - 1}/{entry.size}')
+    lines.append(f'Content-Type: {entry.content_type}')
+    lines.append(f'Content-Length: {stop - start}')
+    lines.append('Accept-Ranges: bytes')
+
+    if request.method == 'HEAD':
+        files.release(entry)
+        return static_header(request, lines), None
+    return static_header(request, lines), FileSegment(files, entry, start, stop - start)
+
+def static_header(request, lines):
+    header = connection_header(request, request.keep_alive())
+    if header is not None:
+        lines.append(header.decode('latin-1'))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+class RouteNode:
+    def __init__(self):
+        # key: literal path segment, value: RouteNode
+        self.children = {}
+
+        # '{name}' matches any one segment, '{name*}' the rest of the path
+        self.param = None
+        self.param_name = None
+        self.rest_name = None
+        self.rest = None
+
+        # Route of the path ending at this node
+        self.route = None
+
+class Route:
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+        # key: method, value: (handler, kind, pool)
+        self.handlers = {}
+
+        # the Allow header of a 405, kept up to date by add
+        self.allowed = []
+
+    def add(self, method, handler):
+        self.handlers[method] = handler
+        methods = set(self.handlers)
+        if 'GET' in methods:
+            methods.add('HEAD')
+        self.allowed = sorted(methods)
+
+class Router:
+    """Paths without parameters in a dict, the others in a trie of path segments
+
+    Lookup is one dict access for static paths and one dict access per segment
+    for parameterized ones, however many routes are registered.
+    """
+
+    def __init__(self):
+        # key: path, value: Route
+        self.static = {}
+        self.root = RouteNode()
+
+    def add(self, method, pattern, handler, kind=RESPONSE, pool=None):
+        """Register handler for method on pattern, like '/items/{id}' or '/static/{path*}'
+
+        RESPONSE handlers are called as handler(request, params, cache) and return
+        the complete response, STREAM handlers as handler(request, params) and
+        return JSON fragments or None for 400, OFFLOAD handlers like RESPONSE ones
+        without the cache, in pool.
+        """
+        if '{' not in pattern:
+            route = self.static.setdefault(pattern, Route(pattern))
+        else:
+            node = self.root
+            segments = pattern.split('/')[1:]
+            for index, segment in enumerate(segments):
+                if segment.startswith('{') and segment.endswith('*}'):
+                    if index != len(segments) - 1:
+                        raise ValueError(f'{segment} must be the last segment of {pattern}')
+                    if node.rest is None:
+                        node.rest, node.rest_name = RouteNode(), segment[1:-2]
+                    node = node.rest
+                elif segment.startswith('{') and segment.endswith('}'):
+                    if node.param is None:
+                        node.param, node.param_name = RouteNode(), segment[1:-1]
+                    elif node.param_name != segment[1:-1]:
+                        raise ValueError(f'{pattern} names the parameter {node.param_name} differently')
+                    node = node.param
+                else:
+                    node = node.children.setdefault(segment, RouteNode())
+            if node.route is None:
+                node.route = Route(pattern)
+            route = node.route
+        route.add(method, (handler, kind, pool))
+
+    def match(self, method, path):
+        """Return (handler, kind, pool), params and the allowed methods of path
+
+        The handler is None for a path that does not exist, allowed is empty
+        then, and for a method the path does not support (405).
+        """
+        route = self.static.get(path)
+        params = {}
+        if route is None:
+            route = self.search(self.root, path.split('/')[1:], 0, params)
+        if route is None:
+            return None, params, []
+        handler = route.handlers.get(method)
+        if handler is None and method == 'HEAD':
+            handler = route.handlers.get('GET')
+        return handler, params, route.allowed
+
+    def search(self, node, segments, index, params):
+        # literal segments win over '{name}', which wins over '{name*}'
+        if index == len(segments):
+            return node.route
+        segment = segments[index]
+        child = node.children.get(segment)
+        if child is not None:
+            route = self.search(child, segments, index + 1, params)
+            if route is not None:
+                return route
+        if node.param is not None and segment:
+            route = self.search(node.param, segments, index + 1, params)
+            if route is not None:
+                params[node.param_name] = segment
+                return route
+        if node.rest is not None:
+            rest = '/'.join(segments[index:])
+            if rest and node.rest.route is not None:
+                params[node.rest_name] = rest
+                return node.rest.route
+        return None
+
+def index(request, params, cache):
+    return respond('/index.html', cache, request.headers.get('accept-encoding'))
+
+def item(request, params, cache):
+    """GET /items/{id}: one generated record, the responses go to the bounded LRU"""
+    # isdigit() also takes superscripts like '\xb9' that int() refuses
+    if not (params['id'].isascii() and params['id'].isdecimal()):
+        return respond(None, cache, request.headers.get('accept-encoding'))
+    number = int(params['id'])
+    accept_encoding = request.headers.get('accept-encoding')
+    encoding = LEGACY_ENCODING if accept_encoding is None else negotiate(accept_encoding)
+
+    def build():
+        record = {"id": number, "name": f"item {number}", "tags": ["generated", "stream"], "score": number * 7 % 1000}
+        body, headers = encode_body(json.dumps(record).encode('utf-8'), encoding)
+        if encoding == LEGACY_ENCODING:
+            return build_response(200, body)
+        return build_response(200, body, 'application/json', headers)
+
+    if cache is None:
+        return build()
+    return cache.get_or_build((f'/items/{number}', 200, encoding), build, dynamic=True)
+
+def items(request, params):
+    count = items_count(request.target)
+    return None if count is None else generate_items(count)
+
+def metrics(request, params, cache):
+    """GET /metrics: the phase histograms and counters for a Prometheus scraper"""
+    return build_response(200, METRICS.render(), 'text/plain; version=0.0.4; charset=utf-8')
+
+ROUTES = Router()
+# the client asks for 'index.html' without the slash
+ROUTES.add('GET', '/index.html', index)
+ROUTES.add('GET', 'index.html', index)
+ROUTES.add('GET', ITEMS_PATH, items, STREAM)
+ROUTES.add('GET', ITEMS_PATH + '/{id}', item)
+ROUTES.add('GET', '/report', report, OFFLOAD, PROCESS_POOL)
+ROUTES.add('GET', '/slow', slow, OFFLOAD, THREAD_POOL)
+ROUTES.add('GET', STATIC_PREFIX + '{path*}', None, STATIC)
+ROUTES.add('GET', METRICS_PATH, metrics)
+
+def serve(cache=RESPONSES, idle_timeout=IDLE_TIMEOUT, static_root=None, offload=True, router=ROUTES,
+          instrument=True, access_log=True):
     """Start the server and process incoming requests"""
 
     # Create the server socket
     server_socket = create_server()
+    files = FileCache(static_root) if static_root is not None else None
     input_socket = [server_socket]
+    output_socket = []
+
+    # offload=False runs the handlers routed with OFFLOAD in the loop, for comparison
+    pools = WorkerPools() if offload else None
+    if pools is not None:
+        input_socket.append(pools)
+
+    # instrument=False and access_log=False leave the loop untimed and unlogged, for comparison
+    timing = METRICS if instrument else None
+    log = AccessLog(sys.stdout, metrics=timing) if access_log else None
+
+    # key: client socket, value: HttpConnection
+    connections = {}
+
+    def close(sock):
+        for sockets in (input_socket, output_socket):
+            if sock in sockets:
+                sockets.remove(sock)
+        connection = connections.pop(sock, None)
+        if connection is not None:
+            connection.discard()
+        sock.close()
+
+    def flush(sock, connection):
+        # send what the socket takes now, the rest waits for writability
+        started = time.perf_counter()
+        try:
+            drained = connection.send(sock)
+        except OSError:
+            close(sock)
+            return
+        if timing is not None:
+            timing.observe('send', time.perf_counter() - started)
+
+        if not drained:
+            if sock not in output_socket:
+                output_socket.append(sock)
+            # stop reading a client that pipelines faster than it reads
+            if connection.pending > OUTBOUND_LIMIT and sock in input_socket:
+                input_socket.remove(sock)
+            return
+        if sock in output_socket:
+            output_socket.remove(sock)
+        if connection.outbound:
+            # a worker is still busy, its completion flushes again
+            return
+        if connection.closing:
+            close(sock)
+        elif sock not in input_socket:
+            input_socket.append(sock)
+
+    def not_found(request):
+        return respond(None, cache, request.headers.get('accept-encoding'))
+
+    def answered(connection, request, header, size, started):
+        # count and log a response, size is its body length, None when it is streamed
+        if timing is None and log is None:
+            return
+        status = int(header[9:12])
+        if timing is not None:
+            timing.count(status)
+        if log is not None:
+            log.log(connection.address, request, status, size, time.perf_counter() - started)
+
+    def queue_response(connection, request, response, started):
+        keep_alive = request.keep_alive()
+        header = connection_header(request, keep_alive)
+        if header is not None:
+            response = add_header(response, header)
+        if request.method == 'HEAD':
+            response = without_body(response)
+        connection.queue(response)
+        answered(connection, request, response, body_length(response), started)
+        return keep_alive
+
+    def dispatch(sock, connection, request, now, started):
+        # queue the response to request, return whether the connection stays open
+        handler, params, allowed = router.match(request.method, request.target.partition('?')[0])
+        if handler is None:
+            if not allowed:
+                return queue_response(connection, request, not_found(request), started)
+            response = build_response(405, get_content(405), headers=(f'Allow: {", ".join(allowed)}',))
+            return queue_response(connection, request, response, started)
+        handler, kind, pool = handler
+
+        if kind == STATIC:
+            static = respond_static(request, files, now, params['path']) if files is not None else None
+            if static is None:
+                return queue_response(connection, request, not_found(request), started)
+            header, segment = static
+            connection.queue(header)
+            if segment is not None:
+                connection.queue_file(segment)
+            answered(connection, request, header, segment.remaining if segment is not None else 0, started)
+            return request.keep_alive()
+
+        if kind == STREAM:
+            try:
+                fragments = handler(request, params)
+            except Exception:
+                return queue_response(connection, request, build_response(500, get_content(500)), started)
+            if fragments is None:
+                response = add_header(build_response(400, get_content(400)), b'Connection: close')
+                connection.queue(response)
+                answered(connection, request, response, body_length(response), started)
+                return False
+            header, body, keep_alive = respond_stream(request, fragments)
+            connection.queue(header)
+            if request.method == 'HEAD':
+                body.close()
+            else:
+                connection.queue_body(body)
+            answered(connection, request, header, None, started)
+            return keep_alive
+
+        if kind == OFFLOAD:
+            keep_alive = request.keep_alive()
+            pending = PendingResponse(connection_header(request, keep_alive), request.method == 'HEAD')
+            connection.queue_pending(pending)
+            if pools is not None:
+                pools.submit(pool, handler, (request, params), (sock, pending, request, started))
+            else:
+                pending.complete(run_handler(handler, request, params))
+                connection.completed(pending)
+                answered(connection, request, pending.data, body_length(pending.data), started)
+            return keep_alive
+
+        # a failing handler answers 500 instead of leaving the event loop
+        try:
+            response = handler(request, params, cache)
+        except Exception:
+            response = build_response(500, get_content(500))
+        return queue_response(connection, request, response, started)
 
     try:
         while True:
-            read_ready, _, _ = select.select(input_socket, [], [])
-            
+            # wake up now and then to close idle keep-alive connections
+            read_ready, write_ready, _ = select.select(input_socket, output_socket, [], min(idle_timeout, 1.0))
+            now = time.monotonic()
+
             for sock in read_ready:
                 if sock == server_socket:
+                    started = time.perf_counter()
                     client_socket, client_address = server_socket.accept()
-                    input_socket.append(client_socket)       
-
-                else:                
-                    # receive data from client, break when null received          
-                    data = sock.recv(4096)
-                    print('data:', data)
-                    
-                    if data:
-                        request_file = get_header(data)
-                        response_header = b''
-                        response_data = b''
-                        
-                        if request_file == 'index.html' or request_file == '/index.html':
-                            response_data = get_content(200)
-                            
-                            content_length = len(response_data)
-                            response_header = 'HTTP/1.1 200 OK\r\nContent-Type: text/html; charset=UTF-8\r\nContent-Length: ' \
-                                            + str(content_length) + '\r\n\r\n'
-
-                            sock.sendall(response_header.encode('utf-8') + response_data.encode('utf-8'))
+                    client_socket.setblocking(False)
+                    input_socket.append(client_socket)
+                    connections[client_socket] = HttpConnection(now, client_address)
+                    if timing is not None:
+                        timing.observe('accept', time.perf_counter() - started)
 
+                elif sock is pools:
+                    for (client_socket, pending, request, started), future in pools.collect():
+                        if future.exception() is not None:
+                            pending.complete(build_response(500, get_content(500)))
                         else:
-                            response_data = get_content(404)
-                            
-                            content_length = len(response_data)
-                            response_header(b'HTTP/1.1 404 Not found\r\nContent-Type: text/html; charset=UTF-8\r\nContent-Length: ' \
-                                            + str(content_length) + '\r\n\r\n')
-                            sock.sendall(response_header.encode('utf-8') + response_data.encode('utf-8'))
-                    else:
+                            pending.complete(future.result())
+                        # the client may have gone in the meantime
+                        connection = connections.get(client_socket)
+                        if connection is not None:
+                            connection.completed(pending)
+                            answered(connection, request, pending.data, body_length(pending.data), started)
+                            flush(client_socket, connection)
+
+                else:
+                    # a pool answer earlier in this pass may have closed it
+                    connection = connections.get(sock)
+                    if connection is None:
+                        continue
+                    # receive data from client, break when null received
+                    try:
+                        data = sock.recv(65536)
+                    except BlockingIOError:
+                        continue
+                    except OSError:
+                        data = b''
+
+                    if not data:
+                        close(sock)
+                        continue
+
+                    connection.last_activity = now
+
+                    started = time.perf_counter()
+                    requests = connection.parser.feed(data)
+                    if timing is not None:
+                        timing.observe('parse', time.perf_counter() - started)
+
+                    # pipelined requests are answered in order, in one send
+                    for request in requests:
+                        started = time.perf_counter()
+                        keep_alive = dispatch(sock, connection, request, now, started)
+                        if timing is not None:
+                            timing.observe('handler', time.perf_counter() - started)
+                        if not keep_alive:
+                            connection.closing = True
+                            break
+
+                    # answer what was complete before a malformed request, then give up
+                    if connection.parser.error is not None and not connection.closing:
+                        connection.queue(add_header(build_response(400, get_content(400)), b'Connection: close'))
+                        connection.closing = True
+
+                    if connection.closing and sock in input_socket:
                         input_socket.remove(sock)
-                        sock.close()
+                    flush(sock, connection)
 
+            for sock in write_ready:
+                if sock in connections:
+                    flush(sock, connections[sock])
 
-    except KeyboardInterrupt:        
+            # a connection with output pending is not idle, its client is just slow
+            for sock, connection in list(connections.items()):
+                if not connection.outbound and now - connection.last_activity > idle_timeout:
+                    close(sock)
+
+    except KeyboardInterrupt:
+        for sock in list(connections):
+            close(sock)
+        if files is not None:
+            files.close()
+        if pools is not None:
+            pools.shutdown()
+        if log is not None:
+            log.close()
         server_socket.close()
 
+def run_server(cache, **options):
+    # benchmark child, the request logging goes nowhere
+    sys.stdout = NullWriter()
+    serve(cache, **options)
+
+def connect_when_ready(address=('localhost', 8080), timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return socket.create_connection(address)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+def read_response(sock, buffer=b''):
+    """Read one Content-Length framed response, return it and the bytes read past it"""
+    while b'\r\n\r\n' not in buffer:
+        data = sock.recv(65536)
+        if not data:
+            raise ConnectionError('connection closed before the response header')
+        buffer += data
+    header, _, rest = buffer.partition(b'\r\n\r\n')
+    length = 0
+    for line in header.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            length = int(value)
+    while len(rest) < length:
+        data = sock.recv(65536)
+        if not data:
+            raise ConnectionError('connection closed before the end of the body')
+        rest += data
+    return header + b'\r\n\r\n' + rest[:length], rest[length:]
+
+def benchmark_response_cache(count=200000, requests=20000):
+    import contextlib
+    import multiprocessing
+
+    request = b"GET /index.html HTTP/1.1\r\nHost: localhost\r\n\r\n"
+    print(f'GET /index.html, {count} requests in process, {requests} over one localhost connection')
+    print(f'{"":>10} {"in process req/s":>17} {"localhost req/s":>16}')
+    for name, cache in (('no cache', None), ('cache', ResponseCache())):
+        # handle_request alone: parsing, json.dumps + zlib.compress or a cache hit
+        with contextlib.redirect_stdout(NullWriter()):
+            started = time.perf_counter()
+            for _ in range(count):
+                handle_request(request, cache)
+            in_process = count / (time.perf_counter() - started)
+
+        # the whole path through serve(), one request in flight at a time
+        server = multiprocessing.Process(target=run_server, args=(cache,), daemon=True)
+        server.start()
+        client_socket = connect_when_ready()
+        buffer = b''
+        started = time.perf_counter()
+        for _ in range(requests):
+            client_socket.sendall(request)
+            _, buffer = read_response(client_socket, buffer)
+        over_socket = requests / (time.perf_counter() - started)
+        client_socket.close()
+        server.terminate()
+        server.join()
+        print(f'{name:>10} {in_process:>17.0f} {over_socket:>16.0f}')
+
+def benchmark_keep_alive(requests=10000, depth=16):
+    import multiprocessing
+
+    request = b"GET /index.html HTTP/1.1\r\nHost: localhost\r\n\r\n"
+    closing = b"GET /index.html HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n"
+    server = multiprocessing.Process(target=run_server, args=(RESPONSES,), daemon=True)
+    server.start()
+    connect_when_ready().close()
+    print(f'GET /index.html x {requests} from one local client')
+    print(f'{"":>24} {"req/s":>8}')
+
+    # a new connection for every request, the server closes it after the response
+    started = time.perf_counter()
+    for _ in range(requests):
+        client_socket = socket.create_connection(('localhost', 8080))
+        client_socket.sendall(closing)
+        while client_socket.recv(65536):
+            pass
+        client_socket.close()
+    print(f'{"connection per request":>24} {requests / (time.perf_counter() - started):>8.0f}')
+
+    # one connection, one request in flight
+    client_socket = socket.create_connection(('localhost', 8080))
+    buffer = b''
+    started = time.perf_counter()
+    for _ in range(requests):
+        client_socket.sendall(request)
+        _, buffer = read_response(client_socket, buffer)
+    print(f'{"keep-alive":>24} {requests / (time.perf_counter() - started):>8.0f}')
+
+    # one connection, depth requests written before reading their responses
+    started = time.perf_counter()
+    for _ in range(requests // depth):
+        client_socket.sendall(request * depth)
+        for _ in range(depth):
+            _, buffer = read_response(client_socket, buffer)
+    print(f'{f"pipelined, depth {depth}":>24} {requests // depth * depth / (time.perf_counter() - started):>8.0f}')
+    client_socket.close()
+    server.terminate()
+    server.join()
+
+def drain_socket(listener, total):
+    # benchmark child: read and discard total bytes, then answer with one byte
+    sock, _ = listener.accept()
+    buffer = bytearray(1024 * 1024)
+    received = 0
+    while received < total:
+        received += sock.recv_into(buffer)
+    sock.sendall(b'x')
+    sock.close()
+
+def benchmark_sendfile(sizes=((1024, 20000), (1024 * 1024, 500), (100 * 1024 * 1024, 5))):
+    import multiprocessing
+    import tempfile
+
+    def read_sendall(sock, path, size):
+        # what a server without sendfile does for every request
+        with open(path, 'rb') as file:
+            os.fstat(file.fileno())
+            sock.sendall(file.read())
+
+    def cached_sendfile(sock, path, size):
+        entry = files.acquire(os.path.basename(path), time.monotonic())
+        offset = 0
+        while offset < entry.size:
+            offset += os.sendfile(sock.fileno(), entry.fd, offset, entry.size - offset)
+        files.release(entry)
+
+    print(f'{"file":>8} {"requests":>9} {"method":>14} {"MB/s":>8} {"CPU us/req":>11}')
+    with tempfile.TemporaryDirectory() as root:
+        files = FileCache(root)
+        for size, requests in sizes:
+            path = os.path.join(root, f'{size}.bin')
+            with open(path, 'wb') as file:
+                file.write(os.urandom(min(size, 1024 * 1024)) * max(1, size // (1024 * 1024)))
+
+            for name, send in (('read+sendall', read_sendall), ('sendfile', cached_sendfile)):
+                listener = socket.create_server(('localhost', 0))
+                drain = multiprocessing.Process(target=drain_socket, args=(listener, size * requests))
+                drain.start()
+                sock = socket.create_connection(listener.getsockname())
+                listener.close()
+
+                started, cpu = time.perf_counter(), time.process_time()
+                for _ in range(requests):
+                    send(sock, path, size)
+                sock.recv(1)
+                elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu
+                sock.close()
+                drain.join()
+                label = f'{size // 1024} KB' if size < 1024 * 1024 else f'{size // (1024 * 1024)} MB'
+                print(f'{label:>8} {requests:>9} {name:>14} {size * requests / elapsed / 1e6:>8.0f} '
+                      f'{cpu / requests * 1e6:>11.1f}')
+            os.remove(path)
+        files.close()
+
+def benchmark_encoders(repeat=0.5):
+    payloads = {
+        'status': get_json(200),
+        'object': json.dumps({f'field{i}': {'id': i, 'name': f'item {i}', 'tags': ['a', 'b'], 'price': i * 1.5}
+                              for i in range(20)}).encode('utf-8'),
+        'list 100 KB': json.dumps([{'id': i, 'user': f'user{i % 97}', 'active': i % 3 == 0, 'score': i * 7 % 1000}
+                                   for i in range(1600)]).encode('utf-8'),
+        'list 1 MB': json.dumps([{'id': i, 'user': f'user{i % 97}', 'active': i % 3 == 0, 'score': i * 7 % 1000}
+                                 for i in range(16000)]).encode('utf-8'),
+    }
+    print(f'{"payload":>12} {"bytes":>8} {"encoding":>9} {"level":>6} {"on wire":>8} {"ratio":>6} {"CPU us/req":>11}')
+    for name, data in payloads.items():
+        skipped = ' (under COMPRESS_MIN_SIZE, sent as is)' if len(data) < COMPRESS_MIN_SIZE else ''
+        print(f'{name:>12} {len(data):>8} {"identity":>9} {"":>6} {len(data):>8} {1:>6.2f} {0:>11.1f}{skipped}')
+        for encoder in ENCODERS.values():
+            for level in dict.fromkeys((encoder.fast_level, encoder.best_level)):
+                # repeat for at least repeat seconds of CPU
+                count, cpu = 0, 0.0
+                started = time.process_time()
+                while cpu < repeat:
+                    body = encoder.compress(data, level)
+                    count += 1
+                    cpu = time.process_time() - started
+                print(f'{"":>12} {"":>8} {encoder.name:>9} {level:>6} {len(body):>8} '
+                      f'{len(data) / len(body):>6.2f} {cpu / count * 1e6:>11.1f}')
+
+def peak_rss(pid):
+    # VmHWM: the highest resident set size of the process so far
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def cpu_seconds(pid):
+    # utime + stime of the process, in clock ticks
+    with open(f'/proc/{pid}/stat') as stat_file:
+        fields = stat_file.read().rpartition(')')[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def build_items_in_memory(count, result):
+    # what get_content does: the whole JSON, then the whole compressed blob
+    import resource
+
+    started = time.perf_counter()
+    body = b''.join(generate_items(count))
+    compressed = gzip.compress(body, compresslevel=6)
+    ready = time.perf_counter() - started
+    result.send((ready, len(body), len(compressed), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024))
+
+def benchmark_streaming(size=500 * 1024 * 1024):
+    import multiprocessing
+
+    count = size // (len(b''.join(generate_items(1000))) // 1000)
+    print(f'GET /items?count={count}, about {size // (1024 * 1024)} MB of JSON, gzip')
+    print(f'{"":>10} {"first byte s":>13} {"total s":>8} {"on wire MB":>11} {"peak RSS MB":>12}')
+
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    builder = multiprocessing.Process(target=build_items_in_memory, args=(count, sender))
+    builder.start()
+    ready, _, compressed, rss = receiver.recv()
+    builder.join()
+    # nothing can be sent before the blob is complete
+    print(f'{"buffered":>10} {ready:>13.3f} {ready:>8.1f} {compressed / 1e6:>11.1f} {rss / 1e6:>12.0f}')
+
+    server = multiprocessing.Process(target=run_server, args=(RESPONSES,), daemon=True)
+    server.start()
+    client_socket = connect_when_ready()
+    buffer = bytearray(1024 * 1024)
+    started = time.perf_counter()
+    client_socket.sendall(f'GET /items?count={count} HTTP/1.1\r\nAccept-Encoding: gzip\r\n'
+                          f'Connection: close\r\n\r\n'.encode('latin-1'))
+    received = client_socket.recv_into(buffer)
+    first_byte = time.perf_counter() - started
+    while True:
+        read = client_socket.recv_into(buffer)
+        if not read:
+            break
+        received += read
+    total = time.perf_counter() - started
+    client_socket.close()
+    rss = peak_rss(server.pid)
+    server.terminate()
+    server.join()
+    print(f'{"streamed":>10} {first_byte:>13.3f} {total:>8.1f} {received / 1e6:>11.1f} {rss / 1e6:>12.0f}')
+
+def hammer(request, clients, stop):
+    # benchmark child: clients threads sending request back to back
+    import threading
+
+    def client():
+        client_socket = connect_when_ready()
+        buffer = b''
+        while not stop.is_set():
+            client_socket.sendall(request)
+            _, buffer = read_response(client_socket, buffer)
+        client_socket.close()
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def benchmark_offload(requests=300, clients=2):
+    import multiprocessing
+    import signal
+
+    cheap = b"GET /index.html HTTP/1.1\r\nHost: localhost\r\n\r\n"
+    heavy_routes = (('/report?rows=5000', 'process pool'), ('/slow?ms=20', 'thread pool'))
+    print(f'p99 of GET /index.html while {clients} clients request a heavy route back to back')
+    print(f'{"heavy route":>20} {"handler runs in":>16} {"p50 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+    for route, pool in heavy_routes:
+        heavy = f'GET {route} HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: gzip\r\n\r\n'.encode('latin-1')
+        for offload in (False, True):
+            # not a daemon, the server starts its own process pool
+            server = multiprocessing.Process(target=run_server, args=(RESPONSES,), kwargs={'offload': offload})
+            server.start()
+            client_socket = connect_when_ready()
+            stop = multiprocessing.Event()
+            load = multiprocessing.Process(target=hammer, args=(heavy, clients, stop))
+            load.start()
+            time.sleep(0.5)
+
+            latencies = []
+            buffer = b''
+            for _ in range(requests):
+                started = time.perf_counter()
+                client_socket.sendall(cheap)
+                _, buffer = read_response(client_socket, buffer)
+                latencies.append(time.perf_counter() - started)
+            stop.set()
+            load.join()
+            client_socket.close()
+            # KeyboardInterrupt in serve() shuts the pools down
+            os.kill(server.pid, signal.SIGINT)
+            server.join()
+
+            latencies.sort()
+            p50, p99 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+            print(f'{route:>20} {pool if offload else "select loop":>16} {p50 * 1e3:>8.2f} {p99 * 1e3:>8.2f} '
+                  f'{latencies[-1] * 1e3:>8.2f}')
+
+def benchmark_routing(sizes=(10, 100, 1000), lookups=200000):
+    import re
+
+    print(f'{"routes":>7} {"lookup":>10} {"router ns":>10} {"regex list ns":>14}')
+    for size in sizes:
+        router = Router()
+        patterns = []
+        # half static paths, half with a parameter, like a REST API
+        for i in range(size // 2):
+            router.add('GET', f'/api/v1/resource{i}', 'list')
+            router.add('GET', f'/api/v1/resource{i}/{{id}}', 'show')
+            patterns.append((re.compile(f'/api/v1/resource{i}$'), 'list'))
+            patterns.append((re.compile(f'/api/v1/resource{i}/([^/]+)$'), 'show'))
+
+        def scan(path):
+            # what a chain of comparisons does: try every route in turn
+            for pattern, handler in patterns:
+                match = pattern.match(path)
+                if match:
+                    return handler, match.groups()
+            return None
+
+        last = size // 2 - 1
+        for name, path in (('static', f'/api/v1/resource{last}'), ('param', f'/api/v1/resource{last}/123'),
+                           ('miss', '/api/v2/nothing')):
+            timings = []
+            # the scan gets slower with every route, fewer rounds keep the run short
+            for lookup, count in ((lambda: router.match('GET', path), lookups),
+                                  (lambda: scan(path), max(1000, lookups * 10 // size))):
+                started = time.perf_counter()
+                for _ in range(count):
+                    lookup()
+                timings.append((time.perf_counter() - started) / count * 1e9)
+            print(f'{size:>7} {name:>10} {timings[0]:>10.0f} {timings[1]:>14.0f}')
+
+def benchmark_instrumentation(observations=200000, requests=20000, runs=3):
+    import multiprocessing
+    import signal
+
+    # what one timed phase and one access log line cost the loop
+    metrics = Metrics()
+    started = time.perf_counter()
+    for _ in range(observations):
+        begun = time.perf_counter()
+        metrics.observe('handler', time.perf_counter() - begun)
+    observe = (time.perf_counter() - started) / observations
+    log = AccessLog(NullWriter(), backlog=observations)
+    request = Request('GET', '/index.html', 'HTTP/1.1', {}, b'')
+    started = time.perf_counter()
+    for _ in range(observations):
+        log.log(('127.0.0.1', 12345), request, 200, 127, 0.0001)
+    logged = (time.perf_counter() - started) / observations
+    log.close()
+    print(f'timing one phase {observe * 1e9:.0f} ns, queueing one access log line {logged * 1e9:.0f} ns')
+
+    # keep-alive GET /index.html, the cheapest request, so the overhead shows the most
+    keep_alive = b"GET /index.html HTTP/1.1\r\nHost: localhost\r\n\r\n"
+    print(f'GET /index.html x {requests} on one keep-alive connection, best of {runs}')
+    print(f'{"":>24} {"req/s":>8} {"server CPU us/req":>18}')
+    for name, options in (('uninstrumented', {'instrument': False, 'access_log': False}),
+                          ('histograms', {'instrument': True, 'access_log': False}),
+                          ('histograms + log', {'instrument': True, 'access_log': True})):
+        server = multiprocessing.Process(target=run_server, args=(RESPONSES,), kwargs=options)
+        server.start()
+        client_socket = connect_when_ready()
+        buffer = b''
+        best = 0
+        cpu = float('inf')
+        for _ in range(runs):
+            cpu_started = cpu_seconds(server.pid)
+            started = time.perf_counter()
+            for _ in range(requests):
+                client_socket.sendall(keep_alive)
+                _, buffer = read_response(client_socket, buffer)
+            best = max(best, requests / (time.perf_counter() - started))
+            cpu = min(cpu, (cpu_seconds(server.pid) - cpu_started) / requests)
+        print(f'{name:>24} {best:>8.0f} {cpu * 1e6:>18.1f}')
+        if options['instrument']:
+            client_socket.sendall(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            exposition, buffer = read_response(client_socket, buffer)
+            means = {}
+            for line in exposition.decode().splitlines():
+                if line.startswith(('http_phase_seconds_sum', 'http_phase_seconds_count')):
+                    key, value = line.rsplit(' ', 1)
+                    means.setdefault(key.split('"')[1], []).append(float(value))
+            print(f'{"":>24} mean ' + ', '.join(f'{phase} {total / count * 1e6:.1f} us'
+                                              for phase, (total, count) in means.items() if count))
+        client_socket.close()
+        os.kill(server.pid, signal.SIGINT)
+        server.join()
+
 # A 'null' stream that discards anything written to it
 class NullWriter(StringIO):
     def write(self, txt):
@@ -120,6 +1889,380 @@ class TestHttpServer(unittest.TestCase):
         content = get_content(500)
         assert_in('500 Internal Server Error', zlib.decompress(content).decode('utf-8'))
 
+    def test_handle_request_cached(self):
+        print('Testing handle_request with the response cache ...')
+        cache = ResponseCache()
+        request = b"GET /index.html HTTP/1.1\r\nHost: localhost\r\n\r\n"
+        with patch(f'{__name__}.get_json', wraps=get_json) as mock_get_json:
+            first = handle_request(request, cache)
+            second = handle_request(request, cache)
+            handle_request(b"GET index.html HTTP/1.1\r\n\r\n", cache)
+        mock_get_json.assert_called_once_with(200)
+        self.assertIs(first, second)
+        self.assertEqual(cache.hits, 2)
+
+        header, _, body = first.partition(b'\r\n\r\n')
+        self.assertIn(b'HTTP/1.1 200 OK', header)
+        self.assertIn(f'Content-Length: {len(body)}'.encode('utf-8'), header)
+        self.assertIn('Hello world!', zlib.decompress(body).decode('utf-8'))
+
+        not_found = handle_request(b"GET /nonexistent.html HTTP/1.1\r\n\r\n", cache)
+        self.assertIn(b'HTTP/1.1 404 Not found', not_found)
+        print()
+
+    def test_response_cache_lru_and_invalidate(self):
+        print('Testing response cache eviction and invalidation ...')
+        cache = ResponseCache(max_dynamic=2)
+        cache.put(('/index.html', 200, 'zlib'), b'index')
+        cache.put(('/a', 200, 'zlib'), b'a', dynamic=True)
+        cache.put(('/b', 200, 'zlib'), b'b', dynamic=True)
+        cache.get(('/a', 200, 'zlib'))
+        cache.put(('/c', 200, 'zlib'), b'c', dynamic=True)
+
+        # '/b' was the least recently used dynamic entry, static entries stay
+        self.assertEqual(cache.get(('/b', 200, 'zlib')), None)
+        self.assertEqual(cache.get(('/a', 200, 'zlib')), b'a')
+        self.assertEqual(cache.get(('/index.html', 200, 'zlib')), b'index')
+
+        cache.invalidate('/index.html')
+        self.assertEqual(cache.get(('/index.html', 200, 'zlib')), None)
+        self.assertEqual(len(cache), 2)
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+        print()
+
+    def test_request_parser_split_and_pipelined(self):
+        print('Testing request reassembly and pipelining ...')
+        parser = RequestParser()
+        self.assertEqual(parser.feed(b"GET /index.html HTTP/1.1\r\nHo"), [])
+
+        # the rest of the first request, a second one and half of a third in one read
+        requests = parser.feed(b"st: localhost\r\n\r\nGET /a HTTP/1.1\r\nConnection: close\r\n\r\n"
+                               b"POST /b HTTP/1.0\r\nConnection: Keep-Alive\r\nContent-Length: 3\r\n\r\nab")
+        self.assertEqual([request.target for request in requests], ['/index.html', '/a'])
+        self.assertEqual(requests[0].headers, {'host': 'localhost'})
+        self.assertEqual([request.keep_alive() for request in requests], [True, False])
+
+        (request,) = parser.feed(b"c")
+        self.assertEqual((request.method, request.body, request.keep_alive()), ('POST', b'abc', True))
+        self.assertEqual(Request('GET', '/', 'HTTP/1.0', {}).keep_alive(), False)
+
+        # requests before a malformed one are still answered
+        requests = parser.feed(b"GET /x HTTP/1.1\r\n\r\nNONSENSE\r\n\r\nGET /y HTTP/1.1\r\n\r\n")
+        self.assertEqual([request.target for request in requests], ['/x'])
+        self.assertIsInstance(parser.error, ValueError)
+
+        # a Content-Length int() would take but a strict parser would not
+        for value in (b'1_0', b'+5', b'-0', b'\xb2'):
+            parser = RequestParser()
+            self.assertEqual(parser.feed(b"POST / HTTP/1.1\r\nContent-Length: " + value + b"\r\n\r\n0123456789"), [])
+            self.assertIsInstance(parser.error, ValueError)
+        print()
+
+    @patch('select.select')
+    @patch('socket.socket')
+    def test_serve_keep_alive_pipelined(self, mock_socket, mock_select):
+        print('Testing pipelined requests on one connection ...')
+        mock_server_socket = MagicMock()
+        mock_client_socket = MagicMock()
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.return_value = (mock_client_socket, ('127.0.0.1', 12345))
+        mock_select.side_effect = [([mock_server_socket], [], []), ([mock_client_socket], [], []), KeyboardInterrupt]
+        mock_client_socket.recv.return_value = (b"GET /index.html HTTP/1.1\r\n\r\n"
+                                                b"GET /missing HTTP/1.1\r\nConnection: close\r\n\r\n")
+        # the outbound buffer is cleared after the send, keep a copy
+        sent = []
+        mock_client_socket.send.side_effect = lambda data: sent.append(bytes(data)) or len(data)
+
+        with patch('sys.stdout', new=NullWriter()):
+            serve(ResponseCache())
+
+        # both responses, in order, in a single send, then the connection is closed
+        expected = respond('/index.html') + add_header(respond('/missing'), b'Connection: close')
+        self.assertEqual(sent, [expected])
+        mock_client_socket.close.assert_called_once()
+        print(f"send called with: {sent}")
+        print()
+
+    def test_parse_range(self):
+        print('Testing parse_range ...')
+        self.assertEqual(parse_range('bytes=0-499', 1000), (0, 500))
+        self.assertEqual(parse_range('bytes=500-', 1000), (500, 1000))
+        self.assertEqual(parse_range('bytes=-200', 1000), (800, 1000))
+        self.assertEqual(parse_range('bytes=900-2000', 1000), (900, 1000))
+
+        # ignored: the whole file is sent
+        self.assertEqual(parse_range('bytes=0-1,5-9', 1000), None)
+        self.assertEqual(parse_range('bytes=9-1', 1000), None)
+        self.assertEqual(parse_range('lines=1-2', 1000), None)
+        self.assertIsNone(parse_range('bytes=\xb2-', 1000))
+        self.assertIsNone(parse_range('bytes=-\xb2', 1000))
+        with self.assertRaises(ValueError):
+            parse_range('bytes=1000-', 1000)
+        print()
+
+    def test_static_file_range_and_cache(self):
+        print('Testing static files with sendfile ...')
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, 'data.txt'), 'wb') as file:
+                file.write(b'0123456789')
+            files = FileCache(root)
+
+            request = Request('GET', '/static/data.txt', 'HTTP/1.1', {'range': 'bytes=2-5'})
+            header, segment = respond_static(request, files, now=100.0)
+            self.assertIn(b'HTTP/1.1 206 Partial Content', header)
+            self.assertIn(b'Content-Range: bytes 2-5/10', header)
+            self.assertIn(b'Content-Type: text/plain', header)
+
+            # header and file leave through one connection, the file via sendfile
+            connection = HttpConnection(100.0)
+            connection.queue(header)
+            connection.queue_file(segment)
+            server_end, client_end = socket.socketpair()
+            with server_end, client_end:
+                self.assertTrue(connection.send(server_end), 'drained')
+                server_end.close()
+                received = b''.join(iter(lambda: client_end.recv(65536), b''))
+            self.assertTrue(received.endswith(b'\r\n\r\n2345'), 'body')
+            self.assertEqual(files.entries['data.txt'].users, 0)
+
+            # within the revalidation interval there is no syscall at all
+            with patch('os.open') as mock_open, patch('os.stat') as mock_stat:
+                _, segment = respond_static(request, files, now=100.5)
+                segment.release()
+            mock_open.assert_not_called()
+            mock_stat.assert_not_called()
+
+            # a changed file is noticed once the interval passed
+            with open(os.path.join(root, 'data.txt'), 'ab') as file:
+                file.write(b'abc')
+            header, segment = respond_static(Request('GET', '/static/data.txt', 'HTTP/1.1', {}), files, 102.0)
+            segment.release()
+            self.assertIn(b'Content-Length: 13', header)
+
+            self.assertEqual(respond_static(Request('GET', '/static/../skeleton.py', 'HTTP/1.1', {}), files, 102.0),
+                         None)
+            self.assertEqual(respond_static(Request('GET', '/static/missing', 'HTTP/1.1', {}), files, 102.0), None)
+            self.assertEqual(respond_static(Request('GET', '/static/a%00b', 'HTTP/1.1', {}), files, 102.0), None)
+            files.close()
+        print()
+
+    def test_negotiate_accept_encoding(self):
+        print('Testing Accept-Encoding negotiation ...')
+        self.assertEqual(negotiate('gzip;q=0.5, deflate'), 'deflate')
+        self.assertEqual(negotiate('x-gzip'), 'gzip')
+        self.assertEqual(negotiate('identity'), 'identity')
+        self.assertEqual(negotiate('gzip;q=0, *;q=0'), 'identity')
+        self.assertEqual(negotiate('*'), next(iter(ENCODERS)))
+
+        # large bodies are encoded, small ones are not worth it
+        data = json.dumps([{"id": i, "name": f"user {i}"} for i in range(100)]).encode('utf-8')
+        body, headers = encode_body(data, 'gzip')
+        self.assertEqual(gzip.decompress(body), data)
+        self.assertEqual(headers, ('Content-Encoding: gzip', 'Vary: Accept-Encoding'))
+        self.assertEqual(encode_body(b'{}', 'gzip'), (b'{}', ('Vary: Accept-Encoding',)))
+
+        # no Accept-Encoding: the zlib body this server always sent, without a header
+        legacy = handle_request(b"GET /index.html HTTP/1.1\r\n\r\n", None)
+        self.assertIn('Hello world!', zlib.decompress(legacy.partition(b'\r\n\r\n')[2]).decode('utf-8'))
+        negotiated = handle_request(b"GET /index.html HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n", None)
+        self.assertNotIn(b'Content-Encoding', negotiated)
+        self.assertIn(b'Vary: Accept-Encoding', negotiated)
+        print()
+
+    def test_chunked_gzip_stream(self):
+        print('Testing streamed gzip with chunked transfer coding ...')
+        request = Request('GET', '/items?count=5000', 'HTTP/1.1', {'accept-encoding': 'gzip'})
+        header, body, keep_alive = respond_stream(request, generate_items(items_count(request.target)))
+        self.assertIn(b'Transfer-Encoding: chunked', header)
+        self.assertIn(b'Content-Encoding: gzip', header)
+        self.assertTrue(keep_alive, 'keep_alive')
+
+        # the first chunk decodes on its own, before the rest is generated
+        body.fill()
+        size, _, rest = bytes(body.buffer).partition(b'\r\n')
+        first = zlib.decompressobj(31).decompress(rest[:int(size, 16)])
+        self.assertTrue(first.startswith(b'[{"id": 0,') and len(first) >= CHUNK_SIZE, 'first chunk')
+        self.assertFalse(body.finished)
+
+        while body.fill():
+            pass
+        encoded = bytes(body.buffer)
+        self.assertTrue(encoded.endswith(b'\r\n0\r\n\r\n'), 'last chunk')
+        decoded = bytearray()
+        while True:
+            size, _, encoded = encoded.partition(b'\r\n')
+            if not int(size, 16):
+                break
+            decoded += encoded[:int(size, 16)]
+            encoded = encoded[int(size, 16) + 2:]
+        self.assertEqual(json.loads(gzip.decompress(decoded))[-1]['id'], 4999)
+
+        # without Accept-Encoding the legacy zlib body, like every other route sends
+        header, body, _ = respond_stream(Request('GET', '/items?count=3', 'HTTP/1.0', {}), generate_items(3))
+        self.assertNotIn(b'Content-Encoding', header)
+        while body.fill():
+            pass
+        self.assertEqual([item['id'] for item in json.loads(zlib.decompress(bytes(body.buffer)))], [0, 1, 2])
+
+        # HTTP/1.0 has no chunked coding, closing the connection ends the body
+        header, body, keep_alive = respond_stream(Request('GET', '/items', 'HTTP/1.0', {}), generate_items(2))
+        self.assertTrue(b'Transfer-Encoding' not in header and not keep_alive, 'HTTP/1.0')
+        self.assertEqual(items_count('/items?count=-1'), None)
+        print()
+
+    def test_worker_pool_response_in_order(self):
+        print('Testing offloaded response ordering ...')
+        pools = WorkerPools(threads=1)
+        connection = HttpConnection(0.0)
+        pending = PendingResponse(b'Connection: close')
+        connection.queue_pending(pending)
+        connection.queue(b'second response')
+
+        server_end, client_end = socket.socketpair()
+        with server_end, client_end:
+            # nothing leaves before the worker is done, not even the later response
+            self.assertTrue(connection.send(server_end), 'nothing to send yet')
+            client_end.setblocking(False)
+            self.assertRaises(BlockingIOError, client_end.recv, 1024)
+
+            pools.submit(THREAD_POOL, lambda request, params: build_response(200, b'first'), (None, {}), pending)
+            read_ready, _, _ = select.select([pools], [], [], 5.0)
+            self.assertEqual(read_ready, [pools])
+            ((token, future),) = pools.collect()
+            token.complete(future.result())
+            connection.completed(token)
+            self.assertTrue(connection.send(server_end), 'drained')
+            received = client_end.recv(1024)
+        pools.shutdown()
+
+        self.assertIn(b'Connection: close\r\n\r\nfirst', received)
+        self.assertTrue(received.endswith(b'firstsecond response'), 'order')
+        print()
+
+    def test_offloaded_handlers_reject_bad_parameters(self):
+        print('Testing 400 for unusable query parameters ...')
+        for handler, target in ((report, '/report?rows=x'), (report, '/report?rows=-1'), (slow, '/slow?ms=x'),
+                                (slow, '/slow?ms=nan')):
+            response = run_handler(handler, Request('GET', target, 'HTTP/1.1', {}), {})
+            self.assertTrue(response.startswith(b'HTTP/1.1 400 Bad Request'), target)
+        response = run_handler(report, Request('GET', '/report?rows=2', 'HTTP/1.1', {'accept-encoding': 'gzip'}), {})
+        # too small to compress
+        self.assertEqual(len(json.loads(response.partition(b'\r\n\r\n')[2])), 2)
+        print()
+
+    def test_router_params_and_methods(self):
+        print('Testing route matching ...')
+        router = Router()
+        router.add('GET', '/users', 'list')
+        router.add('POST', '/users', 'create')
+        router.add('GET', '/users/{id}', 'show')
+        router.add('GET', '/users/me', 'me')
+        router.add('GET', '/users/{id}/posts/{post}', 'post')
+        router.add('GET', '/files/{path*}', 'file', STATIC)
+
+        self.assertEqual(router.match('POST', '/users')[0], ('create', RESPONSE, None))
+        self.assertEqual(router.match('GET', '/users/42')[:2], (('show', RESPONSE, None), {'id': '42'}))
+        # a literal segment wins over a parameter
+        self.assertEqual(router.match('GET', '/users/me')[:2], (('me', RESPONSE, None), {}))
+        self.assertEqual(router.match('GET', '/users/7/posts/9')[1], {'id': '7', 'post': '9'})
+        self.assertEqual(router.match('GET', '/files/css/site.css')[1], {'path': 'css/site.css'})
+        self.assertEqual(router.match('HEAD', '/users/42')[0], ('show', RESPONSE, None))
+
+        # unknown path: no handler and nothing allowed, wrong method: 405 with Allow
+        self.assertEqual(router.match('GET', '/users/7/comments'), (None, {}, []))
+        self.assertEqual(router.match('DELETE', '/users'), (None, {}, ['GET', 'HEAD', 'POST']))
+        print()
+
+    @patch('select.select')
+    @patch('socket.socket')
+    def test_serve_method_not_allowed(self, mock_socket, mock_select):
+        print('Testing 405 for a known path ...')
+        mock_server_socket = MagicMock()
+        mock_client_socket = MagicMock()
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.return_value = (mock_client_socket, ('127.0.0.1', 12345))
+        mock_select.side_effect = [([mock_server_socket], [], []), ([mock_client_socket], [], []), KeyboardInterrupt]
+        mock_client_socket.recv.return_value = (b"DELETE /index.html HTTP/1.1\r\n\r\nHEAD /index.html HTTP/1.1\r\n\r\n"
+                                                b"GET /items/\xb9 HTTP/1.1\r\n\r\n")
+        sent = []
+        mock_client_socket.send.side_effect = lambda data: sent.append(bytes(data)) or len(data)
+
+        with patch('sys.stdout', new=NullWriter()):
+            serve(ResponseCache(), offload=False)
+        self.assertIn(b'HTTP/1.1 405 Method Not Allowed', sent[0])
+        self.assertIn(b'Allow: GET, HEAD\r\n', sent[0])
+        # the HEAD response ends with its header, a non-ASCII digit is no item id and gets a 404
+        self.assertTrue(b''.join(sent).endswith(without_body(respond('/index.html')) + respond(None)),
+                        'HEAD and non-ASCII id')
+        print()
+
+    @patch('select.select')
+    @patch('socket.socket')
+    def test_serve_pool_answer_to_closed_client(self, mock_socket, mock_select):
+        print('Testing a client closed by its pool answer ...')
+        mock_server_socket = MagicMock()
+        mock_client_socket = MagicMock()
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.return_value = (mock_client_socket, ('127.0.0.1', 12345))
+        mock_client_socket.recv.return_value = b"GET /slow HTTP/1.1\r\n\r\n"
+        mock_client_socket.send.side_effect = BrokenPipeError
+
+        with patch(f'{__name__}.WorkerPools') as mock_pools:
+            pools = mock_pools.return_value
+            submitted = []
+            pools.submit.side_effect = lambda kind, handler, args, token: submitted.append(token)
+            pools.collect.side_effect = lambda: [(token, MagicMock(**{'exception.return_value': None,
+                                                                      'result.return_value': respond(None)}))
+                                                 for token in submitted]
+            # the failed send of the pool answer closes the client, then its read turn comes
+            mock_select.side_effect = [([mock_server_socket], [], []), ([mock_client_socket], [], []),
+                                       ([pools, mock_client_socket], [], []), KeyboardInterrupt]
+            with patch('sys.stdout', new=NullWriter()):
+                serve(ResponseCache())
+        mock_client_socket.close.assert_called_once()
+        print()
+
+    @patch('select.select')
+    @patch('socket.socket')
+    def test_serve_metrics_and_access_log(self, mock_socket, mock_select):
+        print('Testing /metrics and the access log ...')
+        histogram = Histogram((0.001, 0.01))
+        for seconds in (0.0005, 0.001, 0.002, 1.0):
+            histogram.observe(seconds)
+        # a bucket counts the observations up to and including its bound
+        self.assertEqual(histogram.counts, [2, 1, 1])
+
+        mock_server_socket = MagicMock()
+        mock_client_socket = MagicMock()
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.return_value = (mock_client_socket, ('127.0.0.1', 12345))
+        mock_select.side_effect = [([mock_server_socket], [], []), ([mock_client_socket], [], []), KeyboardInterrupt]
+        mock_client_socket.recv.return_value = b"GET /index.html HTTP/1.1\r\n\r\nGET /metrics HTTP/1.1\r\n\r\n"
+        sent = []
+        mock_client_socket.send.side_effect = lambda data: sent.append(bytes(data)) or len(data)
+
+        stdout = StringIO()
+        with patch(f'{__name__}.METRICS', new=Metrics()), patch('sys.stdout', new=stdout):
+            serve(ResponseCache(), offload=False)
+        _, _, exposition = sent[0].partition(b'Content-Type: text/plain; version=0.0.4')
+        self.assertIn(b'http_responses_total{code="200"} 1\n', exposition)
+        self.assertIn(b'http_phase_seconds_count{phase="accept"} 1\n', exposition)
+        self.assertIn(b'http_phase_seconds_count{phase="parse"} 1\n', exposition)
+        self.assertIn(b'http_phase_seconds_bucket{phase="handler",le="+Inf"} 1\n', exposition)
+
+        # the writer thread wrote both lines before serve() returned
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('127.0.0.1 - - ['), 'client address')
+        self.assertIn('"GET /index.html HTTP/1.1" 200 ', lines[0])
+        # the size field is the body alone, as in the Common Log Format
+        self.assertIn(f'" 200 {body_length(respond("/index.html"))} ', lines[0])
+        self.assertIn('"GET /metrics HTTP/1.1" 200 ', lines[1])
+        print()
+
     @patch('socket.socket')
     def test_create_server(self, mock_socket):
         print('Testing create_server ...')
@@ -218,6 +2361,19 @@ class TestHttpServer(unittest.TestCase):
 if __name__ == '__main__':
     if len(sys.argv) == 2 and sys.argv[1] == 'run':
         serve()
+    elif len(sys.argv) == 3 and sys.argv[1] == 'run':
+        # 'run <directory>' also serves the files of directory under /static/
+        serve(static_root=sys.argv[2])
+    elif len(sys.argv) == 2 and sys.argv[1] == 'bench':
+        benchmark_response_cache()
+        benchmark_keep_alive()
+        benchmark_sendfile()
+        benchmark_encoders()
+        benchmark_streaming()
+        benchmark_offload()
+        benchmark_routing()
+        benchmark_instrumentation()
+        sys.exit()
 
     # run unit test to test locally
     # or for domjudge
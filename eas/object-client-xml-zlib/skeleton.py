@@ -1,6 +1,7 @@
-import datetime
+from datetime import datetime, timedelta
 from io import StringIO
 import socket
+import struct
 import time
 import sys
 import pickle
@@ -9,27 +10,229 @@ import unittest
 from unittest.mock import MagicMock, patch
 import zlib
 
+# the object server's message format: the codec version byte, a flags byte and the
+# timestamp in microseconds since the epoch, then the varint length and UTF-8 bytes
+# of the username and of the text
+CODEC_VERSION = 1
+HEADER = struct.Struct('>BBq')
+FLAG_UTC = 0x01
+FLAG_ZLIB = 0x02
+FLAG_ZDICT = 0x04
+# first byte of a legacy message, the zlib header of a pickle
+LEGACY_PREFIX = 0x78
+
+# shorter username and text parts only grow when compressed on their own
+COMPRESS_MIN_SIZE = 256
+
+# window of a shared dictionary's compressor, as the server's train_dictionary sizes them
+DICTIONARY_WBITS = 12
+DICTIONARY_MEMLEVEL = 2
+
+# first byte of a connection whose messages all go through one deflate stream
+STREAM_PREFACE = 0x80
+# any other connection sends each message after its length
+FRAME_HEADER = struct.Struct('>I')
+# largest message the server takes, and the most a received one may inflate to
+MAX_MESSAGE_SIZE = 1024 * 1024
+
+# where the object server listens, its main() binds port 5001
+SERVER_ADDRESS = ('localhost', 5001)
+
+# message timestamps are local time strings in this format
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+# lengths and dictionary ids stay below MAX_MESSAGE_SIZE, 5 varint bytes hold 35 bits
+MAX_VARINT_SIZE = 5
+
+def encode_varint(value):
+    # unsigned LEB128, seven bits a byte, lowest first
+    if value < 0x80:
+        return bytes((value,))
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append(value & 0x7f | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+def decode_varint(data, offset):
+    """Return the varint at offset of data and the offset after it"""
+    byte = data[offset]
+    if byte < 0x80:
+        return byte, offset + 1
+    value = byte & 0x7f
+    for shift in range(7, 7 * MAX_VARINT_SIZE, 7):
+        offset += 1
+        byte = data[offset]
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset + 1
+    raise ValueError(f'varint longer than {MAX_VARINT_SIZE} bytes')
+
+def inflate(decompressor, data, limit=MAX_MESSAGE_SIZE):
+    """Decompress data, a zlib.error rather than more than limit bytes of output"""
+    # max_length stops a small bomb of compressed zeros before it is allocated
+    inflated = decompressor.decompress(data, limit)
+    if decompressor.unconsumed_tail:
+        raise zlib.error(f'message exceeds {limit} bytes')
+    return inflated
+
+class Dictionary:
+    """A preset deflate dictionary the server also knows, primed once and copied for every message"""
+
+    def __init__(self, dictionary_id, zdict):
+        self.dictionary_id = dictionary_id
+        self.zdict = zdict
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -DICTIONARY_WBITS,
+                                           DICTIONARY_MEMLEVEL, zdict=zdict)
+
+    def compress(self, data):
+        compressor = self.compressor.copy()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=self.zdict)
+        data = inflate(decompressor, data)
+        if not decompressor.eof or decompressor.unused_data:
+            raise zlib.error('incomplete or trailing deflate data')
+        return data
+
+# key: dictionary id, value: Dictionary
+DICTIONARIES = {}
+
+def load_dictionary(path):
+    """Register a dictionary file written by the server's train tool, return its id"""
+    with open(path, 'rb') as file:
+        data = file.read()
+    dictionary_id, offset = decode_varint(data, 0)
+    DICTIONARIES[dictionary_id] = Dictionary(dictionary_id, data[offset:])
+    return dictionary_id
+
 class Message:
     def __init__(self, username, text):
         self.username = username
         self.text = text
-        self.timestamp = time.asctime(time.localtime(time.time()))
+        self.timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
+
+    def serialize(self, legacy=False, dictionary_id=None, compress=True):
+        """Encode the message, legacy=True pickles it for servers that only unpickle
 
-    def serialize(self):
-        # Serialize the message
-        serialized =  pickle.dumps(self)
-        # Compress the message
-        return zlib.compress(serialized)
+        With dictionary_id the username and text are compressed against that
+        loaded dictionary when it makes them smaller; compress=False leaves them
+        as they are, for a stream compressed as a whole.
+        """
+        if legacy:
+            # Serialize the message and compress it
+            return zlib.compress(pickle.dumps(self))
+
+        flags = 0
+        micros = (datetime.strptime(self.timestamp, TIMESTAMP_FORMAT) - EPOCH) // MICROSECOND
+        username = self.username.encode('utf-8')
+        text = self.text.encode('utf-8')
+        fields = encode_varint(len(username)) + username + encode_varint(len(text)) + text
+        if compress and dictionary_id is not None:
+            if dictionary_id not in DICTIONARIES:
+                raise ValueError(f'unknown dictionary {dictionary_id}')
+            compressed = encode_varint(dictionary_id) + DICTIONARIES[dictionary_id].compress(fields)
+            if len(compressed) < len(fields):
+                flags |= FLAG_ZDICT
+                fields = compressed
+        elif compress and len(fields) >= COMPRESS_MIN_SIZE:
+            compressed = zlib.compress(fields)
+            if len(compressed) < len(fields):
+                flags |= FLAG_ZLIB
+                fields = compressed
+        return HEADER.pack(CODEC_VERSION, flags, micros) + fields
 
     @staticmethod
-    def deserialize(serialized_message):
-        # Decompress the message
-        decompressed = zlib.decompress(serialized_message)
+    def deserialize(serialized_message, allow_pickle=False):
+        """Decode a message, a pickled one only with allow_pickle: unpickling runs code of the sender"""
+        if not serialized_message:
+            raise ValueError('empty message')
+        version = serialized_message[0]
+        if version == LEGACY_PREFIX:
+            if not allow_pickle:
+                raise ValueError('pickled message refused, legacy messages need allow_pickle')
+            # Decompress the message and deserialize it
+            decompressor = zlib.decompressobj()
+            try:
+                data = inflate(decompressor, serialized_message)
+                if not decompressor.eof or decompressor.unused_data:
+                    raise zlib.error('incomplete or trailing zlib data')
+                return pickle.loads(data)
+            except (zlib.error, pickle.UnpicklingError, EOFError) as error:
+                raise ValueError(f'malformed message: {error}') from None
+        if version != CODEC_VERSION:
+            raise ValueError(f'unsupported message version {version}')
+
+        try:
+            _, flags, micros = HEADER.unpack_from(serialized_message)
+            fields = serialized_message[HEADER.size:]
+            if flags & FLAG_ZDICT:
+                dictionary_id, offset = decode_varint(fields, 0)
+                if dictionary_id not in DICTIONARIES:
+                    raise ValueError(f'message compressed with unknown dictionary {dictionary_id}')
+                fields = DICTIONARIES[dictionary_id].decompress(fields[offset:])
+            elif flags & FLAG_ZLIB:
+                decompressor = zlib.decompressobj()
+                fields = inflate(decompressor, fields)
+                if not decompressor.eof:
+                    raise zlib.error('incomplete zlib data')
+            length, offset = decode_varint(fields, 0)
+            username = fields[offset:offset + length].decode('utf-8')
+            length, offset = decode_varint(fields, offset + length)
+            if offset + length != len(fields):
+                raise ValueError('message length does not match its fields')
+            text = fields[offset:].decode('utf-8')
+            timestamp = EPOCH + micros * MICROSECOND
+        except (struct.error, IndexError, zlib.error, UnicodeDecodeError, OverflowError) as error:
+            raise ValueError(f'malformed message: {error}') from None
 
-        # Deserialize the message
-        message =  pickle.loads(decompressed)
+        message = Message(username, text)
+        # timestamps in UTC come back as UTC wall clock, the client's own are naive local time
+        message.timestamp = timestamp.strftime(TIMESTAMP_FORMAT)
         return message
 
+class StreamEncoder:
+    """One compressobj for all the messages of a connection, a sync flush after each
+
+    Every message compresses against the ones before it on the connection,
+    the username and common phrases cost a few bits after their first time.
+    """
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.started = False
+
+    def encode(self, message):
+        """Return the bytes to send for message, the connection preface before the first one"""
+        data = self.compressor.compress(message.serialize(compress=False)) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if not self.started:
+            self.started = True
+            return bytes((STREAM_PREFACE,)) + data
+        return data
+
+class ChatConnection:
+    """A long-lived connection to the server, its messages share one deflate stream"""
+
+    def __init__(self, address=SERVER_ADDRESS):
+        self.socket = socket.create_connection(address)
+        self.encoder = StreamEncoder()
+
+    def send(self, message):
+        self.socket.sendall(self.encoder.encode(message))
+
+    def close(self):
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 def main():
     username = str(input())
     text = str(input())
@@ -42,8 +245,8 @@ def main():
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         # connect to server
         s.connect(('localhost', 12345))
-        # send message to server
-        s.sendall(serialized_message)
+        # send message to server, after its length
+        s.sendall(FRAME_HEADER.pack(len(serialized_message)) + serialized_message)
         print("Message sent to the server.")
 
 # A 'null' stream that discards anything written to it
@@ -72,6 +275,22 @@ class TestChatClient(unittest.TestCase):
         assert_equal(deserialized_message.text, text)
         self.assertIsInstance(datetime.strptime(deserialized_message.timestamp, '%Y-%m-%d %H:%M:%S.%f'), datetime)
 
+        # a short message that would inflate past MAX_MESSAGE_SIZE is refused
+        bomb = HEADER.pack(CODEC_VERSION, FLAG_ZLIB, 0) + zlib.compress(bytes(MAX_MESSAGE_SIZE + 1))
+        with self.assertRaises(ValueError):
+            Message.deserialize(bomb)
+        # as is a timestamp beyond what datetime holds
+        with self.assertRaises(ValueError):
+            Message.deserialize(HEADER.pack(CODEC_VERSION, 0, 2 ** 62) + serialized_message[HEADER.size:])
+        # a cut pickle and bytes after the zlib stream are malformed, not an unpickling error
+        legacy = message.serialize(legacy=True)
+        for malformed in (zlib.compress(pickle.dumps(message)[:-3]), legacy + b'xx'):
+            with self.assertRaises(ValueError):
+                Message.deserialize(malformed, allow_pickle=True)
+        # and a length that never ends
+        with self.assertRaises(ValueError):
+            Message.deserialize(HEADER.pack(CODEC_VERSION, 0, 0) + b'\xff' * 300000)
+
     @patch('builtins.input', side_effect=['Alice', 'Hello, World!'])
     @patch('socket.socket')
     def test_client_main(self, mock_socket_class, mock_input):
@@ -87,12 +306,31 @@ class TestChatClient(unittest.TestCase):
         
         # Get the arguments with which sendall was called
         sent_data = mock_socket_instance.sendall.call_args[0][0]
-        deserialized_message = Message.deserialize(sent_data)
+        self.assertEqual(FRAME_HEADER.unpack_from(sent_data)[0], len(sent_data) - FRAME_HEADER.size)
+        deserialized_message = Message.deserialize(sent_data[FRAME_HEADER.size:])
         
         assert_equal(deserialized_message.text, 'Hello, World!')
         assert_equal(deserialized_message.username, 'Alice')
         self.assertIsInstance(datetime.strptime(deserialized_message.timestamp, '%Y-%m-%d %H:%M:%S.%f'), datetime)
 
+    def test_stream_encoder(self):
+        print('Testing StreamEncoder ...')
+        encoder = StreamEncoder()
+        first = Message('Alice', 'Hello, World! Lunch at noon?')
+        second = Message('Alice', 'Hello again! Lunch at noon?')
+        sent = [encoder.encode(first), encoder.encode(second)]
+        self.assertEqual(sent[0][0], STREAM_PREFACE)
+
+        # each piece decodes on arrival to exactly its message
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        for data, message in zip((sent[0][1:], sent[1]), (first, second)):
+            decoded = Message.deserialize(decompressor.decompress(data))
+            self.assertEqual((decoded.username, decoded.text, decoded.timestamp),
+                         (message.username, message.text, message.timestamp))
+        # the second message compresses against the first
+        self.assertEqual(len(sent[1]) < len(second.serialize()), True)
+        print()
+
 if __name__ == '__main__':
     if len(sys.argv) == 2 and sys.argv[1] == 'run':
         main()
@@ -1,9 +1,16 @@
-from datetime import datetime
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from io import StringIO
+from logging.handlers import QueueHandler, QueueListener
+import json
 import logging
+import queue
 import socket
 import pickle
+import struct
 import sys
+import time
 import zlib
 import select
 import unittest
@@ -14,6 +21,152 @@ from unittest.mock import MagicMock, patch
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# first byte of a serialized message: the layout of what follows
+CODEC_VERSION = 1
+# first byte of a legacy message, the zlib header of a pickle
+LEGACY_PREFIX = 0x78
+
+# version, flags, timestamp in microseconds since the epoch;
+# then the varint length and UTF-8 bytes of the username and of the text
+HEADER = struct.Struct('>BBq')
+# the timestamp was aware and is in UTC, without it the timestamp is naive
+FLAG_UTC = 0x01
+# the username and text part is zlib compressed
+FLAG_ZLIB = 0x02
+# the username and text part is raw deflate against a shared dictionary, whose varint id comes first
+FLAG_ZDICT = 0x04
+
+# shorter username and text parts only grow when compressed
+COMPRESS_MIN_SIZE = 256
+
+# a shared dictionary gives deflate the history a short message lacks;
+# the compressor's window is no larger, so its primed state is cheap to copy
+DICTIONARY_SIZE = 4096
+DICTIONARY_WBITS = 12
+DICTIONARY_MEMLEVEL = 2
+# length of the substrings train_dictionary counts
+SEGMENT_SIZE = 8
+
+# first byte of a connection whose messages all go through one deflate stream, each
+# followed by a sync flush; message versions stay below it
+STREAM_PREFACE = 0x80
+# undecoded bytes a connection may leave waiting for the rest of a message
+MAX_MESSAGE_SIZE = 1024 * 1024
+
+# any other connection sends frames: the message length, then the message; the
+# length's first byte is 0, which tells it apart from STREAM_PREFACE and LEGACY_PREFIX
+FRAME_HEADER = struct.Struct('>I')
+
+# bytes asked of every recv_into, into one buffer main() allocates once
+RECV_SIZE = 256 * 1024
+
+# one record a received message; the JSON lines formatter takes the fields from its arguments
+RECEIVED = 'Received message: Username: %s Text: %s Timestamp: %s'
+# while more records than this wait for the log writer, one in LOG_SAMPLE_RATE is kept
+LOG_BACKLOG = 10000
+LOG_SAMPLE_RATE = 10
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+# lengths and dictionary ids stay below MAX_MESSAGE_SIZE, 5 varint bytes hold 35 bits
+MAX_VARINT_SIZE = 5
+
+def encode_varint(value):
+    # unsigned LEB128, seven bits a byte, lowest first
+    if value < 0x80:
+        return bytes((value,))
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append(value & 0x7f | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+def decode_varint(data, offset):
+    """Return the varint at offset of data and the offset after it"""
+    byte = data[offset]
+    if byte < 0x80:
+        return byte, offset + 1
+    value = byte & 0x7f
+    for shift in range(7, 7 * MAX_VARINT_SIZE, 7):
+        offset += 1
+        byte = data[offset]
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset + 1
+    raise ValueError(f'varint longer than {MAX_VARINT_SIZE} bytes')
+
+def inflate(decompressor, data, limit=MAX_MESSAGE_SIZE):
+    """Decompress data, a zlib.error rather than more than limit bytes of output"""
+    # max_length stops a small bomb of compressed zeros before it is allocated
+    inflated = decompressor.decompress(data, limit)
+    if decompressor.unconsumed_tail:
+        raise zlib.error(f'message exceeds {limit} bytes')
+    return inflated
+
+class Dictionary:
+    """A preset deflate dictionary, primed once and copied for every message"""
+
+    def __init__(self, dictionary_id, zdict):
+        self.dictionary_id = dictionary_id
+        self.zdict = zdict
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -DICTIONARY_WBITS,
+                                           DICTIONARY_MEMLEVEL, zdict=zdict)
+
+    def compress(self, data):
+        compressor = self.compressor.copy()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=self.zdict)
+        data = inflate(decompressor, data)
+        # raw deflate has no checksum, a cut message shows as an unfinished stream
+        if not decompressor.eof or decompressor.unused_data:
+            raise zlib.error('incomplete or trailing deflate data')
+        return data
+
+# key: dictionary id, value: Dictionary; the id in a message says which one it was compressed with
+DICTIONARIES = {}
+
+def register_dictionary(dictionary_id, zdict):
+    DICTIONARIES[dictionary_id] = Dictionary(dictionary_id, zdict)
+    return DICTIONARIES[dictionary_id]
+
+def save_dictionary(path, dictionary_id, zdict):
+    # the varint id, then the dictionary
+    with open(path, 'wb') as file:
+        file.write(encode_varint(dictionary_id) + zdict)
+
+def load_dictionary(path):
+    """Register the dictionary saved at path, return its id"""
+    with open(path, 'rb') as file:
+        data = file.read()
+    dictionary_id, offset = decode_varint(data, 0)
+    register_dictionary(dictionary_id, data[offset:])
+    return dictionary_id
+
+def train_dictionary(messages, size=DICTIONARY_SIZE, segment=SEGMENT_SIZE):
+    """Build a dictionary of the substrings most common in the encoded messages
+
+    Substrings seen only once are left out and so are ones the dictionary already
+    contains. The most common ones go last, where deflate reaches them with the
+    shortest distances.
+    """
+    counts = Counter()
+    for message in messages:
+        fields = message.encode_fields()
+        for offset in range(len(fields) - segment + 1):
+            counts[fields[offset:offset + segment]] += 1
+
+    dictionary = b''
+    for substring, count in counts.most_common():
+        if count < 2 or len(dictionary) + segment > size:
+            break
+        if substring not in dictionary:
+            dictionary = substring + dictionary
+    return dictionary
+
 class Message:
     def __init__(self, username, text, timestamp):
         # Initialize the message attributes
@@ -22,23 +175,321 @@ class Message:
         self.timestamp = timestamp
 
     @staticmethod
-    def deserialize(serialized_message):
-        # Decompress the message
-        decompresss =  zlib.decompress(serialized_message)
-        # print(decompresss)
-        # Deserialize the message
-        message_dict = pickle.loads(decompresss)
-        return message_dict
-
-    def serialize(self):
-        # Serialize the message
-        serialized = pickle.dumps(self)
-
-        # Compress the message
-        compressed = zlib.compress(serialized)
-        return compressed
-        
-def main():
+    def deserialize(serialized_message, allow_pickle=False):
+        """Decode a message, a pickled one only with allow_pickle: unpickling runs code of the sender"""
+        if not serialized_message:
+            raise ValueError('empty message')
+        version = serialized_message[0]
+        if version == LEGACY_PREFIX:
+            if not allow_pickle:
+                raise ValueError('pickled message refused, legacy clients need allow_pickle')
+            # Decompress the message and deserialize it
+            decompressor = zlib.decompressobj()
+            try:
+                data = inflate(decompressor, serialized_message)
+                if not decompressor.eof or decompressor.unused_data:
+                    raise zlib.error('incomplete or trailing zlib data')
+                return pickle.loads(data)
+            except (zlib.error, pickle.UnpicklingError, EOFError) as error:
+                raise ValueError(f'malformed message: {error}') from None
+        if version != CODEC_VERSION:
+            raise ValueError(f'unsupported message version {version}')
+
+        try:
+            _, flags, micros = HEADER.unpack_from(serialized_message)
+            fields = serialized_message[HEADER.size:]
+            if flags & FLAG_ZDICT:
+                dictionary_id, offset = decode_varint(fields, 0)
+                if dictionary_id not in DICTIONARIES:
+                    raise ValueError(f'message compressed with unknown dictionary {dictionary_id}')
+                fields = DICTIONARIES[dictionary_id].decompress(fields[offset:])
+            elif flags & FLAG_ZLIB:
+                decompressor = zlib.decompressobj()
+                fields = inflate(decompressor, fields)
+                if not decompressor.eof:
+                    raise zlib.error('incomplete zlib data')
+            length, offset = decode_varint(fields, 0)
+            username = fields[offset:offset + length].decode('utf-8')
+            length, offset = decode_varint(fields, offset + length)
+            if offset + length != len(fields):
+                raise ValueError('message length does not match its fields')
+            text = fields[offset:].decode('utf-8')
+            timestamp = EPOCH + micros * MICROSECOND
+        except (struct.error, IndexError, zlib.error, UnicodeDecodeError, OverflowError) as error:
+            raise ValueError(f'malformed message: {error}') from None
+
+        if flags & FLAG_UTC:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        return Message(username, text, timestamp)
+
+    def encode_fields(self):
+        # the username and text part, before any compression
+        username = self.username.encode('utf-8')
+        text = self.text.encode('utf-8')
+        return encode_varint(len(username)) + username + encode_varint(len(text)) + text
+
+    def serialize(self, legacy=False, dictionary_id=None, compress=True):
+        """Encode the message, legacy=True pickles it for servers that only unpickle
+
+        With dictionary_id the username and text are compressed against that
+        registered dictionary, whatever their length, when it makes them smaller.
+        compress=False leaves them as they are, for a stream compressed as a whole.
+        """
+        if legacy:
+            # Serialize the message and compress it
+            return zlib.compress(pickle.dumps(self))
+
+        flags = 0
+        timestamp = self.timestamp
+        if timestamp.tzinfo is not None:
+            flags |= FLAG_UTC
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        fields = self.encode_fields()
+        if compress and dictionary_id is not None:
+            if dictionary_id not in DICTIONARIES:
+                raise ValueError(f'unknown dictionary {dictionary_id}')
+            compressed = encode_varint(dictionary_id) + DICTIONARIES[dictionary_id].compress(fields)
+            if len(compressed) < len(fields):
+                flags |= FLAG_ZDICT
+                fields = compressed
+        elif compress and len(fields) >= COMPRESS_MIN_SIZE:
+            compressed = zlib.compress(fields)
+            if len(compressed) < len(fields):
+                flags |= FLAG_ZLIB
+                fields = compressed
+        return HEADER.pack(CODEC_VERSION, flags, (timestamp - EPOCH) // MICROSECOND) + fields
+
+
+def message_end(buffer, offset):
+    """Return where the uncompressed message at offset of buffer ends, None while it is incomplete"""
+    try:
+        length, position = decode_varint(buffer, offset + HEADER.size)
+        length, position = decode_varint(buffer, position + length)
+    except IndexError:
+        return None
+    end = position + length
+    return end if end <= len(buffer) else None
+
+class StreamEncoder:
+    """Sending half of a stream connection: one compressobj for all its messages
+
+    Every message compresses against the ones before it, usernames and common
+    phrases cost a few bits after their first time. The sync flush after each
+    message lets the receiver decode it without waiting for the next.
+    """
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.started = False
+
+    def encode(self, message):
+        """Return the bytes to send for message, the connection preface before the first one"""
+        data = self.compressor.compress(message.serialize(compress=False)) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if not self.started:
+            self.started = True
+            return bytes((STREAM_PREFACE,)) + data
+        return data
+
+class StreamDecoder:
+    """Receiving half of a stream connection, fed with what follows the preface"""
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        # decompressed bytes of a message not complete yet
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Return the messages data completes"""
+        messages = []
+        while True:
+            # never inflate more than the rest of one message, what is left waits in unconsumed_tail
+            if len(self.buffer) >= MAX_MESSAGE_SIZE:
+                raise ValueError(f'message exceeds {MAX_MESSAGE_SIZE} bytes')
+            try:
+                self.buffer += self.decompressor.decompress(data, MAX_MESSAGE_SIZE - len(self.buffer))
+            except zlib.error as error:
+                raise ValueError(f'malformed stream: {error}') from None
+            offset = 0
+            while True:
+                end = message_end(self.buffer, offset)
+                if end is None:
+                    break
+                messages.append(Message.deserialize(bytes(self.buffer[offset:end])))
+                offset = end
+            del self.buffer[:offset]
+            data = self.decompressor.unconsumed_tail
+            if not data:
+                return messages
+
+class FrameDecoder:
+    """Reassembles the length-prefixed frames of a connection, one message each"""
+
+    def __init__(self, allow_pickle=False):
+        self.allow_pickle = allow_pickle
+        # received bytes of a frame not complete yet
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Return the messages data completes"""
+        buffer = self.buffer
+        buffer += data
+        messages = []
+        offset = 0
+        while len(buffer) - offset >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(buffer, offset)
+            if length > MAX_MESSAGE_SIZE:
+                raise ValueError(f'message exceeds {MAX_MESSAGE_SIZE} bytes')
+            end = offset + FRAME_HEADER.size + length
+            if end > len(buffer):
+                break
+            messages.append(Message.deserialize(bytes(buffer[offset + FRAME_HEADER.size:end]), self.allow_pickle))
+            offset = end
+        del buffer[:offset]
+        return messages
+
+class LegacyDecoder:
+    """Pickled messages of clients from before the binary codec, unframed: each is one zlib stream"""
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj()
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Return the messages data completes"""
+        messages = []
+        while data:
+            if len(self.buffer) >= MAX_MESSAGE_SIZE:
+                raise ValueError(f'message exceeds {MAX_MESSAGE_SIZE} bytes')
+            try:
+                self.buffer += self.decompressor.decompress(data, MAX_MESSAGE_SIZE - len(self.buffer))
+            except zlib.error as error:
+                raise ValueError(f'malformed message: {error}') from None
+            if not self.decompressor.eof:
+                # the rest of a message that reached the limit
+                data = self.decompressor.unconsumed_tail
+                continue
+            try:
+                messages.append(pickle.loads(self.buffer))
+            except (pickle.UnpicklingError, EOFError) as error:
+                raise ValueError(f'malformed message: {error}') from None
+            data = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj()
+            self.buffer = bytearray()
+        return messages
+
+def open_decoder(first, allow_pickle=False):
+    """Return the decoder for a connection whose first byte is first"""
+    if first == STREAM_PREFACE:
+        return StreamDecoder()
+    if first == LEGACY_PREFIX:
+        if not allow_pickle:
+            raise ValueError('pickled message refused, legacy clients need allow_pickle')
+        return LegacyDecoder()
+    return FrameDecoder(allow_pickle)
+
+def receive_messages(sock, decoders, view, allow_pickle=False):
+    """Receive what sock has into view, return the messages it completes or None once sock closed
+
+    decoders holds the decoder of every socket, the first byte a client sends
+    picks its decoder.
+    """
+    count = sock.recv_into(view)
+    if not count:
+        return None
+    data = view[:count]
+    decoder = decoders.get(sock)
+    if decoder is None:
+        decoder = decoders[sock] = open_decoder(data[0], allow_pickle)
+        if isinstance(decoder, StreamDecoder):
+            data = data[1:]
+    return decoder.feed(data)
+
+def ingest(messages):
+    """Log the messages one wakeup decoded, one record each"""
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    for message in messages:
+        logger.info(RECEIVED, message.username, message.text, message.timestamp)
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object a line: the fields of a received message, the text of any other record"""
+
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname}
+        if record.msg is RECEIVED:
+            username, text, timestamp = record.args
+            entry.update(username=username, text=text, timestamp=str(timestamp))
+        else:
+            entry['message'] = record.getMessage()
+        if hasattr(record, 'sample_rate'):
+            # this record stands for sample_rate of its kind
+            entry['sample_rate'] = record.sample_rate
+        return json.dumps(entry, ensure_ascii=False)
+
+class SamplingQueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting to the listener and samples when it falls behind
+
+    While more than backlog records wait, only one in sample_rate is queued,
+    marked with the rate so that counts can be scaled back up.
+    """
+
+    def __init__(self, log_queue, backlog=LOG_BACKLOG, sample_rate=LOG_SAMPLE_RATE):
+        super().__init__(log_queue)
+        self.backlog = backlog
+        self.sample_rate = sample_rate
+        self.skipped = 0
+
+    def prepare(self, record):
+        # the arguments are strings and datetimes nobody changes, the listener thread formats them
+        return record
+
+    def enqueue(self, record):
+        if self.queue.qsize() > self.backlog:
+            self.skipped += 1
+            if self.skipped % self.sample_rate:
+                return
+            record.sample_rate = self.sample_rate
+        self.queue.put_nowait(record)
+
+class JsonLinesHandler(logging.StreamHandler):
+    """StreamHandler that leaves flushing to FlushingQueueListener"""
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+class FlushingQueueListener(QueueListener):
+    """QueueListener that flushes its handlers once the queue is drained, not after every record"""
+
+    def dequeue(self, block):
+        if block and self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+        return self.queue.get(block)
+
+@contextmanager
+def message_log(stream=None, backlog=LOG_BACKLOG, sample_rate=LOG_SAMPLE_RATE):
+    """Write the server's records as JSON lines to stream (stderr) from a listener thread"""
+    log_queue = queue.SimpleQueue()
+    output = JsonLinesHandler(stream)
+    output.setFormatter(JsonFormatter())
+    listener = FlushingQueueListener(log_queue, output)
+    handler = SamplingQueueHandler(log_queue, backlog, sample_rate)
+    logger.addHandler(handler)
+    logger.propagate = False
+    listener.start()
+    try:
+        yield handler
+    finally:
+        # the listener writes out what is queued before it stops
+        listener.stop()
+        output.flush()
+        logger.removeHandler(handler)
+        logger.propagate = True
+
+def main(allow_pickle=False):
     # Set up the server socket
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.bind(('localhost', 5001))
@@ -47,12 +498,22 @@ def main():
 
 
     sockets_list = [server_socket]
+    # key: client socket, value: its FrameDecoder, StreamDecoder or LegacyDecoder
+    decoders = {}
+    view = memoryview(bytearray(RECV_SIZE))
+
+    def close(sock):
+        # remove socket from sockets_list and close it
+        if sock in sockets_list:
+            sockets_list.remove(sock)
+        decoders.pop(sock, None)
+        sock.close()
 
-    
     logger.info("Server is listening on port 12345")
 
     while True:
         read_sockets, _, exception_sockets = select.select(sockets_list, [], sockets_list)
+        received = []
 
         for notified_socket in read_sockets:
             if notified_socket == server_socket:
@@ -65,30 +526,251 @@ def main():
                 logger.info(f"Accepted new connection from {client_address}")
             else:
                 try:
-                    # receive data
-                    data = notified_socket.recv(1024)
-                    # print(data)
-                    if data:
-                        message = Message.deserialize(data)
-                        # print(message.username)
-                        # print(message.text)
-                        # print(message.timestamp)
-                        logger.info("Received message: ")
-                        logger.info(f"Username: {message.username}")
-                        logger.info(f"Text: {message.text}")
-                        logger.info(f"Timestamp: {message.timestamp}")
+                    # receive data, every message it completes is decoded now
+                    messages = receive_messages(notified_socket, decoders, view, allow_pickle)
+                    if messages is None:
+                        close(notified_socket)
+                        continue
+                    received += messages
                 except Exception as e:
                     logger.info(f"Exception: {e}")
-                    # remove socket from sockets_list
-                    sockets_list.remove(client_socket)
-                    # close socket
-                    notified_socket.close()
+                    close(notified_socket)
 
         for notified_socket in exception_sockets:
-            # remove socket from sockets_list
-            sockets_list.remove(client_socket)
-            # close socket
-            notified_socket.close()
+            close(notified_socket)
+
+        # the messages of every client of this wakeup, logged once all are decoded
+        ingest(received)
+
+WORDS = ('hello', 'world', 'the', 'server', 'is', 'down', 'again', 'lunch', 'at', 'noon', 'deploy',
+         'done', 'can', 'you', 'review', 'my', 'patch', 'thanks', 'meeting', 'moved', 'to', 'tomorrow')
+
+def sample_messages(count, seed=0):
+    """Chat-like messages: a few hundred users, short texts of common words"""
+    import random
+
+    generator = random.Random(seed)
+    started = datetime(2024, 1, 1, 9)
+    return [Message(f'user{generator.randrange(500)}',
+                    ' '.join(generator.choices(WORDS, k=generator.randrange(2, 25))),
+                    started + generator.randrange(3600 * 1000000) * MICROSECOND)
+            for _ in range(count)]
+
+def benchmark_codec(count=1000000):
+    messages = sample_messages(count)
+    print(f'{count} messages, {sum(len(message.text) for message in messages) / count:.0f} characters of text on average')
+    print(f'{"":>14} {"encode/s":>10} {"decode/s":>10} {"bytes/msg":>10}')
+    for name, legacy in (('pickle + zlib', True), ('binary', False)):
+        started = time.perf_counter()
+        encoded = [message.serialize(legacy) for message in messages]
+        encoding = time.perf_counter() - started
+        started = time.perf_counter()
+        for data in encoded:
+            Message.deserialize(data, allow_pickle=legacy)
+        decoding = time.perf_counter() - started
+        size = sum(len(data) for data in encoded) / count
+        print(f'{name:>14} {count / encoding:>10.0f} {count / decoding:>10.0f} {size:>10.1f}')
+
+def benchmark_dictionary(count=100000, training=10000):
+    # trained on other messages than the ones measured
+    zdict = train_dictionary(sample_messages(training, seed=1))
+    register_dictionary(1, zdict)
+    messages = sample_messages(count)
+    fields = [message.encode_fields() for message in messages]
+    raw = sum(len(data) for data in fields)
+    print(f'{count} messages, {raw / count:.1f} bytes of username and text on average, '
+          f'{len(zdict)} byte dictionary from {training} others')
+    print(f'{"":>20} {"bytes/msg":>10} {"ratio":>6} {"compress us":>12} {"decompress us":>14}')
+
+    started = time.perf_counter()
+    compressed = [zlib.compress(data) for data in fields]
+    compressing = time.perf_counter() - started
+    started = time.perf_counter()
+    for data in compressed:
+        zlib.decompress(data)
+    decompressing = time.perf_counter() - started
+    size = sum(len(data) for data in compressed)
+    print(f'{"zlib per message":>20} {size / count:>10.1f} {raw / size:>6.2f} {compressing / count * 1e6:>12.1f} '
+          f'{decompressing / count * 1e6:>14.1f}')
+
+    dictionary = DICTIONARIES[1]
+    started = time.perf_counter()
+    compressed = [dictionary.compress(data) for data in fields]
+    compressing = time.perf_counter() - started
+    started = time.perf_counter()
+    for data in compressed:
+        dictionary.decompress(data)
+    decompressing = time.perf_counter() - started
+    size = sum(len(data) for data in compressed)
+    print(f'{"shared dictionary":>20} {size / count:>10.1f} {raw / size:>6.2f} {compressing / count * 1e6:>12.1f} '
+          f'{decompressing / count * 1e6:>14.1f}')
+
+    # whole messages: what serialize() picks, header and dictionary id included
+    for name, dictionary_id in (('serialize()', None), ('serialize(dict)', 1)):
+        size = sum(len(message.serialize(dictionary_id=dictionary_id)) for message in messages)
+        print(f'{name:>20} {size / count:>10.1f}')
+
+def chat_trace(seconds=3600, rate=10.0, users=40, seed=0):
+    """An hour of chat: messages arriving rate a second from users, some much chattier than others"""
+    import random
+
+    generator = random.Random(seed)
+    names = [f'{generator.choice(("alice", "bob", "carol", "dave", "erin"))}.{generator.randrange(10000)}'
+             for _ in range(users)]
+    weights = [1 / (rank + 1) for rank in range(users)]
+    moment = datetime(2024, 1, 1, 9)
+    end = moment + timedelta(seconds=seconds)
+    trace = []
+    while True:
+        moment += timedelta(seconds=generator.expovariate(rate))
+        if moment >= end:
+            return trace
+        text = ' '.join(generator.choices(WORDS, k=generator.randrange(2, 25)))
+        trace.append(Message(generator.choices(names, weights)[0], text, moment))
+
+def benchmark_stream(seconds=3600):
+    trace = chat_trace(seconds)
+    register_dictionary(1, train_dictionary(chat_trace(600, seed=1)))
+    print(f'{len(trace)} messages from {len({message.username for message in trace})} users in {seconds} s of chat, '
+          f'each user on a connection of its own')
+    print(f'{"":>26} {"bytes/msg":>10} {"msg/s":>8}')
+
+    def per_message(encode, decode):
+        started = time.perf_counter()
+        size = 0
+        for message in trace:
+            data = encode(message)
+            size += len(data)
+            decode(data)
+        return size, time.perf_counter() - started
+
+    def per_connection():
+        encoders = {}
+        decoders = {}
+        started = time.perf_counter()
+        size = 0
+        for message in trace:
+            opened = message.username not in encoders
+            if opened:
+                encoders[message.username] = StreamEncoder()
+                decoders[message.username] = StreamDecoder()
+            data = encoders[message.username].encode(message)
+            size += len(data)
+            # main() takes the preface off, the decoder gets what follows it
+            decoders[message.username].feed(data[1:] if opened else data)
+        return size, time.perf_counter() - started
+
+    for name, (size, elapsed) in (
+            ('pickle + zlib', per_message(lambda message: message.serialize(legacy=True),
+                                          lambda data: Message.deserialize(data, allow_pickle=True))),
+            ('binary', per_message(Message.serialize, Message.deserialize)),
+            ('binary, shared dictionary', per_message(lambda message: message.serialize(dictionary_id=1),
+                                                      Message.deserialize)),
+            ('stream per connection', per_connection())):
+        print(f'{name:>26} {size / len(trace):>10.1f} {len(trace) / elapsed:>8.0f}')
+
+def send_frames(sock, chunks):
+    # benchmark child: send every chunk, then close
+    for chunk in chunks:
+        sock.sendall(chunk)
+    sock.close()
+
+def benchmark_framing(large=2000, small=200000, batch=1000):
+    import multiprocessing
+    import os
+
+    def frame(message, compress=True):
+        data = message.serialize(compress=compress)
+        return FRAME_HEADER.pack(len(data)) + data
+
+    big = frame(Message('alice', os.urandom(32 * 1024).hex(), datetime(2024, 1, 1, 9)), compress=False)
+    frames = [frame(message) for message in sample_messages(batch)]
+    cases = (('64 KB messages', [big] * large, large),
+             ('small, one a send', frames * (small // batch), small // batch * batch),
+             (f'small, {batch} a send', [b''.join(frames)] * (small // batch), small // batch * batch))
+    print(f'{"":>22} {"msg/s":>8} {"MB/s":>8} {"wakeups":>8}')
+    for name, chunks, count in cases:
+        receiver, sender = socket.socketpair()
+        child = multiprocessing.Process(target=send_frames, args=(sender, chunks))
+        started = time.perf_counter()
+        child.start()
+        sender.close()
+        decoders = {}
+        view = memoryview(bytearray(RECV_SIZE))
+        received = 0
+        wakeups = 0
+        while True:
+            select.select([receiver], [], [])
+            wakeups += 1
+            messages = receive_messages(receiver, decoders, view)
+            if messages is None:
+                break
+            received += len(messages)
+        elapsed = time.perf_counter() - started
+        child.join()
+        receiver.close()
+        assert received == count
+        size = sum(len(chunk) for chunk in chunks)
+        print(f'{name:>22} {count / elapsed:>8.0f} {size / elapsed / 1e6:>8.1f} {wakeups:>8}')
+
+def benchmark_logging(count=200000, batch=1000):
+    import multiprocessing
+    import os
+
+    frames = b''
+    for message in sample_messages(batch):
+        data = message.serialize()
+        frames += FRAME_HEADER.pack(len(data)) + data
+
+    def four_records(messages):
+        # what main() did for every message
+        for message in messages:
+            logger.info("Received message: ")
+            logger.info(f"Username: {message.username}")
+            logger.info(f"Text: {message.text}")
+            logger.info(f"Timestamp: {message.timestamp}")
+
+    @contextmanager
+    def synchronous_log(stream):
+        handler = logging.StreamHandler(stream)
+        logger.addHandler(handler)
+        logger.propagate = False
+        try:
+            yield None
+        finally:
+            logger.removeHandler(handler)
+            logger.propagate = True
+
+    @contextmanager
+    def no_log(stream):
+        yield None
+
+    print(f'{count} messages in frames of {batch}, received, decoded and logged to {os.devnull}')
+    print(f'{"":>28} {"msg/s":>8} {"sampled out":>12}')
+    logger.setLevel(logging.INFO)
+    for name, log, consume in (('logging off', no_log, lambda messages: None),
+                               ('four records, synchronous', synchronous_log, four_records),
+                               ('one JSON line, queued', message_log, ingest)):
+        receiver, sender = socket.socketpair()
+        child = multiprocessing.Process(target=send_frames, args=(sender, [frames] * (count // batch)))
+        with open(os.devnull, 'w') as stream, log(stream) as handler:
+            started = time.perf_counter()
+            child.start()
+            sender.close()
+            decoders = {}
+            view = memoryview(bytearray(RECV_SIZE))
+            while True:
+                select.select([receiver], [], [])
+                messages = receive_messages(receiver, decoders, view)
+                if messages is None:
+                    break
+                consume(messages)
+            elapsed = time.perf_counter() - started
+        child.join()
+        receiver.close()
+        skipped = handler.skipped - handler.skipped // handler.sample_rate if handler is not None else 0
+        print(f'{name:>28} {count // batch * batch / elapsed:>8.0f} {skipped:>12}')
+    logger.setLevel(logging.NOTSET)
 
 # A 'null' stream that discards anything written to it
 class NullWriter(StringIO):
@@ -104,6 +786,17 @@ def assert_true_any(parameter1, parameter2):
     
     print(f'test attribute passed: {parameter1} found in log messages' if found else f'test attribute failed: {parameter1} not found in log messages')
 
+def recv_into_from(pieces):
+    # side effect of a mock recv_into that receives pieces one by one, then the close
+    pieces = list(pieces)
+    def recv_into(buffer):
+        if not pieces:
+            return 0
+        piece = pieces.pop(0)
+        buffer[:len(piece)] = piece
+        return len(piece)
+    return recv_into
+
 class TestChatServer(unittest.TestCase):
     
     @patch('select.select')
@@ -126,7 +819,8 @@ class TestChatServer(unittest.TestCase):
         test_message = Message("Alice", "Hello, World!", datetime.now())
         serialized_message = test_message.serialize()
         # print(serialized_message)
-        mock_client_socket.recv.return_value = serialized_message
+        framed = FRAME_HEADER.pack(len(serialized_message)) + serialized_message
+        mock_client_socket.recv_into.side_effect = recv_into_from([framed])
         
         with self.assertLogs(logger, level='INFO') as log:
             with self.assertRaises(KeyboardInterrupt):
@@ -137,7 +831,7 @@ class TestChatServer(unittest.TestCase):
             mock_client_socket.setblocking.assert_called_once_with(False)
             
             # Check if the server received and deserialized the message correctly
-            mock_client_socket.recv.assert_called_once_with(1024)
+            mock_client_socket.recv_into.assert_called_once()
             
             # Verify log messages
             log_output = log.output
@@ -146,10 +840,207 @@ class TestChatServer(unittest.TestCase):
             assert_true_any("Username: Alice", log_output)
             assert_true_any("Text: Hello, World!", log_output) 
 
+    def test_message_codec(self):
+        print('Testing the binary message codec ...')
+        naive = Message('Alice', 'Hello, World!', datetime(2024, 5, 17, 13, 45, 12, 345678))
+        data = naive.serialize()
+        self.assertEqual(data[0], CODEC_VERSION)
+        decoded = Message.deserialize(data)
+        self.assertEqual((decoded.username, decoded.text, decoded.timestamp),
+                         (naive.username, naive.text, naive.timestamp))
+
+        # aware timestamps come back in UTC, long texts are compressed
+        aware = Message('Bjørn', 'ünïcode ' * 100, datetime(2024, 5, 17, 15, 45, tzinfo=timezone(timedelta(hours=2))))
+        data = aware.serialize()
+        self.assertEqual(data[1], FLAG_UTC | FLAG_ZLIB)
+        decoded = Message.deserialize(data)
+        self.assertEqual((decoded.username, decoded.text), (aware.username, aware.text))
+        self.assertEqual(decoded.timestamp, aware.timestamp)
+        self.assertEqual(decoded.timestamp.tzinfo, timezone.utc)
+
+        # pickle only when asked for
+        legacy = naive.serialize(legacy=True)
+        with self.assertRaises(ValueError):
+            Message.deserialize(legacy)
+        self.assertEqual(Message.deserialize(legacy, allow_pickle=True).text, 'Hello, World!')
+        # a cut pickle and bytes after the zlib stream are malformed, not an unpickling error
+        for malformed in (zlib.compress(pickle.dumps(naive)[:-3]), legacy + b'xx'):
+            with self.assertRaises(ValueError):
+                Message.deserialize(malformed, allow_pickle=True)
+        with self.assertRaises(ValueError):
+            LegacyDecoder().feed(zlib.compress(pickle.dumps(naive)[:-3]))
+
+        # a timestamp beyond what datetime holds is malformed too
+        out_of_range = HEADER.pack(CODEC_VERSION, 0, 2 ** 62) + data[HEADER.size:]
+        # a length of endless continuation bytes fails after MAX_VARINT_SIZE of them
+        endless = HEADER.pack(CODEC_VERSION, 0, 0) + b'\xff' * 300000
+        for malformed in (b'', b'\x02' + data[1:], data[:-1], data[:5], out_of_range, endless):
+            with self.assertRaises(ValueError):
+                Message.deserialize(malformed)
+        self.assertEqual(decode_varint(encode_varint(MAX_MESSAGE_SIZE), 0), (MAX_MESSAGE_SIZE, 3))
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        with self.assertRaises(ValueError):
+            StreamDecoder().feed(compressor.compress(endless[:HEADER.size + 10]) + compressor.flush(zlib.Z_SYNC_FLUSH))
+        print()
+
+    def test_shared_dictionary(self):
+        print('Testing shared dictionary compression ...')
+        import tempfile
+
+        zdict = train_dictionary(sample_messages(1000, seed=1))
+        self.assertTrue(0 < len(zdict) <= DICTIONARY_SIZE, 'dictionary size')
+        with tempfile.TemporaryDirectory() as directory:
+            path = f'{directory}/chat.zdict'
+            save_dictionary(path, 7, zdict)
+            with patch.dict(DICTIONARIES, clear=True):
+                self.assertEqual(load_dictionary(path), 7)
+                self.assertTrue(DICTIONARIES[7].zdict == zdict, 'loaded dictionary')
+
+                message = sample_messages(1)[0]
+                data = message.serialize(dictionary_id=7)
+                self.assertEqual(data[1] & FLAG_ZDICT, FLAG_ZDICT)
+                self.assertEqual(data[HEADER.size], 7)
+                # a short message shrinks against the dictionary, on its own it would not
+                self.assertTrue(len(data) < len(message.serialize()), 'smaller')
+                decoded = Message.deserialize(data)
+                self.assertEqual((decoded.username, decoded.text, decoded.timestamp),
+                             (message.username, message.text, message.timestamp))
+
+                with self.assertRaises(ValueError):
+                    Message.deserialize(data[:-1])
+                del DICTIONARIES[7]
+                with self.assertRaises(ValueError):
+                    Message.deserialize(data)
+        print()
+
+    def test_stream_connection(self):
+        print('Testing the per-connection deflate stream ...')
+        encoder = StreamEncoder()
+        messages = sample_messages(3)
+        sent = [encoder.encode(message) for message in messages]
+        self.assertEqual(sent[0][0], STREAM_PREFACE)
+
+        # the messages come back in order however the bytes are split
+        data = b''.join(sent)[1:]
+        decoder = StreamDecoder()
+        decoded = []
+        for offset in range(0, len(data), 5):
+            decoded += decoder.feed(data[offset:offset + 5])
+        self.assertEqual([(message.username, message.text, message.timestamp) for message in decoded],
+                     [(message.username, message.text, message.timestamp) for message in messages])
+        self.assertEqual(len(decoder.buffer), 0)
+
+        with self.assertRaises(ValueError):
+            StreamDecoder().feed(b'\xff' * 16)
+
+        # one recv may inflate to more than MAX_MESSAGE_SIZE in all, but not in one message
+        encoder = StreamEncoder()
+        many = [Message('Alice', 'x' * 65536, EPOCH) for _ in range(20)]
+        data = b''.join(encoder.encode(message) for message in many)[1:]
+        self.assertEqual(len(StreamDecoder().feed(data)), 20)
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        header = HEADER.pack(CODEC_VERSION, 0, 0) + encode_varint(4 * MAX_MESSAGE_SIZE)
+        bomb = compressor.compress(header + bytes(4 * MAX_MESSAGE_SIZE)) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        with self.assertRaises(ValueError):
+            StreamDecoder().feed(bomb)
+        with self.assertRaises(ValueError):
+            LegacyDecoder().feed(zlib.compress(bytes(4 * MAX_MESSAGE_SIZE)))
+        print()
+
+    def test_receive_frames(self):
+        print('Testing framed receive and reassembly ...')
+        large = Message('Alice', 'x' * 65536 + bytes(range(256)).hex(), datetime(2024, 1, 1, 9))
+        small = sample_messages(20)
+        data = b''.join(FRAME_HEADER.pack(len(encoded)) + encoded
+                        for encoded in [large.serialize(compress=False)] + [message.serialize() for message in small])
+        # larger than one recv, and split inside frame headers
+        sock = MagicMock()
+        sock.recv_into.side_effect = recv_into_from([data[offset:offset + 4099] for offset in range(0, len(data), 4099)])
+        decoders = {}
+        view = memoryview(bytearray(RECV_SIZE))
+        received = []
+        while True:
+            messages = receive_messages(sock, decoders, view)
+            if messages is None:
+                break
+            received += messages
+        self.assertTrue([message.text for message in received] == [large.text] + [message.text for message in small],
+                    'messages in order')
+        self.assertIsInstance(decoders[sock], FrameDecoder)
+        self.assertEqual(len(decoders[sock].buffer), 0)
+
+        # unframed pickles of old clients, only with allow_pickle
+        legacy = b''.join(message.serialize(legacy=True) for message in small[:3])
+        sock.recv_into.side_effect = recv_into_from([legacy[:7], legacy[7:]])
+        with self.assertRaises(ValueError):
+            receive_messages(sock, {}, view)
+        sock.recv_into.side_effect = recv_into_from([legacy[:7], legacy[7:]])
+        decoders = {}
+        received = receive_messages(sock, decoders, view, allow_pickle=True)
+        received += receive_messages(sock, decoders, view, allow_pickle=True)
+        self.assertEqual([message.text for message in received], [message.text for message in small[:3]])
+
+        # a frame longer than any message is not waited for
+        with self.assertRaises(ValueError):
+            FrameDecoder().feed(FRAME_HEADER.pack(MAX_MESSAGE_SIZE + 1))
+        # nor does a short one inflate beyond that size
+        bomb = HEADER.pack(CODEC_VERSION, FLAG_ZLIB, 0) + zlib.compress(bytes(MAX_MESSAGE_SIZE + 1))
+        with self.assertRaises(ValueError):
+            FrameDecoder().feed(FRAME_HEADER.pack(len(bomb)) + bomb)
+        print()
+
+    def test_message_log(self):
+        print('Testing the JSON lines message log ...')
+        messages = sample_messages(3)
+        stream = StringIO()
+        # whatever level the test runner left the root logger at
+        logger.setLevel(logging.INFO)
+        try:
+            with message_log(stream):
+                ingest(messages)
+                logger.info('Accepted new connection from %s', ('127.0.0.1', 54321))
+        finally:
+            logger.setLevel(logging.NOTSET)
+        entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([(entry['username'], entry['text'], entry['timestamp']) for entry in entries[:3]],
+                     [(message.username, message.text, str(message.timestamp)) for message in messages])
+        self.assertEqual(entries[3]['message'], "Accepted new connection from ('127.0.0.1', 54321)")
+        self.assertTrue(logger.propagate, 'handler removed')
+
+        # past the backlog one record in sample_rate is queued, marked with the rate
+        log_queue = queue.SimpleQueue()
+        handler = SamplingQueueHandler(log_queue, backlog=2, sample_rate=3)
+        for message in sample_messages(11):
+            handler.handle(logger.makeRecord(logger.name, logging.INFO, __file__, 0, RECEIVED,
+                                             (message.username, message.text, message.timestamp), None))
+        queued = [log_queue.get() for _ in range(log_queue.qsize())]
+        self.assertEqual([getattr(record, 'sample_rate', 1) for record in queued], [1, 1, 1, 3, 3])
+        print()
+
 if __name__ == '__main__':
-    if len(sys.argv) == 2 and sys.argv[1] == 'run':
-        main()
-    
+    # run [legacy] [dictionary files]: legacy accepts clients that still send pickled messages
+    if len(sys.argv) >= 2 and sys.argv[1] == 'run':
+        allow_pickle = sys.argv[2:3] == ['legacy']
+        for path in sys.argv[2 + allow_pickle:]:
+            load_dictionary(path)
+        with message_log():
+            main(allow_pickle)
+
+    # train <corpus> <dictionary file> <id>: the corpus has a JSON object with username and text a line
+    elif len(sys.argv) == 5 and sys.argv[1] == 'train':
+        with open(sys.argv[2], encoding='utf-8') as corpus:
+            messages = [Message(record['username'], record['text'], EPOCH) for record in map(json.loads, corpus)]
+        zdict = train_dictionary(messages)
+        save_dictionary(sys.argv[3], int(sys.argv[4]), zdict)
+        print(f'{len(zdict)} byte dictionary {sys.argv[4]} from {len(messages)} messages written to {sys.argv[3]}')
+
+    elif len(sys.argv) == 2 and sys.argv[1] == 'bench':
+        benchmark_codec()
+        benchmark_dictionary()
+        benchmark_stream()
+        benchmark_framing()
+        benchmark_logging()
+
     else:
         runner = unittest.TextTestRunner(stream=NullWriter())
         unittest.main(testRunner=runner, exit=False)
@@ -1,18 +1,82 @@
 # client.py
 
+import asyncio
+import codecs
+import os
 import socket
 import select
+import struct
 import sys
+import time
 import unittest
+import io
 from io import StringIO
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, call
+
+# framed mode: every message is a 4-byte big-endian length followed by the payload
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 64 * 1024
+
+# bytes read from stdin or the socket at once by AsyncChatClient
+READ_CHUNK = 64 * 1024
+
+# the server PINGs idle clients, any reply keeps the connection open
+PING = b'PING\n'
+PONG = b'PONG\n'
+
+def encode_frame(payload):
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+class FrameParser:
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        # bytes of incomplete frames wait here until the rest arrives
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+
+        frames = []
+        offset = 0
+        end = len(buffer)
+        view = memoryview(buffer)
+        try:
+            while end - offset >= FRAME_HEADER.size:
+                (length,) = FRAME_HEADER.unpack_from(buffer, offset)
+                if length > self.max_frame_size:
+                    raise ValueError(f'frame of {length} bytes exceeds {self.max_frame_size}')
+                start = offset + FRAME_HEADER.size
+                if end - start < length:
+                    break
+                frames.append(bytes(view[start:start + length]))
+                offset = start + length
+        finally:
+            view.release()
+
+        # drop the consumed frames once per read
+        if offset:
+            del buffer[:offset]
+        return frames
+
+def strip_pings(data):
+    # a PING is a line of its own, chat lines always carry a 'nickname: ' prefix
+    if PING not in data:
+        return data, False
+    lines = data.splitlines(keepends=True)
+    kept = [line for line in lines if line != PING]
+    return b''.join(kept), len(kept) != len(lines)
 
 class ChatClient:
-    def __init__(self, nickname, host='127.0.0.1', port=65432):
+    def __init__(self, nickname, host='127.0.0.1', port=65432, framed=False):
         # define host and port
         self.host = host
         self.port = port
 
+        # must match the server, see ChatServer(framed=True)
+        self.framed = framed
+        self.parser = FrameParser()
+
         # create socket
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
@@ -27,7 +91,12 @@ class ChatClient:
         self.client_socket.setblocking(False)
 
         # send nickname
-        self.client_socket.send(self.nickname)
+        self.client_socket.send(self.encode(self.nickname))
+
+    def encode(self, payload):
+        if self.framed:
+            return encode_frame(payload)
+        return payload
 
     def main_loop(self):
         while True:
@@ -45,7 +114,17 @@ class ChatClient:
             # if the read-ready socket is the client socket
             if sock == self.client_socket:
                 # receive message
-                message = sock.recv(1024).decode('utf-8')
+                if self.framed:
+                    for frame in self.parser.feed(sock.recv(MAX_FRAME_SIZE)):
+                        if frame == PING:
+                            self.client_socket.send(self.encode(PONG))
+                            continue
+                        sys.stdout.write(frame.decode('utf-8', errors='replace'))
+                    continue
+                data, pinged = strip_pings(sock.recv(1024))
+                if pinged:
+                    self.client_socket.send(PONG)
+                message = data.decode('utf-8')
 
                 # write message to stdout
                 sys.stdout.write(message)
@@ -54,12 +133,383 @@ class ChatClient:
                 message = sys.stdin.readline()
 
                 # send message
-                self.client_socket.send(message.encode('utf-8'))
+                self.client_socket.send(self.encode(message.encode('utf-8')))
 
                 # flush the stdout
                 sys.stdout.flush()
 
 
+class AsyncChatClient:
+    def __init__(self, nickname, host='127.0.0.1', port=65432, framed=False):
+        # define host and port
+        self.host = host
+        self.port = port
+
+        # must match the server, see ChatServer(framed=True)
+        self.framed = framed
+        self.parser = FrameParser()
+
+        # a multi-byte character split across two reads is completed by the next read
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+        # do not forget to encode nickname
+        self.nickname = nickname.encode('utf-8')
+
+        # framed lines waiting for the next write, joined into one write per loop tick
+        self.pending = []
+        self.flush_scheduled = False
+        self.reader = None
+        self.writer = None
+
+    def encode(self, payload):
+        if self.framed:
+            return encode_frame(payload)
+        return payload
+
+    async def connect(self):
+        # connect to server and send nickname
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(self.encode(self.nickname))
+
+    async def main_loop(self, stdin=None, stdout=None):
+        stdin = stdin if stdin is not None else sys.stdin.buffer
+        stdout = stdout if stdout is not None else sys.stdout
+        if self.writer is None:
+            await self.connect()
+
+        # stdin is read until EOF, then the connection is closed and the receiver sees EOF
+        receiving = asyncio.ensure_future(self.receive_loop(stdout))
+        await self.send_loop(stdin)
+        await receiving
+
+    async def open_stdin(self, stdin):
+        # pipes and ttys are watched by the event loop, regular files are read in a thread
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=READ_CHUNK)
+        try:
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), stdin)
+        except ValueError:
+            return lambda: loop.run_in_executor(None, stdin.read1, READ_CHUNK)
+        return lambda: reader.read(READ_CHUNK)
+
+    async def send_loop(self, stdin):
+        read = await self.open_stdin(stdin)
+        tail = b''
+        while True:
+            chunk = await read()
+            if not chunk:
+                break
+
+            # only complete lines are sent, the tail waits for the next chunk
+            data = tail + chunk
+            end = data.rfind(b'\n') + 1
+            tail = data[end:]
+            if end:
+                self.queue_lines(data[:end])
+
+            # stop reading stdin while the socket buffer is full
+            await self.writer.drain()
+
+        if tail:
+            self.queue_lines(tail)
+        self.flush()
+        await self.writer.drain()
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    def queue_lines(self, lines):
+        # the unframed server takes each recv for one message, coalesced lines would reach
+        # the room as one message under one nickname: they get a write each, and even so
+        # TCP may join them; only framed mode keeps line boundaries and coalesces
+        if not self.framed:
+            if not self.writer.is_closing():
+                for line in lines.splitlines(keepends=True):
+                    self.writer.write(line)
+            return
+        self.pending.append(b''.join(encode_frame(line) for line in lines.splitlines(keepends=True)))
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        # everything queued during this loop tick leaves in a single write
+        self.flush_scheduled = False
+        if self.pending and not self.writer.is_closing():
+            self.writer.write(b''.join(self.pending))
+        self.pending.clear()
+
+    async def receive_loop(self, stdout):
+        while True:
+            data = await self.reader.read(READ_CHUNK)
+            if not data:
+                break
+            if self.framed:
+                frames = self.parser.feed(data)
+                if PING in frames:
+                    self.queue_lines(PONG)
+                text = ''.join(frame.decode('utf-8', errors='replace') for frame in frames if frame != PING)
+            else:
+                data, pinged = strip_pings(data)
+                if pinged:
+                    self.queue_lines(PONG)
+                text = self.decoder.decode(data)
+            if text:
+                stdout.write(text)
+                stdout.flush()
+
+
+def run_line_sink(port_queue, expected, done_queue, framed=False):
+    # counts the lines received on one connection, stands in for the chat server;
+    # framed, it counts the frames after the nickname
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen()
+    port_queue.put(server_socket.getsockname()[1])
+    client_socket, _ = server_socket.accept()
+    parser = FrameParser()
+    lines = -1 if framed else 0
+    while lines < expected:
+        data = client_socket.recv(READ_CHUNK)
+        if not data:
+            break
+        # ChatClient sends empty frames for what readline returns at EOF
+        lines += sum(1 for frame in parser.feed(data) if frame) if framed else data.count(b'\n')
+    done_queue.put((time.monotonic(), lines))
+    client_socket.close()
+    server_socket.close()
+
+
+def feed_pipe(write_fd, lines):
+    with os.fdopen(write_fd, 'wb') as pipe:
+        pipe.write(lines)
+
+
+def benchmark_piped_lines(count=100000):
+    import multiprocessing
+    import threading
+
+    lines = b''.join(f'bot line {i} with some text\n'.encode('utf-8') for i in range(count))
+    print(f'{count} piped lines, {len(lines)} bytes')
+    print(f'{"client":>24} {"lines/s":>10} {"received":>9}')
+
+    # unframed AsyncChatClient writes line by line, only framed it coalesces a loop tick's lines
+    for name, framed in (('ChatClient', False), ('AsyncChatClient', False), ('ChatClient', True),
+                         ('AsyncChatClient', True)):
+        port_queue, done_queue = multiprocessing.Queue(), multiprocessing.Queue()
+        sink = multiprocessing.Process(target=run_line_sink, args=(port_queue, count, done_queue, framed))
+        sink.start()
+        port = port_queue.get()
+
+        read_fd, write_fd = os.pipe()
+        stdin = os.fdopen(read_fd, 'rb')
+        started = time.monotonic()
+        feeder = threading.Thread(target=feed_pipe, args=(write_fd, lines))
+        feeder.start()
+
+        if name == 'ChatClient':
+            # select + readline + one send per line, until the sink has everything
+            client = ChatClient('bot', port=port, framed=framed)
+            client.connect()
+            # the sink reads as fast as it can, a blocking send keeps the comparison fair
+            client.client_socket.setblocking(True)
+            with patch('sys.stdin', new=io.TextIOWrapper(stdin, encoding='utf-8')):
+                try:
+                    while done_queue.empty():
+                        client.loop_iteration()
+                except ConnectionError:
+                    # the sink closed once it counted everything, before done_queue showed it
+                    pass
+            client.client_socket.close()
+        else:
+            client = AsyncChatClient('bot', port=port, framed=framed)
+            asyncio.run(client.main_loop(stdin=stdin, stdout=io.StringIO()))
+
+        finished, received = done_queue.get()
+        feeder.join()
+        stdin.close()
+        sink.join()
+        label = f'{name}, {"framed" if framed else "unframed"}'
+        print(f'{label:>24} {received / (finished - started):>10.0f} {received:>9}')
+
+
+class LatencyHistogram:
+    def __init__(self, sub_bucket_bits=5):
+        # log-linear buckets: 2**sub_bucket_bits buckets per power of two (about 3% error),
+        # a fixed list of counters no matter how many samples are recorded
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = [0] * (64 << sub_bucket_bits)
+        self.total = 0
+        self.max = 0
+
+    def index(self, value):
+        bits = self.sub_bucket_bits
+        if value < (1 << bits):
+            return value
+        shift = value.bit_length() - 1 - bits
+        return ((shift + 1) << bits) + (value >> shift) - (1 << bits)
+
+    def upper_bound(self, index):
+        # highest value that falls into the bucket
+        bits = self.sub_bucket_bits
+        if index < (1 << bits):
+            return index
+        shift = (index >> bits) - 1
+        low = ((index & ((1 << bits) - 1)) + (1 << bits)) << shift
+        return low + (1 << shift) - 1
+
+    def record(self, value):
+        value = max(0, int(value))
+        self.counts[self.index(value)] += 1
+        self.total += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        if not self.total:
+            return 0
+        target = max(1, -(-int(self.total * fraction * 1000000) // 1000000))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.upper_bound(index), self.max)
+        return self.max
+
+
+async def run_load(host='127.0.0.1', port=65432, clients=50, rate=200, duration=10.0, size=64, drain_timeout=5.0):
+    # every connection speaks the framed ChatClient protocol and stays in the default room,
+    # so each message is expected by clients - 1 receivers
+    histogram = LatencyHistogram()
+    stats = {'sent': 0, 'expected': 0, 'received': 0}
+    writers = []
+    receivers = []
+
+    async def receive(reader):
+        parser = FrameParser()
+        while True:
+            data = await reader.read(READ_CHUNK)
+            if not data:
+                return
+            now = time.perf_counter_ns()
+            for frame in parser.feed(data):
+                # 'load3: <sender> <seq> <scheduled ns> padding', server notices start with '*'
+                _, _, body = frame.partition(b': ')
+                fields = body.split(b' ', 3)
+                if len(fields) < 3 or frame.startswith(b'* '):
+                    continue
+                histogram.record(now - int(fields[2]))
+                stats['received'] += 1
+
+    for i in range(clients):
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(encode_frame(f'load{i}'.encode('utf-8')))
+        writers.append(writer)
+        receivers.append(asyncio.ensure_future(receive(reader)))
+
+    # give the server time to register every nickname before counting deliveries
+    await asyncio.sleep(0.5)
+
+    # messages are scheduled on a fixed timeline and stamped with the scheduled time,
+    # so a stalled sender shows up as latency instead of silently lowering the rate
+    total = int(rate * duration)
+    interval = 1e9 / rate
+    started = time.perf_counter_ns()
+    for seq in range(total):
+        scheduled = started + int(seq * interval)
+        delay = scheduled - time.perf_counter_ns()
+        if delay > 0:
+            await asyncio.sleep(delay / 1e9)
+        sender = seq % clients
+        payload = f'{sender} {seq} {scheduled} '.encode('utf-8')
+        payload += b'x' * max(0, size - len(payload) - 1) + b'\n'
+        writers[sender].write(encode_frame(payload))
+        stats['sent'] += 1
+        stats['expected'] += clients - 1
+    sending = (time.perf_counter_ns() - started) / 1e9
+
+    # wait for the tail of the broadcasts
+    deadline = time.monotonic() + drain_timeout
+    while stats['received'] < stats['expected'] and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = (time.perf_counter_ns() - started) / 1e9
+
+    for writer in writers:
+        writer.close()
+    for receiver in receivers:
+        receiver.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+
+    return {
+        'clients': clients,
+        'sent': stats['sent'],
+        'send_rate': stats['sent'] / sending if sending else 0,
+        'delivered': stats['received'],
+        'dropped': stats['expected'] - stats['received'],
+        'throughput': stats['received'] / elapsed if elapsed else 0,
+        'p50_ms': histogram.percentile(0.5) / 1e6,
+        'p99_ms': histogram.percentile(0.99) / 1e6,
+        'p999_ms': histogram.percentile(0.999) / 1e6,
+        'max_ms': histogram.max / 1e6,
+    }
+
+
+def spawn_server(host, port, timeout=10.0):
+    import subprocess
+
+    # the reactor from test_skeleton-server.py next to this file, in framed mode
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_skeleton-server.py')
+    server = subprocess.Popen([sys.executable, path, 'reactor', 'framed'], stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.2).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise OSError(f'server did not start listening on {host}:{port}')
+
+
+def load_main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='test_skeleton-client.py load',
+                                     description='localhost load generator for the framed chat server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=65432)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=200, help='messages per second, all clients together')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--size', type=int, default=64, help='message size in bytes')
+    parser.add_argument('--spawn', action='store_true', help='start test_skeleton-server.py reactor framed')
+    parser.add_argument('--max-p99-ms', type=float, help='fail when p99 latency is higher')
+    parser.add_argument('--max-dropped', type=int, help='fail when more messages were dropped')
+    args = parser.parse_args(argv)
+
+    server = spawn_server(args.host, args.port) if args.spawn else None
+    try:
+        result = asyncio.run(run_load(args.host, args.port, args.clients, args.rate, args.duration, args.size))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print(f"clients {result['clients']}, sent {result['sent']} at {result['send_rate']:.0f} msg/s")
+    print(f"delivered {result['delivered']} ({result['throughput']:.0f}/s), dropped {result['dropped']}")
+    print(f"latency ms p50 {result['p50_ms']:.3f} p99 {result['p99_ms']:.3f} "
+          f"p999 {result['p999_ms']:.3f} max {result['max_ms']:.3f}")
+
+    # regression gate: a non-zero exit status fails the CI job
+    failed = False
+    if args.max_p99_ms is not None and result['p99_ms'] > args.max_p99_ms:
+        print(f"FAIL: p99 {result['p99_ms']:.3f} ms > {args.max_p99_ms} ms")
+        failed = True
+    if args.max_dropped is not None and result['dropped'] > args.max_dropped:
+        print(f"FAIL: dropped {result['dropped']} > {args.max_dropped}")
+        failed = True
+    return 1 if failed else 0
+
+
 # A 'null' stream that discards anything written to it
 class NullWriter(StringIO):
     def write(self, txt):
@@ -148,14 +598,119 @@ class TestChatClient(unittest.TestCase):
         self.mock_socket_instance.send.assert_called_with(b'Hi there!')
         print(f"send called with: {self.mock_socket_instance.send.call_args}")
 
+    @patch('select.select')
+    @patch('sys.stdin', new=MagicMock())
+    def test_loop_iteration_framed(self, mock_select):
+        print('Testing framed send and receive ...')
+        self.chat_client.framed = True
+
+        # sending wraps the line in a length-prefixed frame
+        sys.stdin.readline.return_value = "Hi there!"
+        mock_select.return_value = ([sys.stdin], [], [])
+        self.chat_client.loop_iteration()
+        self.mock_socket_instance.send.assert_called_with(b'\x00\x00\x00\tHi there!')
+        print(f"send called with: {self.mock_socket_instance.send.call_args}")
+
+        # two frames coalesced in one recv are written separately
+        self.mock_socket_instance.recv.return_value = encode_frame(b'a: one\n') + encode_frame(b'b: two\n')
+        mock_select.return_value = ([self.chat_client.client_socket], [], [])
+        with patch('sys.stdout', new_callable=MagicMock) as mock_stdout:
+            self.chat_client.loop_iteration()
+        self.assertEqual(mock_stdout.write.call_count, 2)
+        print(f"write called with: {mock_stdout.write.call_args_list}")
+
+    @patch('select.select')
+    def test_loop_iteration_answers_ping(self, mock_select):
+        print('Testing PING answered with PONG ...')
+        self.mock_socket_instance.recv.return_value = b"a: hi\nPING\n"
+        mock_select.return_value = ([self.chat_client.client_socket], [], [])
+        with patch('sys.stdout', new_callable=MagicMock) as mock_stdout:
+            self.chat_client.loop_iteration()
+        self.mock_socket_instance.send.assert_called_with(PONG)
+        mock_stdout.write.assert_called_with("a: hi\n")
+        print(f"send called with: {self.mock_socket_instance.send.call_args}")
+        print()
+
+
+class TestAsyncChatClient(unittest.TestCase):
+    def setUp(self):
+        self.chat_client = AsyncChatClient('TestNickname')
+        self.chat_client.writer = MagicMock()
+        self.chat_client.writer.is_closing.return_value = False
+
+    def test_queued_lines_coalesced(self):
+        print('Testing coalesced send ...')
+
+        async def queue_and_wait():
+            self.chat_client.queue_lines(b'one\ntwo\n')
+            self.chat_client.queue_lines(b'three\n')
+            # the flush runs on the next loop tick
+            await asyncio.sleep(0)
+
+        # unframed lines are written one by one, the server reads no boundaries between them
+        asyncio.run(queue_and_wait())
+        self.assertEqual(self.chat_client.writer.write.call_args_list, [call(b'one\n'), call(b'two\n'), call(b'three\n')])
+        print(f"write called with: {self.chat_client.writer.write.call_args_list}")
+
+        # framed mode writes once, with one frame per line
+        self.chat_client.framed = True
+        self.chat_client.writer.write.reset_mock()
+        asyncio.run(queue_and_wait())
+        sent = self.chat_client.writer.write.call_args[0][0]
+        self.assertEqual(FrameParser().feed(sent), [b'one\n', b'two\n', b'three\n'])
+        print()
+
+    def test_receive_split_utf8(self):
+        print('Testing receive split utf-8 ...')
+        encoded = 'héllo wörld\n'.encode('utf-8')
+
+        # the two bytes of 'é' arrive in different reads
+        self.chat_client.reader = MagicMock()
+        reads = [encoded[:2], encoded[2:], b'']
+
+        async def read(size):
+            return reads.pop(0)
+
+        self.chat_client.reader.read = read
+        stdout = MagicMock()
+        asyncio.run(self.chat_client.receive_loop(stdout))
+        written = ''.join(call[0][0] for call in stdout.write.call_args_list)
+        self.assertEqual(written, 'héllo wörld\n')
+        print()
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_percentiles(self):
+        print('Testing latency histogram ...')
+        histogram = LatencyHistogram()
+        for value in range(1, 10001):
+            histogram.record(value * 1000)
+
+        # bucket boundaries are within about 3% of the exact value
+        for fraction, exact in ((0.5, 5000000), (0.99, 9900000), (0.999, 9990000)):
+            value = histogram.percentile(fraction)
+            self.assertTrue(abs(value - exact) / exact < 0.04)
+        self.assertEqual(histogram.percentile(1.0), 10000000)
+        self.assertEqual(histogram.total, 10000)
+        print()
+
 
 if __name__ == "__main__":
-    # uncomment this to test communication between client and server on your local computer
-    # nickname = input("Choose your nickname: ")
-    # client = ChatClient(nickname)
-    # client.connect()
-    # client.main_loop()
-
-    # uncomment this before submitting to dumjudge
-    runner = unittest.TextTestRunner(stream=NullWriter())
-    unittest.main(testRunner=runner, exit=False)
+    if len(sys.argv) == 2 and sys.argv[1] == 'bench':
+        benchmark_piped_lines()
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'load':
+        # e.g. 'load --spawn --clients 100 --rate 500 --max-p99-ms 20'
+        sys.exit(load_main(sys.argv[2:]))
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'async':
+        # for scripted bots: 'async <nickname> [framed]', lines are piped to stdin
+        asyncio.run(AsyncChatClient(sys.argv[2], framed='framed' in sys.argv[3:]).main_loop())
+    else:
+        # uncomment this to test communication between client and server on your local computer
+        # nickname = input("Choose your nickname: ")
+        # client = ChatClient(nickname)
+        # client.connect()
+        # client.main_loop()
+
+        # uncomment this before submitting to dumjudge
+        runner = unittest.TextTestRunner(stream=NullWriter())
+        unittest.main(testRunner=runner, exit=False)
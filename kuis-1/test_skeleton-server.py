@@ -1,6 +1,15 @@
+import mmap
+import os
 import socket
 import select
+import selectors
+import struct
+import sys
+import threading
+import time
 import unittest
+from collections import deque
+from itertools import islice
 from io import StringIO
 from unittest.mock import MagicMock, patch
 
@@ -8,6 +17,33 @@ from unittest.mock import MagicMock, patch
 HOST = '127.0.0.1'
 PORT = 65432
 
+# what ChatServer does when a client's outbound queue is full
+SLOW_CONSUMER_POLICIES = ('drop-oldest', 'disconnect', 'backpressure')
+
+# framed mode: every message is a 4-byte big-endian length followed by the payload
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 64 * 1024
+
+# queued messages handed to one sendmsg call in scatter/gather mode
+SENDMSG_BATCH = 64
+
+# every client joins this room after sending its nickname
+DEFAULT_ROOM = 'lobby'
+
+# relay frames between worker processes: room name length, room name, message as sent to clients
+ROOM_LENGTH = struct.Struct('!H')
+RELAY_QUEUE_LIMIT = 1 << 20
+
+# message history file header: magic, version, max messages, capacity, first, next, write position
+HISTORY_HEADER = struct.Struct('!8sIIQQQQ')
+HISTORY_MAGIC = b'CHATHIST'
+HISTORY_PATH = 'chat-history.bin'
+
+# sent to a client that has been idle for idle_timeout, any reply keeps it connected;
+# a PONG line is taken for the reply only while a PING is outstanding
+PING = b'PING\n'
+PONG = b'PONG'
+
 def receive_message(client_socket):
     try:
         # receive message
@@ -22,6 +58,15 @@ def receive_message(client_socket):
     except:
         return False
 
+def strip_pong(data):
+    # unframed, a recv may carry the PONG line next to chat lines; only a complete
+    # line that is exactly PONG counts
+    if PONG not in data:
+        return data, False
+    lines = data.splitlines(keepends=True)
+    kept = [line for line in lines if not (line.endswith(b'\n') and line.rstrip(b'\r\n') == PONG)]
+    return b''.join(kept), len(kept) != len(lines)
+
 def broadcast(message, sender_socket, clients):
     # check each socket in list of client sockets
     for client in clients:
@@ -30,6 +75,58 @@ def broadcast(message, sender_socket, clients):
         if client != sender_socket:
             client.send(message)
 
+def encode_frame(payload):
+    # length header + payload, the unit of the framed wire protocol
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+class FrameParser:
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        # reassembly buffer for one socket, bytes of incomplete frames wait here
+        self.buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        # append what recv returned and cut out every complete frame
+        buffer = self.buffer
+        buffer += data
+
+        frames = []
+        offset = 0
+        end = len(buffer)
+        view = memoryview(buffer)
+        try:
+            while end - offset >= FRAME_HEADER.size:
+                (length,) = FRAME_HEADER.unpack_from(buffer, offset)
+                if length > self.max_frame_size:
+                    raise ValueError(f'frame of {length} bytes exceeds {self.max_frame_size}')
+                start = offset + FRAME_HEADER.size
+                if end - start < length:
+                    break
+
+                # slicing the memoryview does not copy, bytes() copies the frame once
+                frames.append(bytes(view[start:start + length]))
+                offset = start + length
+        finally:
+            view.release()
+
+        # drop the consumed frames once per read instead of once per frame
+        if offset:
+            del buffer[:offset]
+        return frames
+
+def receive_frames(client_socket, parser):
+    try:
+        # receive whatever is available, frames may be split or coalesced
+        data = client_socket.recv(MAX_FRAME_SIZE)
+
+        # if no data, the peer closed the connection
+        if not len(data):
+            return False
+
+        return parser.feed(data)
+    except (OSError, ValueError):
+        return False
+
 def start_server():
     # create socket
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -108,6 +205,1316 @@ def start_server():
                 broadcast(full_message, sock, clients)
 
 
+class HistoryRing:
+    def __init__(self, capacity, max_messages, path=None):
+        # recent broadcast frames in one flat buffer: header, offset and length
+        # arrays indexed by sequence number % max_messages, then the frame bytes.
+        # No Python object is kept per message.
+        self.capacity = capacity
+        self.max_messages = max_messages
+        self.path = path
+        index_size = max_messages * 12
+        size = HISTORY_HEADER.size + index_size + capacity
+
+        # with a path the buffer is a shared file mapping and survives a restart
+        self.file = None
+        if path is None:
+            self.buffer = bytearray(size)
+        else:
+            self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+            if os.path.getsize(path) != size:
+                self.file.truncate(size)
+            self.buffer = mmap.mmap(self.file.fileno(), size)
+
+        view = memoryview(self.buffer)
+        offsets_start = HISTORY_HEADER.size
+        lengths_start = offsets_start + max_messages * 8
+        data_start = lengths_start + max_messages * 4
+        self.offsets = view[offsets_start:lengths_start].cast('Q')
+        self.lengths = view[lengths_start:data_start].cast('I')
+        self.data = view[data_start:]
+
+        magic, version, max_messages, capacity, self.first, self.next, self.position = \
+            HISTORY_HEADER.unpack_from(self.buffer)
+        if (magic, version, max_messages, capacity) != (HISTORY_MAGIC, 1, self.max_messages, self.capacity):
+            # new file or a different geometry, start empty
+            self.first = self.next = self.position = 0
+            self.save_header()
+
+    def __len__(self):
+        return self.next - self.first
+
+    def save_header(self):
+        HISTORY_HEADER.pack_into(self.buffer, 0, HISTORY_MAGIC, 1, self.max_messages, self.capacity,
+                                 self.first, self.next, self.position)
+
+    def evict(self, start, end):
+        # drop the oldest frames while they overlap [start, end)
+        while self.first < self.next:
+            slot = self.first % self.max_messages
+            offset = self.offsets[slot]
+            if offset >= end or offset + self.lengths[slot] <= start:
+                return
+            self.first += 1
+
+    def append(self, parts):
+        # parts are written one after the other, the frame is never joined
+        length = sum(map(len, parts))
+        if length > self.capacity:
+            return False
+
+        position = self.position
+        if position + length > self.capacity:
+            # no room before the end: the tail is skipped and writing starts over at 0
+            self.evict(position, self.capacity)
+            position = 0
+        self.evict(position, position + length)
+        if self.next - self.first == self.max_messages:
+            self.first += 1
+
+        slot = self.next % self.max_messages
+        self.offsets[slot] = position
+        self.lengths[slot] = length
+        for part in parts:
+            self.data[position:position + len(part)] = part
+            position += len(part)
+
+        # the header is written last, a crash in between loses at most this frame
+        self.position = position
+        self.next += 1
+        self.save_header()
+        return True
+
+    def frames(self, limit=None):
+        # oldest first, as memoryviews into the ring, valid until the next append
+        first = self.first if limit is None else max(self.first, self.next - limit)
+        for sequence in range(first, self.next):
+            slot = sequence % self.max_messages
+            offset = self.offsets[slot]
+            yield self.data[offset:offset + self.lengths[slot]]
+
+    def close(self):
+        self.offsets.release()
+        self.lengths.release()
+        self.data.release()
+        if self.file is not None:
+            self.buffer.flush()
+            self.buffer.close()
+            self.file.close()
+
+
+class OutboundQueue:
+    def __init__(self, limit, scatter_gather=False):
+        # bounded ring of pending messages for one client
+        self.limit = limit
+        self.messages = deque()
+
+        # messages are tuples of buffers written with sendmsg instead of bytes
+        self.scatter_gather = scatter_gather
+
+        # bytes of messages[0] already written to the socket
+        self.offset = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def full(self):
+        return len(self.messages) >= self.limit
+
+    def push(self, message):
+        self.messages.append(message)
+
+    def drop_oldest(self):
+        # a partially written head must be finished, otherwise the
+        # client receives half a message glued to the next one
+        index = 1 if self.offset else 0
+        if index < len(self.messages):
+            del self.messages[index]
+            self.dropped += 1
+
+    def drain(self, sock):
+        # write as much as the socket accepts, return True when empty
+        if self.scatter_gather:
+            return self.drain_scatter_gather(sock)
+
+        while self.messages:
+            head = self.messages[0]
+            try:
+                sent = sock.send(memoryview(head)[self.offset:])
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.offset += sent
+            if self.offset < len(head):
+                return False
+            self.messages.popleft()
+            self.offset = 0
+        return True
+
+    def drain_scatter_gather(self, sock):
+        # one sendmsg writes the parts of many queued messages without joining them
+        messages = self.messages
+        while messages:
+            buffers = []
+            skip = self.offset
+            for parts in islice(messages, SENDMSG_BATCH):
+                for part in parts:
+                    if skip >= len(part):
+                        skip -= len(part)
+                        continue
+                    buffers.append(memoryview(part)[skip:] if skip else part)
+                    skip = 0
+            try:
+                sent = sock.sendmsg(buffers)
+            except (BlockingIOError, InterruptedError):
+                return False
+
+            # pop every message that was written completely
+            sent += self.offset
+            while messages:
+                length = sum(map(len, messages[0]))
+                if sent < length:
+                    break
+                sent -= length
+                messages.popleft()
+            self.offset = sent
+
+            # a partial write means the socket buffer is full
+            if self.offset:
+                return False
+        return True
+
+
+class TimerWheel:
+    def __init__(self, tick=1.0, slots=512):
+        # hashed timing wheel: a timer lands in slot deadline % slots and only
+        # the slot of the current tick is looked at, never every timer
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+
+        # key: timer key, value: deadline as an absolute tick number
+        self.deadlines = {}
+        self.current = int(time.monotonic() / tick)
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key, delay, now):
+        # rescheduling replaces the previous timer of the same key
+        self.cancel(key)
+        deadline = max(-int(-(now + delay) // self.tick), self.current + 1)
+        self.deadlines[key] = deadline
+        self.slots[deadline % len(self.slots)].add(key)
+
+    def cancel(self, key):
+        deadline = self.deadlines.pop(key, None)
+        if deadline is not None:
+            self.slots[deadline % len(self.slots)].discard(key)
+
+    def expire_slot(self, slot, target, expired):
+        # a slot also holds timers one or more turns ahead, those stay
+        due = [key for key in slot if self.deadlines[key] <= target]
+        for key in due:
+            slot.discard(key)
+            del self.deadlines[key]
+        expired.extend(due)
+
+    def advance(self, now):
+        # return the keys whose deadline passed since the last call
+        target = int(now / self.tick)
+        expired = []
+        if target - self.current >= len(self.slots):
+            # asleep for a whole turn or more, every slot is due once
+            for slot in self.slots:
+                self.expire_slot(slot, target, expired)
+        else:
+            for current in range(self.current + 1, target + 1):
+                slot = self.slots[current % len(self.slots)]
+                if slot:
+                    self.expire_slot(slot, current, expired)
+        self.current = max(self.current, target)
+        return expired
+
+
+class ChatServer:
+    def __init__(self, host=HOST, port=PORT, verbose=True, max_queue=1024, slow_consumer='drop-oldest',
+                 framed=False, scatter_gather=False, reuse_port=False, history=None,
+                 idle_timeout=None, ping_timeout=10.0):
+        if slow_consumer not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f'unknown slow consumer policy: {slow_consumer}')
+
+        # define host and port
+        self.host = host
+        self.port = port
+        self.verbose = verbose
+
+        # what to do when a client's outbound queue is full:
+        # drop-oldest, disconnect, or backpressure (stop reading the sender)
+        self.max_queue = max_queue
+        self.slow_consumer = slow_consumer
+
+        # length-prefixed messages instead of one recv per message
+        self.framed = framed
+
+        # key: client_socket, value: FrameParser (framed mode only)
+        self.parsers = {}
+
+        # hand header, nickname prefix and body to sendmsg separately instead of joining them
+        self.scatter_gather = scatter_gather and hasattr(socket.socket, 'sendmsg')
+
+        # key: client_socket, value: b'nickname: ', encoded once at login
+        self.prefixes = {}
+
+        # broadcast payload buffers built so far and their size, independent of room size
+        self.counters = {'broadcasts': 0, 'payload_bytes': 0}
+
+        # key: room, value: set of client sockets in the room
+        self.rooms = {}
+
+        # reverse index, key: client_socket, value: set of rooms
+        self.memberships = {}
+
+        # key: client_socket, value: room its plain messages go to (the last one joined)
+        self.active_rooms = {}
+
+        # key: room, value: b'[room] ', the default room has no label
+        self.room_prefixes = {DEFAULT_ROOM: b''}
+
+        # several worker processes may listen on the same port (SO_REUSEPORT),
+        # broadcasts reach the other workers through these relay sockets
+        self.reuse_port = reuse_port
+        self.relays = set()
+
+        # HistoryRing of recent default room broadcasts, replayed to every new client
+        self.history = history
+
+        # idle clients get a PING after idle_timeout seconds and are closed when they
+        # stay silent for ping_timeout more; None turns the reaper off
+        self.idle_timeout = idle_timeout
+        self.ping_timeout = ping_timeout
+        self.timers = TimerWheel(tick=min(1.0, ping_timeout / 2)) if idle_timeout else None
+
+        # key: client_socket, value: time of the last read, updated in O(1) without touching the wheel
+        self.last_activity = {}
+
+        # key: client_socket, value: time the unanswered PING was sent
+        self.pinged = {}
+
+        # loop time of the current iteration
+        self.now = time.monotonic()
+
+        # DefaultSelector is epoll on Linux and kqueue on BSD/macOS,
+        # so a wakeup costs O(ready sockets) instead of O(all sockets)
+        # and there is no FD_SETSIZE limit like select.select has
+        self.selector = selectors.DefaultSelector()
+
+        # registration map, key: fd, value: client socket
+        self.connections = {}
+
+        # key: client_socket, value: user (same shape as in start_server)
+        self.clients = {}
+
+        # key: client_socket, value: OutboundQueue
+        self.outbound = {}
+
+        # key: client_socket, value: events currently registered (0 = not registered)
+        self.interest = {}
+
+        # sockets with queued data, flushed once at the end of each loop iteration
+        self.dirty = set()
+
+        # backpressure: senders not read from, and which full queue paused them
+        self.paused = set()
+        self.blocked_by = {}
+
+        self.server_socket = None
+
+    def start(self):
+        # create socket
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        # set socket option to reuse address
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        # let the kernel spread incoming connections over the workers
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        # bind address to server socket
+        self.server_socket.bind((self.host, self.port))
+
+        # listen with the largest backlog the kernel allows, so bursts of
+        # connections are not dropped while the loop is busy
+        self.server_socket.listen(socket.SOMAXCONN)
+
+        # the listening socket never blocks, accept is drained until empty
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+
+        # port 0 means the kernel picked one
+        self.port = self.server_socket.getsockname()[1]
+        if self.verbose:
+            print(f'Listening for connections on {self.host}:{self.port}...')
+
+    def main_loop(self):
+        if self.server_socket is None:
+            self.start()
+        while True:
+            self.loop_iteration()
+
+    def loop_iteration(self, timeout=None):
+        # with the reaper on, wake up at least once per wheel tick
+        if self.timers is not None:
+            timeout = self.timers.tick if timeout is None else min(timeout, self.timers.tick)
+
+        # wait until at least one registered socket is ready
+        events = self.selector.select(timeout)
+        self.now = time.monotonic()
+
+        for key, mask in events:
+            sock = key.fileobj
+
+            # if the ready socket is the server socket, then accept connection
+            if sock is self.server_socket:
+                self.accept_connections()
+                continue
+
+            # an earlier event in this iteration may have closed the socket
+            if mask & selectors.EVENT_READ and sock in self.interest:
+                self.handle_readable(sock)
+            if mask & selectors.EVENT_WRITE and sock in self.interest:
+                self.handle_writable(sock)
+
+        if self.timers is not None:
+            self.reap_idle()
+        self.flush()
+        return len(events)
+
+    def accept_connections(self):
+        # accept every pending connection in one wakeup
+        while True:
+            try:
+                client_socket, _ = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            self.add_connection(client_socket)
+
+    def add_connection(self, client_socket):
+        # the nickname is read when the socket becomes read ready,
+        # so a client that connects and stays silent never stalls the loop
+        client_socket.setblocking(False)
+        self.connections[client_socket.fileno()] = client_socket
+        self.outbound[client_socket] = OutboundQueue(self.max_queue, self.scatter_gather)
+        if self.framed:
+            self.parsers[client_socket] = FrameParser()
+        self.interest[client_socket] = 0
+        self.update_interest(client_socket)
+        if self.timers is not None:
+            now = time.monotonic()
+            self.last_activity[client_socket] = now
+            self.timers.schedule(client_socket, self.idle_timeout, now)
+
+    def add_relay(self, relay_socket):
+        # connection to another worker, read and written like a client but never sent chat traffic
+        relay_socket.setblocking(False)
+        self.relays.add(relay_socket)
+        self.connections[relay_socket.fileno()] = relay_socket
+        self.outbound[relay_socket] = OutboundQueue(RELAY_QUEUE_LIMIT)
+        self.parsers[relay_socket] = FrameParser(2 * MAX_FRAME_SIZE)
+        self.interest[relay_socket] = 0
+        self.update_interest(relay_socket)
+
+    def update_interest(self, sock):
+        # read unless paused by backpressure, write only while data is queued
+        events = 0
+        if sock not in self.paused:
+            events |= selectors.EVENT_READ
+        if self.outbound[sock]:
+            events |= selectors.EVENT_WRITE
+
+        current = self.interest[sock]
+        if events == current:
+            return
+        if not current:
+            self.selector.register(sock, events)
+        elif not events:
+            self.selector.unregister(sock)
+        else:
+            self.selector.modify(sock, events)
+        self.interest[sock] = events
+
+    def handle_readable(self, sock):
+        # broadcasts from other workers
+        if sock in self.relays:
+            frames = receive_frames(sock, self.parsers[sock])
+            if frames is False:
+                self.disconnect(sock)
+                return
+            for frame in frames:
+                self.handle_relay(frame)
+            return
+
+        # receive message(s) from read-ready socket
+        if self.framed:
+            messages = receive_frames(sock, self.parsers[sock])
+        else:
+            messages = receive_message(sock)
+            if messages is not False:
+                messages = [messages]
+
+        # check if message is False
+        if messages is False:
+            self.disconnect(sock)
+            return
+
+        # only the time is recorded, the wheel looks at it when the timer fires
+        if self.timers is not None:
+            self.last_activity[sock] = self.now
+
+        for message in messages:
+            self.handle_message(sock, message)
+
+    def handle_message(self, sock, message):
+        # first message on a new connection is the nickname
+        user = self.clients.get(sock)
+        if user is None:
+            user = message.decode('utf-8', errors='replace')
+            self.clients[sock] = user
+            self.prefixes[sock] = f"{user}: ".encode('utf-8')
+            self.memberships[sock] = set()
+            self.join(sock, DEFAULT_ROOM)
+            if self.history is not None:
+                self.replay_history(sock)
+            if self.verbose:
+                print('Accepted new connection from {}:{}, nickname: {}'.format(*sock.getpeername(), user))
+            return
+
+        # answer to a PING, reading it already counted as activity; without a PING
+        # outstanding it is a chat message like any other
+        if sock in self.pinged:
+            if self.framed:
+                ponged = message.strip() == PONG
+                if ponged:
+                    message = b''
+            else:
+                message, ponged = strip_pong(message)
+            if ponged:
+                del self.pinged[sock]
+                if not message:
+                    return
+
+        # /join <room> and /part <room> change the sender's rooms
+        if message[:1] == b'/':
+            command, _, room = message.decode('utf-8', errors='replace').strip().partition(' ')
+            command = command.lower()
+            room = room.strip()
+            if command in ('/join', '/part') and room:
+                if command == '/join':
+                    self.join(sock, room)
+                else:
+                    self.part(sock, room)
+                return
+
+        room = self.active_rooms.get(sock)
+        if room is None:
+            self.send_notice(sock, 'you are not in a room, use /join <room>')
+            return
+
+        if self.verbose:
+            print(f'Received message from {user} in {room}: {message.decode("utf-8", errors="replace")}')
+
+        # Broadcast message with nickname prefixed, the body is forwarded as received
+        # and the one buffer built here is shared by every recipient's queue
+        room_prefix = self.room_prefixes[room]
+        prefix = self.prefixes[sock]
+        length = len(room_prefix) + len(prefix) + len(message)
+        if self.framed:
+            parts = (FRAME_HEADER.pack(length), room_prefix, prefix, message)
+        else:
+            parts = (room_prefix, prefix, message)
+        if self.scatter_gather:
+            full_message = parts
+        else:
+            full_message = b''.join(parts)
+
+        self.counters['broadcasts'] += 1
+        self.counters['payload_bytes'] += length
+
+        # only the room's members are visited, not every connected client
+        self.broadcast(full_message, sock, self.rooms[room])
+        if room == DEFAULT_ROOM and self.history is not None:
+            self.history.append(parts)
+        if self.relays:
+            self.relay(room, parts)
+
+    def relay(self, room, parts):
+        # one frame for all workers, they deliver it to their own members of the room
+        room_name = room.encode('utf-8')
+        frame = encode_frame(b''.join((ROOM_LENGTH.pack(len(room_name)), room_name) + parts))
+        for relay_socket in self.relays:
+            self.outbound[relay_socket].push(frame)
+            self.dirty.add(relay_socket)
+
+    def handle_relay(self, frame):
+        (length,) = ROOM_LENGTH.unpack_from(frame)
+        start = ROOM_LENGTH.size + length
+        room = frame[ROOM_LENGTH.size:start].decode('utf-8', errors='replace')
+
+        # the message was built by the other worker, it has no sender here
+        message = frame[start:]
+        if room == DEFAULT_ROOM and self.history is not None:
+            self.history.append((message,))
+        members = self.rooms.get(room)
+        if not members:
+            return
+        if self.scatter_gather:
+            message = (message,)
+        self.broadcast(message, None, members)
+
+    def reap_idle(self):
+        # only the sockets whose timer fired are looked at
+        now = self.now
+        for sock in self.timers.advance(now):
+            if sock not in self.interest:
+                continue
+
+            # a sender paused by backpressure is not read, so it cannot look active
+            if sock in self.paused:
+                self.timers.schedule(sock, self.idle_timeout, now)
+                continue
+
+            last_activity = self.last_activity[sock]
+            pinged = self.pinged.pop(sock, None)
+            if pinged is not None and last_activity < pinged:
+                # no answer to the PING
+                if self.verbose:
+                    print('Evicting idle connection: {}'.format(self.clients.get(sock)))
+                self.disconnect(sock)
+                continue
+
+            remaining = last_activity + self.idle_timeout - now
+            if remaining > 0:
+                # active since the timer was set, try again when it could be idle
+                self.timers.schedule(sock, remaining, now)
+            elif sock not in self.clients:
+                # connected but never sent a nickname
+                self.disconnect(sock)
+            else:
+                self.send_ping(sock)
+                self.pinged[sock] = now
+                self.timers.schedule(sock, self.ping_timeout, now)
+
+    def send_ping(self, sock):
+        ping = encode_frame(PING) if self.framed else PING
+        self.outbound[sock].push((ping,) if self.scatter_gather else ping)
+        self.dirty.add(sock)
+
+    def replay_history(self, sock):
+        # frames are copied out of the ring, it may be overwritten before the queue drains,
+        # and at most half a queue is replayed, so live messages are not dropped right away
+        queue = self.outbound[sock]
+        for frame in self.history.frames(self.max_queue // 2):
+            message = bytes(frame)
+            queue.push((message,) if self.scatter_gather else message)
+        if queue:
+            self.dirty.add(sock)
+
+    def join(self, sock, room):
+        if room not in self.rooms:
+            self.rooms[room] = set()
+            self.room_prefixes.setdefault(room, f"[{room}] ".encode('utf-8'))
+        self.rooms[room].add(sock)
+        self.memberships[sock].add(room)
+        self.active_rooms[sock] = room
+        if room != DEFAULT_ROOM:
+            self.send_notice(sock, f'joined {room}')
+
+    def part(self, sock, room):
+        members = self.rooms.get(room)
+        if members is None or sock not in members:
+            self.send_notice(sock, f'not in {room}')
+            return
+        self.leave(sock, room)
+
+        # messages go to another joined room, if any is left
+        if self.active_rooms.get(sock) == room:
+            rooms = self.memberships[sock]
+            self.active_rooms[sock] = next(iter(rooms)) if rooms else None
+        self.send_notice(sock, f'left {room}')
+
+    def leave(self, sock, room):
+        members = self.rooms[room]
+        members.discard(sock)
+        self.memberships[sock].discard(room)
+        if not members:
+            del self.rooms[room]
+            if room != DEFAULT_ROOM:
+                del self.room_prefixes[room]
+
+    def send_notice(self, sock, text):
+        # server message to one client, it goes through the same queue as broadcasts
+        notice = f'* {text}\n'.encode('utf-8')
+        if self.framed:
+            notice = encode_frame(notice)
+        if self.scatter_gather:
+            notice = (notice,)
+        self.outbound[sock].push(notice)
+        self.dirty.add(sock)
+
+    def broadcast(self, message, sender_socket, clients):
+        # same semantics as broadcast(), but only queues the message,
+        # the sockets are written when they are writable
+        slow = []
+        for client in clients:
+            if client == sender_socket:
+                continue
+            queue = self.outbound[client]
+            if queue.full():
+                if self.slow_consumer == 'disconnect':
+                    slow.append(client)
+                    continue
+                if self.slow_consumer == 'drop-oldest':
+                    queue.drop_oldest()
+                else:
+                    self.pause(sender_socket, client)
+            queue.push(message)
+            self.dirty.add(client)
+
+        for client in slow:
+            if self.verbose:
+                print('Disconnecting slow consumer: {}'.format(self.clients[client]))
+            self.disconnect(client)
+
+    def pause(self, sender_socket, client):
+        # stop reading from the sender until the client's queue has drained
+        if sender_socket not in self.interest:
+            return
+        self.blocked_by.setdefault(client, set()).add(sender_socket)
+        self.paused.add(sender_socket)
+        self.update_interest(sender_socket)
+
+    def resume(self, client):
+        for sender_socket in self.blocked_by.pop(client, ()):
+            # the sender may still be blocked by another full queue
+            if any(sender_socket in senders for senders in self.blocked_by.values()):
+                continue
+            self.paused.discard(sender_socket)
+            if sender_socket in self.interest:
+                self.update_interest(sender_socket)
+
+    def handle_writable(self, sock):
+        try:
+            self.outbound[sock].drain(sock)
+        except OSError:
+            self.disconnect(sock)
+            return
+        self.after_write(sock)
+
+    def after_write(self, sock):
+        # release paused senders once the queue is below the low watermark
+        if sock in self.blocked_by and len(self.outbound[sock]) <= self.max_queue // 2:
+            self.resume(sock)
+        self.update_interest(sock)
+
+    def flush(self):
+        # try to write queued data right away, register for writability only if it did not fit
+        # pop() keeps the set's table, so flushing a big room does not reallocate it every tick
+        dirty = self.dirty
+        while dirty:
+            sock = dirty.pop()
+            if sock not in self.interest:
+                continue
+            try:
+                self.outbound[sock].drain(sock)
+            except OSError:
+                self.disconnect(sock)
+                continue
+            self.after_write(sock)
+
+    def disconnect(self, sock):
+        user = self.clients.pop(sock, None)
+        self.prefixes.pop(sock, None)
+        for room in list(self.memberships.get(sock, ())):
+            self.leave(sock, room)
+        self.memberships.pop(sock, None)
+        self.active_rooms.pop(sock, None)
+        self.relays.discard(sock)
+        if self.timers is not None:
+            self.timers.cancel(sock)
+            self.last_activity.pop(sock, None)
+            self.pinged.pop(sock, None)
+        if self.verbose and user is not None:
+            print('Closed connection from: {}'.format(user))
+
+        # unregister before closing, the selector needs a valid fd
+        if self.interest.pop(sock):
+            self.selector.unregister(sock)
+        del self.connections[sock.fileno()]
+        del self.outbound[sock]
+        self.parsers.pop(sock, None)
+        self.dirty.discard(sock)
+        self.paused.discard(sock)
+        self.resume(sock)
+        for senders in self.blocked_by.values():
+            senders.discard(sock)
+        sock.close()
+
+    def close(self):
+        for sock in list(self.connections.values()):
+            self.disconnect(sock)
+        if self.server_socket is not None:
+            self.selector.unregister(self.server_socket)
+            self.server_socket.close()
+        if self.history is not None:
+            self.history.close()
+        self.selector.close()
+
+
+def run_worker(index, relay_pairs, options, ready=None):
+    # keep only this worker's ends of the relay mesh
+    server = ChatServer(reuse_port=True, **options)
+    for (first, second), (left, right) in relay_pairs.items():
+        if first == index:
+            server_relay, unused = left, right
+        elif second == index:
+            server_relay, unused = right, left
+        else:
+            left.close()
+            right.close()
+            continue
+        unused.close()
+        server.add_relay(server_relay)
+
+    server.start()
+    if ready is not None:
+        ready.put(index)
+    try:
+        server.main_loop()
+    except KeyboardInterrupt:
+        server.close()
+
+
+def start_workers(workers, ready=None, **options):
+    import multiprocessing
+
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise OSError('SO_REUSEPORT is not available on this platform')
+
+    # full mesh of unix socket pairs, one per pair of workers
+    relay_pairs = {}
+    for first in range(workers):
+        for second in range(first + 1, workers):
+            relay_pairs[first, second] = socket.socketpair()
+
+    processes = []
+    for index in range(workers):
+        process = multiprocessing.Process(target=run_worker, args=(index, relay_pairs, options, ready))
+        process.start()
+        processes.append(process)
+
+    # the parent does not take part in the mesh
+    for left, right in relay_pairs.values():
+        left.close()
+        right.close()
+    return processes
+
+
+def serve_workers(workers, **options):
+    processes = start_workers(workers, **options)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
+def raise_fd_limit():
+    # every client costs one fd, lift the soft limit up to the hard limit
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 1 << 20
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def hold_idle_clients(port, count, first, ready, done):
+    # runs in a child process, so the benchmark clients do not eat the server's fd budget
+    raise_fd_limit()
+    sockets = []
+    for i in range(first, first + count):
+        try:
+            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # spread source addresses over 127.0.0.0/8 so the ephemeral
+            # port range of a single address is never exhausted
+            client_socket.bind((f'127.0.{(i >> 8) & 0xff}.{(i & 0xff) or 1}', 0))
+            client_socket.connect((HOST, port))
+            client_socket.send(f'idle{i}'.encode('utf-8'))
+        except OSError:
+            break
+        sockets.append(client_socket)
+    ready.put(len(sockets))
+    done.wait()
+    for client_socket in sockets:
+        client_socket.close()
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def benchmark_idle_clients(counts=(1000, 10000, 50000), probes=200, per_process=15000):
+    import multiprocessing
+
+    fd_limit = raise_fd_limit()
+    print(f'fd limit: {fd_limit}, selector: {selectors.DefaultSelector.__name__}')
+    print(f'{"clients":>8} {"held":>8} {"p50 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+
+    for count in counts:
+        server = ChatServer(port=0, verbose=False)
+        server.start()
+        stopped = threading.Event()
+
+        def run():
+            while not stopped.is_set():
+                server.loop_iteration(timeout=0.05)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+
+        # open the idle clients from child processes
+        ready = multiprocessing.Queue()
+        done = multiprocessing.Event()
+        holders = []
+        for first in range(0, count, per_process):
+            holder = multiprocessing.Process(
+                target=hold_idle_clients,
+                args=(server.port, min(per_process, count - first), first, ready, done))
+            holder.start()
+            holders.append(holder)
+        opened = sum(ready.get() for _ in holders)
+
+        # wait until the server has registered every nickname it can
+        deadline = time.monotonic() + 30
+        while len(server.clients) < opened and time.monotonic() < deadline:
+            time.sleep(0.05)
+        held = len(server.clients)
+
+        # one sender and one receiver measure wakeup + broadcast latency
+        latencies = []
+        try:
+            receiver = socket.create_connection((HOST, server.port))
+            receiver.send(b'receiver')
+            sender = socket.create_connection((HOST, server.port))
+            sender.send(b'sender')
+            time.sleep(0.2)
+            for i in range(probes):
+                started = time.perf_counter()
+                sender.send(b'probe')
+                receiver.recv(1024)
+                latencies.append((time.perf_counter() - started) * 1000)
+            receiver.close()
+            sender.close()
+        except OSError as e:
+            print(f'probe failed: {e}')
+
+        if latencies:
+            print(f'{count:>8} {held:>8} {percentile(latencies, 0.5):>8.3f} '
+                  f'{percentile(latencies, 0.99):>8.3f} {max(latencies):>8.3f}')
+        else:
+            print(f'{count:>8} {held:>8} {"-":>8} {"-":>8} {"-":>8}')
+
+        done.set()
+        for holder in holders:
+            holder.join()
+        stopped.set()
+        thread.join()
+        server.close()
+
+
+def drain_consumers(fast, slow, slow_delay, done):
+    # runs in a child process: fast consumers are read as soon as data arrives,
+    # slow consumers get one small read every slow_delay seconds
+    selector = selectors.DefaultSelector()
+    for sock in fast:
+        selector.register(sock, selectors.EVENT_READ)
+    next_slow_read = time.monotonic()
+
+    # the fork also inherited the server side of every pair, so EOF never
+    # arrives; the parent says when it is done instead
+    while not done.is_set():
+        for key, _ in selector.select(min(slow_delay, 0.1)):
+            try:
+                key.fileobj.recv(65536)
+            except OSError:
+                pass
+        if time.monotonic() >= next_slow_read:
+            next_slow_read += slow_delay
+            for sock in slow:
+                try:
+                    sock.recv(512, socket.MSG_DONTWAIT)
+                except OSError:
+                    pass
+
+
+def benchmark_fanout(recipients=5000, messages=1000, slow_fraction=0.01, size=64, slow_delay=0.5):
+    import multiprocessing
+
+    raise_fd_limit()
+    payload = b'x' * size
+    slow_count = int(recipients * slow_fraction)
+    print(f'{recipients} recipients, {slow_count} slow, {messages} messages of {size} bytes')
+    print(f'{"policy":>13} {"msg/s":>10} {"deliveries/s":>13} {"dropped":>9} {"closed":>7}')
+
+    for policy in SLOW_CONSUMER_POLICIES:
+        server = ChatServer(verbose=False, max_queue=256, slow_consumer=policy)
+
+        # socketpairs stand in for accepted connections, the server keeps one end
+        sender, sender_peer = socket.socketpair()
+        server.add_connection(sender)
+        server.clients[sender] = 'sender'
+        server_ends = []
+        client_ends = []
+        for i in range(recipients):
+            server_end, client_end = socket.socketpair()
+            # small buffers make the slow consumers fill up quickly
+            server_end.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            server.add_connection(server_end)
+            server.clients[server_end] = f'client{i}'
+            server_ends.append(server_end)
+            client_ends.append(client_end)
+        fast_ends = server_ends[slow_count:]
+
+        done = multiprocessing.Event()
+        reader = multiprocessing.Process(
+            target=drain_consumers, args=(client_ends[slow_count:], client_ends[:slow_count], slow_delay, done))
+        reader.start()
+        for client_end in client_ends[slow_count:]:
+            client_end.close()
+
+        # done when every message is queued and every fast consumer has its copy
+        started = time.perf_counter()
+        sent = 0
+        while sent < messages or any(server.outbound[sock] for sock in fast_ends if sock in server.outbound):
+            # with backpressure the sender is paused and the loop only drains queues
+            if sent < messages and sender not in server.paused:
+                server.broadcast(payload, sender, server.clients)
+                sent += 1
+                server.flush()
+            server.loop_iteration(timeout=0)
+        elapsed = time.perf_counter() - started
+
+        dropped = sum(queue.dropped for queue in server.outbound.values())
+        closed = recipients + 1 - len(server.clients)
+        print(f'{policy:>13} {messages / elapsed:>10.0f} {messages * recipients / elapsed:>13.0f} '
+              f'{dropped:>9} {closed:>7}')
+
+        done.set()
+        reader.join()
+        server.close()
+        sender_peer.close()
+        for client_end in client_ends[:slow_count]:
+            client_end.close()
+
+
+def benchmark_frame_parser(frames=1000000, size=16, chunk=65536):
+    # a recorded stream of small frames, replayed in recv-sized chunks
+    payload = b'x' * size
+    stream = encode_frame(payload) * frames
+    chunks = [stream[i:i + chunk] for i in range(0, len(stream), chunk)]
+    print(f'{frames} frames of {size} bytes in {len(chunks)} chunks of {chunk} bytes')
+    print(f'{"parser":>18} {"messages/s":>12} {"messages seen":>14}')
+
+    # current approach: every recv is taken as one message
+    started = time.perf_counter()
+    seen = 0
+    for data in chunks:
+        if len(data):
+            seen += 1
+    elapsed = time.perf_counter() - started
+    print(f'{"recv per message":>18} {seen / elapsed:>12.0f} {seen:>14}')
+
+    # naive reassembly: slice the bytes buffer after every frame
+    started = time.perf_counter()
+    seen = 0
+    buffer = b''
+    for data in chunks:
+        buffer += data
+        while len(buffer) >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(buffer)
+            if len(buffer) - FRAME_HEADER.size < length:
+                break
+            buffer[FRAME_HEADER.size:FRAME_HEADER.size + length]
+            buffer = buffer[FRAME_HEADER.size + length:]
+            seen += 1
+    elapsed = time.perf_counter() - started
+    print(f'{"bytes slicing":>18} {seen / elapsed:>12.0f} {seen:>14}')
+
+    # FrameParser: memoryview slices, one compaction per read
+    started = time.perf_counter()
+    seen = 0
+    parser = FrameParser()
+    for data in chunks:
+        seen += len(parser.feed(data))
+    elapsed = time.perf_counter() - started
+    print(f'{"FrameParser":>18} {seen / elapsed:>12.0f} {seen:>14}')
+
+
+def benchmark_broadcast_allocations(room_sizes=(10, 100, 1000, 10000), rounds=200, size=64):
+    import tracemalloc
+
+    print(f'{"room":>6} {"mode":>14} {"payload B/msg":>14} {"traced B/msg":>13}')
+    for room_size in room_sizes:
+        for scatter_gather in (False, True):
+            server = ChatServer(verbose=False, framed=True, scatter_gather=scatter_gather)
+
+            # plain objects stand in for sockets, nothing is written in this benchmark
+            sockets = [object() for _ in range(room_size)]
+            for i, sock in enumerate(sockets):
+                server.outbound[sock] = OutboundQueue(server.max_queue, scatter_gather)
+                server.handle_message(sock, f'client{i}'.encode('utf-8'))
+            sender = sockets[0]
+            body = b'x' * size
+
+            def drain():
+                # empty the queues the way a flush does, keeping their storage
+                for queue in server.outbound.values():
+                    while queue.messages:
+                        queue.messages.popleft()
+                while server.dirty:
+                    server.dirty.pop()
+
+            # one round to size the dirty set and the queues
+            server.handle_message(sender, body)
+            drain()
+            server.counters.update(broadcasts=0, payload_bytes=0)
+
+            traced = 0
+            tracemalloc.start()
+            for _ in range(rounds):
+                before = tracemalloc.get_traced_memory()[0]
+                server.handle_message(sender, body)
+                traced += tracemalloc.get_traced_memory()[0] - before
+                drain()
+            tracemalloc.stop()
+
+            mode = 'sendmsg' if server.scatter_gather else 'joined'
+            payload = server.counters['payload_bytes'] / server.counters['broadcasts']
+            print(f'{room_size:>6} {mode:>14} {payload:>14.0f} {traced / rounds:>13.0f}')
+
+
+def benchmark_rooms(clients=10000, rooms=1000, messages=2000, size=64):
+    # plain objects stand in for sockets, nothing is written in this benchmark
+    server = ChatServer(verbose=False)
+    sockets = [object() for _ in range(clients)]
+    for i, sock in enumerate(sockets):
+        server.outbound[sock] = OutboundQueue(server.max_queue)
+        server.handle_message(sock, f'client{i}'.encode('utf-8'))
+        server.handle_message(sock, f'/join room{i % rooms}'.encode('utf-8'))
+        server.handle_message(sock, f'/part {DEFAULT_ROOM}'.encode('utf-8'))
+    body = b'x' * size
+
+    def drain():
+        for queue in server.outbound.values():
+            while queue.messages:
+                queue.messages.popleft()
+        while server.dirty:
+            server.dirty.pop()
+
+    drain()
+    print(f'{clients} clients in {rooms} rooms, {messages} messages')
+    print(f'{"fan-out":>12} {"us/msg":>10} {"deliveries/msg":>15}')
+
+    # current behaviour: every message visits every connected client
+    elapsed = 0
+    for i in range(messages):
+        sender = sockets[i % clients]
+        started = time.process_time()
+        server.broadcast(body, sender, server.clients)
+        elapsed += time.process_time() - started
+        drain()
+    print(f'{"full scan":>12} {elapsed / messages * 1e6:>10.1f} {clients - 1:>15}')
+
+    # room index: only the members of the sender's room are visited
+    elapsed = 0
+    deliveries = 0
+    for i in range(messages):
+        sender = sockets[i % clients]
+        started = time.process_time()
+        server.handle_message(sender, body)
+        elapsed += time.process_time() - started
+        deliveries += len(server.dirty)
+        drain()
+    print(f'{"room index":>12} {elapsed / messages * 1e6:>10.1f} {deliveries / messages:>15.0f}')
+
+
+def benchmark_workers(worker_counts=(1, 2, 4, 8), clients=32, messages=200, size=64, timeout=60):
+    import multiprocessing
+
+    # pick a free port up front, every worker binds it with SO_REUSEPORT
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind((HOST, 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    body = b'x' * size
+    expected = clients * (clients - 1) * messages
+    print(f'{clients} framed clients, {messages} messages each, {expected} deliveries, {multiprocessing.cpu_count()} cpus')
+    print(f'{"workers":>8} {"msg/s":>10} {"deliveries/s":>13} {"delivered":>10}')
+
+    for workers in worker_counts:
+        ready = multiprocessing.Queue()
+        processes = start_workers(workers, ready=ready, port=port, verbose=False, framed=True, max_queue=1 << 16)
+        for _ in range(workers):
+            ready.get()
+
+        sockets = []
+        for i in range(clients):
+            client_socket = socket.create_connection((HOST, port))
+            client_socket.sendall(encode_frame(f'bench{i}'.encode('utf-8')))
+            sockets.append(client_socket)
+        parsers = {client_socket: FrameParser() for client_socket in sockets}
+        time.sleep(0.5)
+
+        def read_available():
+            received = 0
+            for client_socket in sockets:
+                while True:
+                    try:
+                        data = client_socket.recv(MAX_FRAME_SIZE, socket.MSG_DONTWAIT)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    received += len(parsers[client_socket].feed(data))
+            return received
+
+        delivered = 0
+        started = time.perf_counter()
+        for _ in range(messages):
+            for client_socket in sockets:
+                client_socket.sendall(encode_frame(body))
+            delivered += read_available()
+        deadline = time.monotonic() + timeout
+        while delivered < expected and time.monotonic() < deadline:
+            delivered += read_available()
+        elapsed = time.perf_counter() - started
+
+        print(f'{workers:>8} {clients * messages / elapsed:>10.0f} {delivered / elapsed:>13.0f} {delivered:>10}')
+
+        for client_socket in sockets:
+            client_socket.close()
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
+def benchmark_history(messages=1000000, size=64):
+    import tracemalloc
+
+    def frame(i):
+        # distinct frames, the way real chat traffic arrives
+        body = f'client{i % 1000}: message {i} '.encode('utf-8')
+        return encode_frame(body + b'x' * max(0, size - len(body)))
+
+    length = len(frame(0))
+    print(f'{messages} retained messages of about {length} bytes')
+    print(f'{"storage":>16} {"total MB":>10} {"bytes/msg":>10} {"overhead/msg":>13}')
+
+    # what a deque of bytes objects would cost for the same history
+    tracemalloc.start()
+    retained = deque(maxlen=messages)
+    for i in range(messages):
+        retained.append(frame(i))
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del retained
+    print(f'{"deque of bytes":>16} {used / 1e6:>10.1f} {used / messages:>10.1f} {used / messages - length:>13.1f}')
+
+    tracemalloc.start()
+    history = HistoryRing(capacity=messages * length, max_messages=messages)
+    for i in range(messages):
+        history.append((frame(i),))
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f'{"HistoryRing":>16} {used / 1e6:>10.1f} {used / messages:>10.1f} {used / messages - length:>13.1f}')
+    history.close()
+
+class IdleBenchSocket:
+    # just enough of a socket for ChatServer bookkeeping
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        pass
+
+
+def benchmark_idle_reaper(connections=100000, seconds=360, idle_timeout=300.0, active_fraction=0.01):
+    import random
+
+    random.seed(1)
+    server = ChatServer(verbose=False, idle_timeout=idle_timeout, ping_timeout=10.0)
+    start = server.timers.current * server.timers.tick
+    sockets = [IdleBenchSocket(fd) for fd in range(connections)]
+    for sock in sockets:
+        server.connections[sock.fd] = sock
+        server.outbound[sock] = OutboundQueue(server.max_queue)
+        server.interest[sock] = 0
+        server.clients[sock] = f'client{sock.fd}'
+        server.memberships[sock] = set()
+        # connections arrived over the last idle_timeout, not all at once
+        connected = start - random.random() * idle_timeout
+        server.last_activity[sock] = connected
+        server.timers.schedule(sock, idle_timeout, connected)
+
+    # 1% of the connections are dead and never answer a PING
+    dead = set(random.sample(sockets, connections // 100))
+    touch_cpu = reap_cpu = scan_cpu = 0
+    for second in range(1, seconds + 1):
+        now = start + second
+        server.now = now
+
+        # some clients talk every second, reading them only stores the time
+        active = random.sample(sockets, int(connections * active_fraction))
+        started = time.process_time()
+        for sock in active:
+            if sock not in dead and sock in server.interest:
+                server.last_activity[sock] = now
+        touch_cpu += time.process_time() - started
+
+        started = time.process_time()
+        server.reap_idle()
+        reap_cpu += time.process_time() - started
+
+        # pinged clients that are alive answer right away
+        for sock in list(server.pinged):
+            server.outbound[sock].messages.clear()
+            if sock not in dead:
+                server.last_activity[sock] = now
+        server.dirty.clear()
+
+        # what a reaper without the wheel does every tick: look at every client
+        started = time.process_time()
+        idle = [sock for sock, last in server.last_activity.items() if now - last >= idle_timeout]
+        scan_cpu += time.process_time() - started
+
+    evicted = connections - len(server.clients)
+    print(f'{connections} connections, {seconds} ticks of 1 s, idle timeout {idle_timeout:.0f} s')
+    print(f'activity updates: {touch_cpu / seconds * 1e3:.2f} ms/tick '
+          f'({touch_cpu / (seconds * connections * active_fraction) * 1e9:.0f} ns each)')
+    print(f'timer wheel reaper: {reap_cpu / seconds * 1e3:.2f} ms/tick including PINGs, '
+          f'evicted {evicted} of {len(dead)} dead')
+    print(f'full scan, finding the idle clients only: {scan_cpu / seconds * 1e3:.2f} ms/tick')
+
+
 # A 'null' stream that discards anything written to it
 class NullWriter(StringIO):
     def write(self, txt):
@@ -242,11 +1649,312 @@ class TestChatServer(unittest.TestCase):
         print(f"recv called with: {mock_client_socket.recv.call_args}")
         print()
 
+    def test_reactor_nickname_then_broadcast(self):
+        print('Testing reactor nickname and broadcast ...')
+        server = ChatServer(verbose=False)
+        mock_receiver_socket = MagicMock()
+        mock_receiver_socket.send.side_effect = len
+        server.outbound[mock_receiver_socket] = OutboundQueue(server.max_queue)
+        server.interest[mock_receiver_socket] = selectors.EVENT_READ
+        server.handle_message(mock_receiver_socket, b'receiver')
+        server.outbound[self.mock_client_socket] = OutboundQueue(server.max_queue)
+        server.selector = MagicMock()
+
+        # first message from a connection is its nickname
+        self.mock_client_socket.recv.return_value = b'TestUser'
+        server.handle_readable(self.mock_client_socket)
+        self.assertEqual(server.clients[self.mock_client_socket], 'TestUser')
+        mock_receiver_socket.send.assert_not_called()
+
+        # following messages are broadcast with the nickname prefixed
+        self.mock_client_socket.recv.return_value = b'Hello'
+        server.handle_readable(self.mock_client_socket)
+        server.flush()
+        mock_receiver_socket.send.assert_called_once_with(b'TestUser: Hello')
+        self.mock_client_socket.send.assert_not_called()
+        print(f"send receiver called with: {mock_receiver_socket.send.call_args}")
+        print()
+
+    def test_rooms_join_part(self):
+        print('Testing rooms join and part ...')
+        server = ChatServer(verbose=False)
+        mock_sockets = [MagicMock(), MagicMock(), MagicMock()]
+        for i, sock in enumerate(mock_sockets):
+            server.outbound[sock] = OutboundQueue(server.max_queue)
+            server.handle_message(sock, f'user{i}'.encode('utf-8'))
+        self.assertEqual(server.rooms[DEFAULT_ROOM], set(mock_sockets))
+
+        # user0 and user1 join a room, messages there skip user2
+        server.handle_message(mock_sockets[0], b'/join python\n')
+        server.handle_message(mock_sockets[1], b'/JOIN python')
+        self.assertEqual(server.rooms['python'], {mock_sockets[0], mock_sockets[1]})
+        self.assertEqual(server.memberships[mock_sockets[0]], {DEFAULT_ROOM, 'python'})
+        for queue in server.outbound.values():
+            queue.messages.clear()
+
+        server.handle_message(mock_sockets[0], b'hi\n')
+        self.assertEqual(list(server.outbound[mock_sockets[1]].messages), [b'[python] user0: hi\n'])
+        self.assertEqual(len(server.outbound[mock_sockets[2]]), 0)
+
+        # after /part the sender talks in the room it is still in
+        server.handle_message(mock_sockets[0], b'/part python')
+        self.assertEqual(server.active_rooms[mock_sockets[0]], DEFAULT_ROOM)
+        server.handle_message(mock_sockets[1], b'/part python')
+        self.assertNotIn('python', server.rooms)
+        print()
+
+    def test_relay_between_workers(self):
+        print('Testing relay between workers ...')
+        first, second = ChatServer(verbose=False), ChatServer(verbose=False)
+        left, right = socket.socketpair()
+        first.selector = second.selector = MagicMock()
+        first.add_relay(left)
+        second.add_relay(right)
+
+        # one client on each worker, both in the default room
+        mock_sender_socket, mock_receiver_socket = MagicMock(), MagicMock()
+        first.outbound[mock_sender_socket] = OutboundQueue(first.max_queue)
+        first.handle_message(mock_sender_socket, b'sender')
+        second.outbound[mock_receiver_socket] = OutboundQueue(second.max_queue)
+        second.handle_message(mock_receiver_socket, b'receiver')
+
+        # the broadcast crosses the relay and reaches the other worker's client
+        first.handle_message(mock_sender_socket, b'Hello')
+        first.flush()
+        second.handle_readable(right)
+        self.assertEqual(list(second.outbound[mock_receiver_socket].messages), [b'sender: Hello'])
+        left.close()
+        right.close()
+        print()
+
+    def test_history_ring_wraps(self):
+        print('Testing history ring ...')
+        history = HistoryRing(capacity=16, max_messages=8)
+        for frame in (b'aaaaa', b'bbbbb', b'ccccc'):
+            history.append((frame,))
+        self.assertEqual([bytes(frame) for frame in history.frames()], [b'aaaaa', b'bbbbb', b'ccccc'])
+
+        # no room left before the end: the write wraps to 0 and evicts what it overwrites
+        history.append((b'dd', b'dd'))
+        self.assertEqual([bytes(frame) for frame in history.frames()], [b'bbbbb', b'ccccc', b'dddd'])
+        self.assertEqual([bytes(frame) for frame in history.frames(limit=1)], [b'dddd'])
+
+        # a frame larger than the ring is not stored
+        self.assertFalse(history.append((b'x' * 17,)))
+        history.close()
+        print()
+
+    def test_history_persists_and_replays(self):
+        print('Testing history persistence and replay ...')
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'history.bin')
+            server = ChatServer(verbose=False, history=HistoryRing(1024, 16, path=path))
+            mock_sender_socket = MagicMock()
+            server.outbound[mock_sender_socket] = OutboundQueue(server.max_queue)
+            server.handle_message(mock_sender_socket, b'sender')
+            server.handle_message(mock_sender_socket, b'Hello')
+            server.handle_message(mock_sender_socket, b'/join other')
+            server.handle_message(mock_sender_socket, b'not recorded')
+            server.history.close()
+
+            # a restarted server replays the lobby history to a new client
+            server = ChatServer(verbose=False, history=HistoryRing(1024, 16, path=path))
+            server.outbound[self.mock_client_socket] = OutboundQueue(server.max_queue)
+            server.handle_message(self.mock_client_socket, b'TestUser')
+            self.assertEqual(list(server.outbound[self.mock_client_socket].messages), [b'sender: Hello'])
+            server.history.close()
+        print()
+
+    def test_timer_wheel(self):
+        print('Testing timer wheel ...')
+        wheel = TimerWheel(tick=1.0, slots=8)
+        wheel.current = 100
+        wheel.schedule('a', 3, now=100.0)
+        wheel.schedule('b', 11, now=100.0)
+        wheel.schedule('c', 3, now=100.0)
+        wheel.cancel('c')
+
+        # 'b' shares a slot with 'a' but is one turn later
+        self.assertEqual(wheel.advance(102.5), [])
+        self.assertEqual(wheel.advance(103.0), ['a'])
+        self.assertEqual(wheel.advance(110.0), [])
+        self.assertEqual(wheel.advance(111.0), ['b'])
+        self.assertEqual(len(wheel), 0)
+        print()
+
+    def test_idle_client_pinged_then_evicted(self):
+        print('Testing idle client ping and eviction ...')
+        server = ChatServer(verbose=False, idle_timeout=5, ping_timeout=2)
+        server.selector = MagicMock()
+        server.timers.current = 1000
+        server.add_connection(self.mock_client_socket)
+        server.handle_message(self.mock_client_socket, b'TestUser')
+        server.last_activity[self.mock_client_socket] = 1000.0
+        server.timers.schedule(self.mock_client_socket, 5, 1000.0)
+
+        # activity before the deadline only moves the timer
+        server.last_activity[self.mock_client_socket] = 1003.0
+        server.now = 1005.0
+        server.reap_idle()
+        self.assertNotIn(self.mock_client_socket, server.pinged)
+
+        # idle for idle_timeout: PING
+        server.now = 1008.0
+        server.reap_idle()
+        self.assertEqual(list(server.outbound[self.mock_client_socket].messages), [PING])
+
+        # no answer within ping_timeout: closed
+        server.now = 1010.0
+        server.reap_idle()
+        self.assertNotIn(self.mock_client_socket, server.clients)
+        self.mock_client_socket.close.assert_called_once()
+        print()
+
+    def test_pong_only_answers_a_ping(self):
+        print('Testing PONG as chat text and as PING reply ...')
+        server = ChatServer(verbose=False, idle_timeout=5, ping_timeout=2)
+        server.selector = MagicMock()
+        server.add_connection(self.mock_client_socket)
+        server.handle_message(self.mock_client_socket, b'TestUser')
+
+        # no PING outstanding: the text PONG is broadcast
+        server.handle_message(self.mock_client_socket, b'PONG\n')
+        self.assertEqual(server.counters['broadcasts'], 1)
+
+        # the reply to a PING is not
+        server.pinged[self.mock_client_socket] = 1000.0
+        server.handle_message(self.mock_client_socket, b'PONG\n')
+        self.assertEqual(server.counters['broadcasts'], 1)
+        self.assertNotIn(self.mock_client_socket, server.pinged)
+
+        # unframed, the reply may share a recv with chat lines, on either side
+        server.pinged[self.mock_client_socket] = 1000.0
+        server.handle_message(self.mock_client_socket, b'hi\nPONG\nthere\n')
+        self.assertEqual(server.counters['broadcasts'], 2)
+        self.assertNotIn(self.mock_client_socket, server.pinged)
+        self.assertEqual(strip_pong(b'hi\nPONG\nthere\n'), (b'hi\nthere\n', True))
+        # PONG inside a line, or without its newline, is text
+        self.assertEqual(strip_pong(b'PONG or PING\n'), (b'PONG or PING\n', False))
+        self.assertEqual(strip_pong(b'hi PONG'), (b'hi PONG', False))
+        print()
+
+    def test_outbound_queue_partial_send(self):
+        print('Testing outbound queue partial send ...')
+        queue = OutboundQueue(limit=2)
+        queue.push(b'Hello')
+        queue.push(b'World')
+
+        # the socket accepts 3 bytes, then would block
+        self.mock_client_socket.send.side_effect = [3, BlockingIOError]
+        self.assertFalse(queue.drain(self.mock_client_socket))
+        self.assertEqual(queue.offset, 3)
+
+        # drop-oldest keeps the partially written head
+        queue.drop_oldest()
+        self.assertEqual(list(queue.messages), [b'Hello'])
+
+        self.mock_client_socket.send.side_effect = len
+        queue.drain(self.mock_client_socket)
+        self.assertEqual(bytes(self.mock_client_socket.send.call_args[0][0]), b'lo')
+        self.assertEqual(len(queue), 0)
+        print()
+
+    def test_frame_parser_split_and_coalesced(self):
+        print('Testing frame parser ...')
+        parser = FrameParser()
+        stream = encode_frame(b'TestUser') + encode_frame(b'Hello') + encode_frame(b'World!')
+
+        # a frame split across reads is only returned once it is complete
+        self.assertEqual(parser.feed(stream[:6]), [])
+        self.assertEqual(parser.feed(stream[6:15]), [b'TestUser'])
+
+        # several frames in one read are all returned
+        self.assertEqual(parser.feed(stream[15:]), [b'Hello', b'World!'])
+        self.assertEqual(len(parser.buffer), 0)
+
+        # a length above the limit is rejected instead of buffered forever
+        self.assertRaises(ValueError, parser.feed, FRAME_HEADER.pack(MAX_FRAME_SIZE + 1))
+        print()
+
+    def test_outbound_queue_scatter_gather(self):
+        print('Testing outbound queue scatter/gather ...')
+        queue = OutboundQueue(limit=4, scatter_gather=True)
+        shared = (b'\x00\x00\x00\x0c', b'TestUser: ', b'Hi')
+        queue.push(shared)
+        queue.push(shared)
+
+        # the kernel takes the first message and 5 bytes of the second
+        self.mock_client_socket.sendmsg.side_effect = [21, BlockingIOError]
+        self.assertFalse(queue.drain(self.mock_client_socket))
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.offset, 5)
+
+        # the rest of the second message starts inside its prefix part
+        self.mock_client_socket.sendmsg.side_effect = lambda buffers: sum(map(len, buffers))
+        queue.drain(self.mock_client_socket)
+        buffers = self.mock_client_socket.sendmsg.call_args[0][0]
+        self.assertEqual(b''.join(buffers), b'estUser: Hi')
+        self.assertEqual(len(queue), 0)
+        print()
+
+    def test_slow_consumer_policies(self):
+        print('Testing slow consumer policies ...')
+        for policy in SLOW_CONSUMER_POLICIES:
+            server = ChatServer(verbose=False, max_queue=1, slow_consumer=policy)
+            server.selector = MagicMock()
+            mock_sender_socket = MagicMock()
+            mock_slow_socket = MagicMock()
+            for sock, user in ((mock_sender_socket, 'sender'), (mock_slow_socket, 'slow')):
+                server.connections[id(sock)] = sock
+                sock.fileno.return_value = id(sock)
+                server.clients[sock] = user
+                server.outbound[sock] = OutboundQueue(server.max_queue)
+                server.interest[sock] = selectors.EVENT_READ
+
+            server.broadcast(b'first', mock_sender_socket, server.clients)
+            server.broadcast(b'second', mock_sender_socket, server.clients)
+
+            if policy == 'drop-oldest':
+                self.assertEqual(list(server.outbound[mock_slow_socket].messages), [b'second'])
+            elif policy == 'disconnect':
+                self.assertNotIn(mock_slow_socket, server.clients)
+                mock_slow_socket.close.assert_called_once()
+            else:
+                self.assertIn(mock_sender_socket, server.paused)
+                server.outbound[mock_slow_socket].messages.clear()
+                server.after_write(mock_slow_socket)
+                self.assertNotIn(mock_sender_socket, server.paused)
+        print()
+
 
 if __name__ == "__main__":
-    # uncomment this to test the communication between server and client on your local computer
-    # start_server()
+    if len(sys.argv) >= 2 and sys.argv[1] == 'reactor':
+        # epoll/kqueue based server for many concurrent clients,
+        # 'reactor framed' switches to length-prefixed messages,
+        # 'reactor history' keeps recent messages in chat-history.bin,
+        # 'reactor idle' PINGs clients idle for 5 minutes and closes the silent ones
+        history = None
+        if 'history' in sys.argv[2:]:
+            history = HistoryRing(capacity=1 << 20, max_messages=512, path=HISTORY_PATH)
+        idle_timeout = 300.0 if 'idle' in sys.argv[2:] else None
+        ChatServer(framed='framed' in sys.argv[2:], history=history, idle_timeout=idle_timeout).main_loop()
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'workers':
+        # 'workers 4 [framed]' forks 4 reactors sharing the port
+        serve_workers(int(sys.argv[2]), framed='framed' in sys.argv[3:])
+    elif len(sys.argv) == 2 and sys.argv[1] == 'bench':
+        benchmark_idle_clients()
+        benchmark_fanout()
+        benchmark_frame_parser()
+        benchmark_broadcast_allocations()
+        benchmark_rooms()
+        benchmark_workers()
+        benchmark_history()
+        benchmark_idle_reaper()
+    else:
+        # uncomment this to test the communication between server and client on your local computer
+        # start_server()
 
-    # uncomment this before submitting to domjudge
-    runner = unittest.TextTestRunner(stream=NullWriter())
-    unittest.main(testRunner=runner, exit=False)
+        # uncomment this before submitting to domjudge
+        runner = unittest.TextTestRunner(stream=NullWriter())
+        unittest.main(testRunner=runner, exit=False)